@@ -57,6 +57,17 @@ resource "google_monitoring_notification_channel" "email_notification" {
   }
 }
 
+## 開催日カレンダーのキャッシュ保存先バケット (get-race_results / get-race_planで共有)
+resource "google_storage_bucket" "kaisai_calendar" {
+  project                     = var.project_id
+  location                    = var.region
+  name                        = "scraping-kaisai_calendar-prod-${data.google_project.project.number}"
+  public_access_prevention    = "inherited"
+  storage_class               = "STANDARD"
+  force_destroy               = true
+  uniform_bucket_level_access = true
+}
+
 module "get-race_results" {
   source                  = "./modules/get-race_results"
   project_id              = var.project_id
@@ -66,6 +77,7 @@ module "get-race_results" {
   netkeiba_login_password = var.netkeiba_login_password
   gcf_source_bucket       = google_storage_bucket.gcf_source.name
   notification_channel_id = google_monitoring_notification_channel.email_notification.id
+  calendar_cache_bucket   = google_storage_bucket.kaisai_calendar.name
 }
 
 module "get-race_plan" {
@@ -75,6 +87,7 @@ module "get-race_plan" {
   region                  = var.region
   gcf_source_bucket       = google_storage_bucket.gcf_source.name
   notification_channel_id = google_monitoring_notification_channel.email_notification.id
+  calendar_cache_bucket   = google_storage_bucket.kaisai_calendar.name
 }
 
 module "get-race_prediction" {
@@ -45,10 +45,12 @@ resource "google_cloudfunctions_function" "functions-scraping-race_plan" {
   docker_registry       = "ARTIFACT_REGISTRY"
   max_instances         = 1
   environment_variables = {
-    PROJECT_ID       = var.project_id
-    LOCATION_ID      = var.region
-    PUBSUB_TARGET    = "race_prediction-prod"
-    MODEL_RUN_OFFSET = "10"
+    PROJECT_ID              = var.project_id
+    LOCATION_ID             = var.region
+    PUBSUB_TARGET           = "race_prediction-prod"
+    MODEL_RUN_OFFSET        = "10"
+    PREDICTION_BATCH_WINDOW = "10"
+    CALENDAR_CACHE_BUCKET   = var.calendar_cache_bucket
   }
 }
 
@@ -0,0 +1,267 @@
+import asyncio
+import dataclasses
+import logging
+import ssl
+import threading
+import time
+import urllib.parse
+
+import aiohttp
+import certifi
+
+from http_cache import get_default_cache
+
+logger = logging.getLogger(__name__)
+
+# ホストごとのレート制限 (1秒あたりのリクエスト数, バースト数)
+# 従来のtime.sleep(1)と同じく、1ホストあたり毎秒1リクエストを上限とする
+DEFAULT_RATE_LIMITS = {
+    "db.netkeiba.com": (1.0, 1),
+    "race.netkeiba.com": (1.0, 1),
+    "regist.netkeiba.com": (1.0, 1),
+    "jiro8.sakura.ne.jp": (1.0, 1),
+}
+# 上記に定義のないホストに適用するレート制限
+FALLBACK_RATE_LIMIT = (1.0, 1)
+
+# リトライ対象のHTTPステータスコード
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# SSLコンテキストはプロセス内で1度だけ作成する
+SSL_CONTEXT = ssl.create_default_context(cafile=certifi.where())
+
+
+class TokenBucket:
+    """
+    トークンバケット方式のレートリミッタ
+    スレッドセーフかつイベントループに依存しないため、
+    別スレッドの asyncio.run() から同じホストへアクセスしても全体のレートが守られる
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """トークンを1つ予約し、利用可能になるまでの待ち時間(秒)を返す"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated_at) * self.rate
+            )
+            self._updated_at = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    async def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def configure_rate_limit(host, rate, capacity=1):
+    """
+    ホストごとのレート制限を設定する関数
+
+    Parameters:
+    ----------
+    host : str
+        対象ホスト名 (例: db.netkeiba.com)
+    rate : float
+        1秒あたりのリクエスト数
+    capacity : int
+        バースト時に連続で送信できるリクエスト数
+    """
+    with _buckets_lock:
+        _buckets[host] = TokenBucket(rate, capacity)
+
+
+def get_bucket(host):
+    with _buckets_lock:
+        if host not in _buckets:
+            rate, capacity = DEFAULT_RATE_LIMITS.get(host, FALLBACK_RATE_LIMIT)
+            _buckets[host] = TokenBucket(rate, capacity)
+        return _buckets[host]
+
+
+@dataclasses.dataclass(frozen=True)
+class FetchResult:
+    url: str
+    status: int
+    content: bytes
+    headers: dict
+    from_cache: bool = False
+
+    def text(self, encoding="utf-8"):
+        return self.content.decode(encoding, errors="replace")
+
+
+class AsyncFetcher:
+    """
+    コネクションプールを共有し、ホストごとのレート制限のもとで並行にHTTP GETを行うクラス
+
+    Parameters:
+    ----------
+    max_connections : int
+        同時に保持するコネクション数の上限
+    max_retries : int
+        ネットワークエラー・5xx・429時のリトライ回数
+    backoff : float
+        リトライ間隔の初期値(秒)。リトライごとに2倍になる
+    timeout : float
+        1リクエストあたりのタイムアウト(秒)
+    cookies : dict
+        リクエストに付与するCookie (ログイン済みセッションの引き継ぎに使用)
+    headers : dict
+        リクエストに付与するHTTPヘッダ
+    cache : http_cache.ResponseCache
+        レスポンスキャッシュ。Noneの場合はキャッシュを利用しない
+    """
+
+    def __init__(
+        self,
+        max_connections=10,
+        max_retries=3,
+        backoff=1.0,
+        timeout=60,
+        cookies=None,
+        headers=None,
+        cache=None,
+    ):
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cookies = cookies
+        self.headers = headers
+        self.cache = cache
+        self._session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.max_connections, ssl=SSL_CONTEXT, ttl_dns_cache=300
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            cookies=self.cookies,
+            headers=self.headers,
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._session.close()
+        self._session = None
+
+    async def fetch(self, url, ttl=None):
+        """
+        URLを取得する。リトライ上限に達した場合はNoneを返す
+        キャッシュがTTL内であればリクエストを送らず、期限切れの場合は条件付きリクエストで再検証する
+
+        Parameters:
+        ----------
+        url : str
+            取得対象URL
+        ttl : float
+            キャッシュを再検証せずに返す期間(秒)。Noneの場合はキャッシュの既定値
+
+        Returns:
+        ----------
+        result : FetchResult or None
+        """
+        entry = None
+        if self.cache is not None:
+            entry = await asyncio.to_thread(self.cache.get, url)
+            if entry is not None and self.cache.is_fresh(entry, ttl):
+                return self._from_entry(entry)
+
+        request_headers = entry.validators() if entry is not None else None
+        bucket = get_bucket(urllib.parse.urlsplit(url).hostname)
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire()
+            try:
+                async with self._session.get(url, headers=request_headers) as response:
+                    content = await response.read()
+                    if response.status == 304 and entry is not None:
+                        entry = await asyncio.to_thread(self.cache.refresh, entry)
+                        return self._from_entry(entry)
+                    if (
+                        response.status not in RETRY_STATUS_CODES
+                        or attempt == self.max_retries
+                    ):
+                        if response.status == 200 and self.cache is not None:
+                            await asyncio.to_thread(
+                                self.cache.put, url, 200, content, response.headers
+                            )
+                        return FetchResult(
+                            url, response.status, content, dict(response.headers)
+                        )
+                    logger.warning(
+                        f"Retrying {url} (status: {response.status}, attempt: {attempt + 1})"
+                    )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries:
+                    logger.error(f"Network error occurred for {url}: {e}")
+                    return None
+                logger.warning(f"Retrying {url} ({e}, attempt: {attempt + 1})")
+            await asyncio.sleep(self.backoff * 2**attempt)
+
+    @staticmethod
+    def _from_entry(entry):
+        return FetchResult(
+            entry.url, entry.status, entry.content, entry.headers, from_cache=True
+        )
+
+    async def fetch_all(self, urls, ttl=None):
+        results = await asyncio.gather(*(self.fetch(url, ttl) for url in urls))
+        hits = sum(1 for result in results if result is not None and result.from_cache)
+        logger.info(f"Fetched {len(urls)} URLs ({hits} served from HTTP cache)")
+        return dict(zip(urls, results))
+
+
+def invalidate(url):
+    """
+    fetch_allで取得したURLのレスポンスを既定のキャッシュから削除する関数
+    200で返ったページから必要な内容を抽出できなかった場合に呼び、再試行時に同じレスポンスを返さないようにする
+    """
+    get_default_cache().invalidate(url)
+
+
+def fetch_all(urls, ttl=None, use_cache=True, **kwargs):
+    """
+    複数のURLを並行に取得する同期関数
+
+    Parameters:
+    ----------
+    urls : list
+        取得対象URLのリスト
+    ttl : float
+        キャッシュを再検証せずに返す期間(秒)
+    use_cache : bool
+        Trueの場合、http_cacheの既定のキャッシュを利用する
+    **kwargs :
+        AsyncFetcherに渡す設定値
+
+    Returns:
+    ----------
+    results : dict
+        URLをkey、FetchResult (取得失敗時はNone) をvalueとする辞書
+    """
+
+    if use_cache:
+        kwargs.setdefault("cache", get_default_cache())
+
+    async def _run():
+        async with AsyncFetcher(**kwargs) as fetcher:
+            return await fetcher.fetch_all(list(urls), ttl)
+
+    return asyncio.run(_run())
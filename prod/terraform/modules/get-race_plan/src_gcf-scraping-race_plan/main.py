@@ -1,21 +1,17 @@
-import ast
+import asyncio
 import dataclasses
 import datetime
 import logging
 import os
 import re
-import ssl
-import subprocess
-import time
-import urllib.request
-from urllib.request import urlopen
-
-import certifi
-import pandas as pd
+
 import pytz
 from bs4 import BeautifulSoup
 from google.cloud import scheduler_v1 as schdlr
-from tqdm import tqdm
+
+import kaisai_calendar
+import scraper
+from fetcher import fetch_all
 
 # from dotenv import load_dotenv
 
@@ -28,6 +24,8 @@ PROJECT_ID = os.environ.get("PROJECT_ID")
 LOCATION_ID = os.environ.get("LOCATION_ID")
 PUBSUB_TARGET = os.environ.get("PUBSUB_TARGET")
 MODEL_RUN_OFFSET = int(os.environ.get("MODEL_RUN_OFFSET"))
+# 発走時刻がこの時間幅(分)に収まるレースは、1つのジョブでまとめて予測する
+PREDICTION_BATCH_WINDOW = int(os.environ.get("PREDICTION_BATCH_WINDOW", 0))
 
 # Create a client
 try:
@@ -44,99 +42,149 @@ class UrlPaths:
     CALENDAR_URL: str = TOP_URL + "calendar.html"
     # レース一覧ページ
     RACE_LIST_URL: str = TOP_URL + "race_list.html"
-
-
-# 関数を定義して文字列をリストに変換
-def ensure_list(input_data):
-    try:
-        if isinstance(input_data, str):
-            return ast.literal_eval(input_data)
-        elif isinstance(input_data, list):
-            return input_data
-        else:
-            raise TypeError("入力データは文字列またはリストである必要があります。")
-    except (ValueError, SyntaxError) as e:
-        logger.error(f"Failed to convert input to list: {e}")
-        raise ValueError("入力された文字列がリスト形式ではありません。")
+    # レース一覧ページがJSで読み込むレース一覧部分のHTML
+    RACE_LIST_SUB_URL: str = TOP_URL + "race_list_sub.html"
 
 
 def get_kaisai_date(from_: str, to_: str):
     """
     yyyy-mm-ddの形式でfrom_とto_を指定すると、間の開催日程一覧が返ってくる関数。
+    確定した月の開催日はkaisai_calendarのキャッシュから返す。
+    取得に失敗した月はログを出力して除外する。
     """
     try:
-        # 日付範囲を生成
-        date_range = pd.date_range(start=from_, end=to_, freq="D")
-        kaisai_date_list = []
-        seen_year_month = set()
-
-        for date in tqdm(date_range, total=len(date_range)):
-            year_month = (date.year, date.month)
-            if year_month not in seen_year_month:
-                seen_year_month.add(year_month)
-                query = [
-                    "year=" + str(date.year),
-                    "month=" + str(date.month),
-                ]
-                url = UrlPaths.CALENDAR_URL + "?" + "&".join(query)
-                ctx = ssl.create_default_context(cafile=certifi.where())
-                try:
-                    with urllib.request.urlopen(url, context=ctx) as response:
-                        html = response.read()
-                    time.sleep(1)
-                    soup = BeautifulSoup(html, "html.parser")
-                    a_list = soup.find("table", class_="Calendar_Table").find_all("a")
-                    for a in a_list:
-                        kaisai_date = re.findall(r"(?<=kaisai_date=)\d+", a["href"])[0]
-                        kaisai_date_list.append(kaisai_date)
-                except urllib.error.URLError as e:
-                    logger.error(f"Failed to fetch URL {url}: {e}")
-                except AttributeError as e:
-                    logger.error(f"Failed to parse HTML from {url}: {e}")
-
-        # 取得した開催日をフィルタリングして指定範囲に含まれる日付のみを返す
-        from_date = from_.replace("-", "")
-        to_date = to_.replace("-", "")
-        kaisai_date_list = [d for d in kaisai_date_list if from_date <= d <= to_date]
-
-        return kaisai_date_list
+        return kaisai_calendar.get_kaisai_date(from_, to_, raise_on_error=False)
     except Exception as e:
         logger.error(f"Unexpected error in get_kaisai_date: {e}")
         raise
 
 
+def get_race_id_list_http(kaisai_date_list):
+    """
+    レース一覧をブラウザを使わずHTTPのみで取得する関数。
+    取得・パースに失敗した開催日、またはレースが1件も見つからなかった開催日は
+    ブラウザで取得し直すため、fallback_date_listとして返す。
+    """
+    urls = {
+        kaisai_date: UrlPaths.RACE_LIST_SUB_URL + "?" + "kaisai_date=" + str(kaisai_date)
+        for kaisai_date in kaisai_date_list
+    }
+    # レース一覧は出走取消等で更新されるため、キャッシュは利用しない
+    responses = fetch_all(urls.values(), use_cache=False)
+
+    race_info_list = []
+    fallback_date_list = []
+    for kaisai_date, url in urls.items():
+        response = responses[url]
+        if response is None or response.status != 200:
+            logger.warning(f"Failed to fetch URL {url}")
+            fallback_date_list.append(kaisai_date)
+            continue
+        soup = BeautifulSoup(response.content, "html.parser")
+        # scraper.pyのpage.evaluateと同じセレクタで抽出する
+        a_list = soup.select('.RaceList_DataItem a[href*="shutuba.html"]')
+        if not a_list:
+            logger.warning(f"No races found in {url}")
+            fallback_date_list.append(kaisai_date)
+            continue
+        for a in a_list:
+            race_id = re.findall(r"race_id=(\d+)", a["href"])
+            race_time = a.select_one(".RaceList_Itemtime")
+            race_info_list.append(
+                {
+                    "race_id": race_id[0] if race_id else None,
+                    "race_date": kaisai_date,
+                    "race_time": race_time.get_text().strip() if race_time else None,
+                }
+            )
+
+    return race_info_list, fallback_date_list
+
+
 def get_race_id_list(kaisai_date_list):
+    # HTTPのみで取得し、取得できなかった開催日のみブラウザで取得する
+    race_info_list, fallback_date_list = get_race_id_list_http(kaisai_date_list)
+    if kaisai_date_list:
+        logger.info(
+            f"Browser fallback rate: {len(fallback_date_list)}/{len(kaisai_date_list)} "
+            f"({len(fallback_date_list) / len(kaisai_date_list):.1%})"
+        )
+    if fallback_date_list:
+        race_info_list += get_race_id_list_browser(fallback_date_list)
+
+    logger.info(f"Total number of race_ids: {len(race_info_list)}")
+    logger.info(f"race_id_list: {race_info_list}")
+    return race_info_list
+
+
+def get_race_id_list_browser(kaisai_date_list):
     try:
-        # ウェブスクレイピング実行
-        command = [
-            "python",
-            "scraper.py",
-            str(kaisai_date_list),
-            UrlPaths.RACE_LIST_URL,
-        ]
-        result = subprocess.run(command, capture_output=True, text=True)
-
-        # スクレイピング結果からrace_id_listを抽出
-        lines = result.stdout.splitlines()
-        logger.info("\n".join(lines[:-1]))
-        logger.error(result.stderr)
-
-        race_info_list = ensure_list(lines[-1])
-        logger.info(f"Total number of race_ids: {len(race_info_list)}")
-        logger.info(f"race_id_list: {race_info_list}")
-
-        return race_info_list
-
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Subprocess failed: {e}")
-        raise
+        # ウェブスクレイピング実行 (別プロセスを起動せず、同じプロセス内で実行する)
+        race_info_list = asyncio.run(
+            scraper.scrape_race_info_list(kaisai_date_list, UrlPaths.RACE_LIST_URL)
+        )
+        return [dataclasses.asdict(race_info) for race_info in race_info_list]
+
     except Exception as e:
-        logger.error(f"Unexpected error in get_race_id_list: {e}")
+        logger.error(f"Unexpected error in get_race_id_list_browser: {e}")
         raise
 
 
-def create_schdlr_job(race_id, race_date, race_time):
+def parse_race_datetime(race_info):
+    """
+    レース情報の開催日・発走時刻を日時に変換する関数。
+    レースID・発走時刻が取得できていない、または形式が正しくない場合はNoneを返す。
+    """
+    if not race_info.get("race_id") or not race_info.get("race_time"):
+        return None
+    try:
+        return datetime.datetime.strptime(
+            f"{race_info['race_date']} {race_info['race_time']}", "%Y%m%d %H:%M"
+        )
+    except (TypeError, ValueError):
+        return None
+
+
+def group_races(race_info_list, window_minutes=PREDICTION_BATCH_WINDOW):
+    """
+    開催日ごとに、先頭レースの発走時刻からwindow_minutes分以内に発走するレースを1グループにまとめる関数。
+    各グループは先頭(最も発走時刻が早い)レースの発走時刻を基準にジョブを作成する。
+    レースID・発走時刻が取得できていないレースはログを出力して除外する。
+    """
+    valid_races = []
+    for race_info in race_info_list:
+        race_datetime = parse_race_datetime(race_info)
+        if race_datetime is None:
+            logger.error(f"Skipped a race with missing or malformed race_id/race_time: {race_info}")
+            continue
+        valid_races.append((race_datetime, race_info))
+
+    race_groups = []
+    for race_datetime, race_info in sorted(
+        valid_races, key=lambda r: (r[1]["race_date"], r[0], r[1]["race_id"])
+    ):
+        if (
+            race_groups
+            and race_groups[-1]["race_date"] == race_info["race_date"]
+            and race_datetime - race_groups[-1]["race_datetime"]
+            <= datetime.timedelta(minutes=window_minutes)
+        ):
+            race_groups[-1]["race_id_list"].append(race_info["race_id"])
+        else:
+            race_groups.append(
+                {
+                    "race_id_list": [race_info["race_id"]],
+                    "race_date": race_info["race_date"],
+                    "race_time": race_info["race_time"],
+                    "race_datetime": race_datetime,
+                }
+            )
+    return race_groups
+
+
+def create_schdlr_job(race_id_list, race_date, race_time):
     try:
+        race_id = race_id_list[0]
         # 出走時刻n分前をcron形式で取得
         race_datetime_obj = datetime.datetime.strptime(race_date, "%Y%m%d")
         race_time_obj = datetime.datetime.strptime(race_time, "%H:%M").time()
@@ -153,12 +201,12 @@ def create_schdlr_job(race_id, race_date, race_time):
         )
         job = schdlr.Job(
             name=scheduler_job_id,
-            description=f"競馬予測モデル実行（レース日時: {race_datetime}）",
+            description=f"競馬予測モデル実行（レース日時: {race_datetime}, レース数: {len(race_id_list)}）",
             pubsub_target=schdlr.types.PubsubTarget(
                 topic_name=f"projects/{PROJECT_ID}/topics/{PUBSUB_TARGET}",
                 attributes={
                     "scheduler_job_id": scheduler_job_id,
-                    "race_id": race_id,
+                    "race_ids": ",".join(race_id_list),
                     "race_date": race_datetime.strftime("%Y-%m-%d"),
                 },
             ),
@@ -177,7 +225,7 @@ def create_schdlr_job(race_id, race_date, race_time):
         )
     except Exception as e:
         logger.error(
-            f"Creation of scheduled job failed. (race_id: {race_id}, race_time: {race_datetime})"
+            f"Creation of scheduled job failed. (race_ids: {race_id_list}, race_time: {race_time})"
         )
         logger.error(f"Error: {e}")
 
@@ -199,12 +247,18 @@ def main(event, context):
         kaisai_date_list = get_kaisai_date(today_str, six_days_later_str)
         race_info_list = get_race_id_list(kaisai_date_list)
 
-        # race_idごとにLGBM予測実行用のCloud Schedulerジョブ登録
-        for race_info in race_info_list:
-            race_id = race_info["race_id"]
-            race_date = race_info["race_date"]
-            race_time = race_info["race_time"]
-            create_schdlr_job(race_id, race_date, race_time)
+        # 発走時刻の近いレースをまとめ、グループごとにLGBM予測実行用のCloud Schedulerジョブ登録
+        race_groups = group_races(race_info_list)
+        logger.info(
+            f"{len(race_info_list)} races were grouped into {len(race_groups)} prediction jobs."
+        )
+        # ジョブの作成に失敗したグループはcreate_schdlr_job内でログを出力し、他のグループの作成を続ける
+        for race_group in race_groups:
+            create_schdlr_job(
+                race_group["race_id_list"],
+                race_group["race_date"],
+                race_group["race_time"],
+            )
 
         logger.info("Function execution finished.")
     except Exception as e:
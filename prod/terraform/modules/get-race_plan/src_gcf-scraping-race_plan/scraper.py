@@ -1,22 +1,119 @@
+"""
+レース一覧ページ(ブラウザ)からのレース情報(レースID・開催日・発走時刻)の取得
+
+main.pyからはscrape_race_info_listをimportして同じプロセス内で実行する
+別プロセスで実行する場合は、結果をrecord_streamの形式で標準出力に書き出す
+
+usage:
+    python scraper.py <kaisai_date_list> <RACE_LIST_URL> [json|arrow]
+"""
+
 import ast
 import asyncio
+import dataclasses
 import logging
+import os
 import sys
+from typing import Optional
 
 from pyppeteer import launch
 
+from record_stream import write_records
+
 logger = logging.getLogger(__name__)
-logging.basicConfig(
-    level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s"
-)
 
+# 1つのブラウザで同時に開くタブの数
+SCRAPER_MAX_TABS = int(os.environ.get("SCRAPER_MAX_TABS", 4))
+# 1ページ(タブを開いてからレース一覧を抽出するまで)あたりの制限時間(秒)
+SCRAPER_PAGE_TIMEOUT = float(os.environ.get("SCRAPER_PAGE_TIMEOUT", 60))
+# レース一覧の抽出に不要なため読み込まないリソースの種類
+BLOCKED_RESOURCE_TYPES = {"image", "media", "font", "stylesheet"}
+
+
+@dataclasses.dataclass(frozen=True)
+class RaceInfo:
+    race_id: Optional[str]
+    race_date: str
+    race_time: Optional[str]
 
-async def scraping_race_info(kaisai_date_list, RACE_LIST_URL):
+
+async def _intercept(request):
+    if request.resourceType in BLOCKED_RESOURCE_TYPES:
+        await request.abort()
+    else:
+        await request.continue_()
+
+
+async def _scrape_race_list(browser, url, kaisai_date):
+    logger.info(f"scraping: {url}")
+
+    page = await browser.newPage()
+    try:
+        await page.setRequestInterception(True)
+        page.on("request", lambda request: asyncio.ensure_future(_intercept(request)))
+
+        timeout_ms = int(SCRAPER_PAGE_TIMEOUT * 1000)
+        await page.goto(url, {"timeout": timeout_ms, "waitUntil": "domcontentloaded"})
+        await page.waitForSelector(".RaceList_Box", {"visible": True, "timeout": timeout_ms})
+
+        race_data_list = await page.evaluate(
+            """() => {
+            const raceItems = document.querySelectorAll('.RaceList_DataItem a[href*="shutuba.html"]');
+            const data = [];
+            raceItems.forEach(aTag => {
+                const raceIdMatch = aTag.href.match(/race_id=(\\d+)/);
+                const raceId = raceIdMatch ? raceIdMatch[1] : null;
+                const raceTimeElement = aTag.querySelector('.RaceList_Itemtime');
+                const raceTime = raceTimeElement ? raceTimeElement.textContent.trim() : null;
+                data.push({ raceId, raceTime });
+            });
+            return data;
+        }"""
+        )
+        return [
+            RaceInfo(
+                race_id=race_data["raceId"],
+                race_date=kaisai_date,
+                race_time=race_data["raceTime"],
+            )
+            for race_data in race_data_list
+        ]
+    finally:
+        # ページを閉じる
+        await page.close()
+
+
+async def _scrape_race_list_bounded(browser, semaphore, kaisai_date, RACE_LIST_URL):
+    """同時に開くタブの数と1ページあたりの制限時間の範囲で、1開催日のレース一覧を取得する"""
+    query = ["kaisai_date=" + str(kaisai_date)]
+    url = RACE_LIST_URL + "?" + "&".join(query)
+    async with semaphore:
+        try:
+            return await asyncio.wait_for(
+                _scrape_race_list(browser, url, kaisai_date),
+                SCRAPER_PAGE_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            logger.error(f"Timeout error while scraping {url}")
+        except Exception as e:
+            logger.error(f"Error while scraping {url}: {str(e)}")
+    return []
+
+
+async def scrape_race_info_list(kaisai_date_list, RACE_LIST_URL) -> list[RaceInfo]:
+    """
+    開催日ごとのレース一覧ページから、レース情報を開催日の順に取得する関数
+    取得に失敗した開催日はログを出力して除外する
+    """
     browser = None
     try:
         # ブラウザ起動
         browser = await launch(
             headless=True,
+            # Cloud Functionsのワーカースレッドからの起動ではシグナルハンドラを登録できない
+            handleSIGINT=False,
+            handleSIGTERM=False,
+            handleSIGHUP=False,
             args=[
                 # '--user-agent=Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/116.0.0.0 Safari/537.36',
                 # "--start-maximized",
@@ -24,59 +121,19 @@ async def scraping_race_info(kaisai_date_list, RACE_LIST_URL):
         )
         logger.info("Launched browser.")
 
-        race_info_list = []
-        for kaisai_date in kaisai_date_list:
-            page = None
-            try:
-                query = ["kaisai_date=" + str(kaisai_date)]
-                url = RACE_LIST_URL + "?" + "&".join(query)
-                print(f"scraping: {url}")
-
-                page = await browser.newPage()
-                await page.goto(url, {"timeout": 180000})
-                await page.waitForSelector(".RaceList_Box", {"visible": True})
-
-                race_data_list = await page.evaluate(
-                    """() => {
-                    const raceItems = document.querySelectorAll('.RaceList_DataItem a[href*="shutuba.html"]');
-                    const data = [];
-                    raceItems.forEach(aTag => {
-                        const raceIdMatch = aTag.href.match(/race_id=(\d+)/);
-                        const raceId = raceIdMatch ? raceIdMatch[1] : null;
-                        const raceTimeElement = aTag.querySelector('.RaceList_Itemtime');
-                        const raceTime = raceTimeElement ? raceTimeElement.textContent.trim() : null;
-                        data.push({ raceId, raceTime });
-                    });
-                    return data;
-                }"""
-                )
-
-                for race_data in race_data_list:
-                    race_info_list.append(
-                        {
-                            "race_id": race_data["raceId"],
-                            "race_date": kaisai_date,
-                            "race_time": race_data["raceTime"],
-                        }
-                    )
-            except asyncio.TimeoutError:
-                logger.error(f"Timeout error while scraping {url}")
-            except Exception as e:
-                logger.error(f"Error while scraping {url}: {str(e)}")
-            finally:
-                # ページを閉じる
-                if "page" in locals():  # pageが定義されている場合のみcloseする
-                    await page.close()
-
-        await browser.close()
+        # 開催日ごとのページを最大SCRAPER_MAX_TABSタブで並行に取得する (結果は開催日の順)
+        semaphore = asyncio.Semaphore(SCRAPER_MAX_TABS)
+        results = await asyncio.gather(
+            *[
+                _scrape_race_list_bounded(browser, semaphore, kaisai_date, RACE_LIST_URL)
+                for kaisai_date in kaisai_date_list
+            ]
+        )
         logger.info("Race information scraping completed.")
-
-        # race_idリスト出力
-        print(race_info_list)
-        return
+        return [race_info for result in results for race_info in result]
 
     except Exception as e:
-        logger.error(f"Unexpected error in scraping_race_info: {str(e)}")
+        logger.error(f"Unexpected error in scrape_race_info_list: {str(e)}")
         return []
     finally:
         if browser:
@@ -85,13 +142,19 @@ async def scraping_race_info(kaisai_date_list, RACE_LIST_URL):
 
 
 if __name__ == "__main__":
+    # ロギングの設定 (標準出力はレコードのストリームに使うため、ログは標準エラー出力に出す)
+    logging.basicConfig(
+        level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
     try:
         # コマンドライン引数から変数を取得
         kaisai_date_list = ast.literal_eval(sys.argv[1])
         RACE_LIST_URL = sys.argv[2]
+        stream_format = sys.argv[3] if len(sys.argv) > 3 else "json"
         logger.info(f"RACE_LIST_URL: {RACE_LIST_URL}")
 
-        asyncio.run(scraping_race_info(kaisai_date_list, RACE_LIST_URL))
+        race_info_list = asyncio.run(scrape_race_info_list(kaisai_date_list, RACE_LIST_URL))
+        write_records(sys.stdout.buffer, race_info_list, stream_format)
 
     except IndexError:
         logger.error("Not enough command line arguments provided.")
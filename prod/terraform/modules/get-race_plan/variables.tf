@@ -13,3 +13,6 @@ variable "gcf_source_bucket" {
 variable "notification_channel_id" {
   type = string
 }
+variable "calendar_cache_bucket" {
+  type = string
+}
@@ -51,7 +51,7 @@ data "archive_file" "src_gcf-race_prediction" {
   type        = "zip"
   source_dir  = "./modules/get-race_prediction/src_gcf-race_prediction"
   output_path = "./modules/tmp/src_gcf-race_prediction.zip"
-  excludes    = []
+  excludes    = ["bench_scraper.py"]
 }
 ### GCFソースコードUpload https://registry.terraform.io/providers/hashicorp/google/latest/docs/resources/storage_bucket_object
 resource "google_storage_bucket_object" "src_gcf-race_prediction" {
@@ -91,9 +91,11 @@ resource "google_cloudfunctions_function" "functions-race_prediction" {
     PROJECT_ID        = var.project_id
     MODEL_BUCKET      = google_storage_bucket.model_registry-prod.name
     MODEL_NAME_PREFIX = "lgb_model_"
+    ENCODER_NAME      = "ordinal_encoder.pkl"
     DOWNLOAD_FOLDER   = "/tmp"
     BQ_DATASET        = google_bigquery_dataset.race_prediction_raw_prod.dataset_id
     SLACK_CHANNEL_ID  = "C07J5JY17U6"
+    FEATURE_STORE_URI = "gs://${google_storage_bucket.model_registry-prod.name}/feature_store"
   }
   secret_environment_variables {
     key        = "SLACK_BOT_TOKEN"
@@ -0,0 +1,106 @@
+"""
+出走表の抽出処理について、従来のセル単位のpage.evaluateと1回のpage.evaluateによる抽出を比較する
+CDPセッションのsendをラップし、レースごとのCDP呼び出し回数と抽出時間を計測する
+
+usage:
+    python bench_scraper.py <race_id> [<race_id> ...]
+"""
+
+import re
+import sys
+import time
+
+from browser_pool import BrowserPool, run
+from scraper import extract_race_card, parse_race_info
+
+RACE_CARD_URL = 'https://race.netkeiba.com/race/shutuba.html'
+
+
+async def legacy_extract_horse_jockey_trainer_data(page):
+    rows = await page.querySelectorAll('.HorseList')
+    data = []
+
+    for row in rows:
+        columns = await row.querySelectorAll('td')
+        row_data = []
+
+        for column in columns:
+            class_name = await page.evaluate('(element) => element.getAttribute("class")', column)
+            if class_name in ['HorseInfo']:
+                href = await column.querySelectorEval('a', '(element) => element.getAttribute("href")')
+                row_data.append(re.findall(r'horse/(\d*)', href)[0])
+            elif class_name in ['Jockey']:
+                href = await column.querySelectorEval('a', '(element) => element.getAttribute("href")')
+                row_data.append(re.findall(r'jockey/result/recent/(\w*)', href)[0])
+            elif class_name in ['Trainer']:
+                href = await column.querySelectorEval('a', '(element) => element.getAttribute("href")')
+                row_data.append(re.findall(r'trainer/result/recent/(\w*)', href)[0])
+            row_data.append(await page.evaluate('(element) => element.textContent', column))
+        data.append(row_data)
+    return data
+
+
+async def legacy_extract_race_card(page):
+    data = await legacy_extract_horse_jockey_trainer_data(page)
+    race_data = await page.querySelector('.RaceList_Item02')
+    race_text = await page.evaluate('(element) => element.textContent', race_data)
+    race_info, race_title, hurdle_race_flg = parse_race_info(race_text)
+    return data, race_info, race_title, hurdle_race_flg
+
+
+class CDPCallCounter:
+    """ページのCDPセッションのsendをラップして呼び出し回数を数える"""
+
+    def __init__(self, page):
+        self.client = page._client
+        self.count = 0
+        self._send = self.client.send
+
+    def __enter__(self):
+        def send(method, params=None):
+            self.count += 1
+            return self._send(method, params)
+
+        # ElementHandleも同じCDPSessionを共有しているため、インスタンス属性の差し替えで全呼び出しを数えられる
+        self.client.send = send
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        del self.client.send
+
+
+async def measure(page, extract):
+    with CDPCallCounter(page) as counter:
+        start = time.perf_counter()
+        result = await extract(page)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+    return result, counter.count, elapsed_ms
+
+
+async def bench(browser_pool, race_id):
+    url = f'{RACE_CARD_URL}?race_id={race_id}'
+    async with browser_pool.page() as page:
+        await page.goto(url, {'timeout': 180000})
+        await page.waitForSelector('.HorseList', {'visible': True})
+
+        legacy, legacy_calls, legacy_ms = await measure(page, legacy_extract_race_card)
+        new, new_calls, new_ms = await measure(page, extract_race_card)
+
+    # 抽出結果が従来と一致することを確認
+    assert legacy == new, f'extraction mismatch: {race_id}'
+    print(f'race_id: {race_id} (horses: {len(new[0])})')
+    print(f'  legacy (per-cell evaluate) {legacy_calls:6d} CDP calls {legacy_ms:10.1f} ms')
+    print(f'  single evaluate            {new_calls:6d} CDP calls {new_ms:10.1f} ms')
+
+
+def main(race_id_list):
+    browser_pool = BrowserPool(max_pages=1)
+    try:
+        for race_id in race_id_list:
+            run(bench(browser_pool, race_id))
+    finally:
+        run(browser_pool.close())
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,105 @@
+import asyncio
+import contextlib
+
+from pyppeteer import launch
+
+# 関数インスタンス内で共有するイベントループ
+# pyppeteerのBrowserは作成したイベントループに紐づくため、
+# 起動ごとにasyncio.run()で新しいループを作るとウォームインスタンスでブラウザを再利用できない
+_loop = asyncio.new_event_loop()
+
+
+def run(coro):
+    """インスタンス共有のイベントループ上でコルーチンを実行する"""
+    return _loop.run_until_complete(coro)
+
+
+class BrowserPool:
+    """
+    ヘッドレスブラウザを1つ起動したまま保持し、ページを貸し出すクラス
+    ウォームインスタンスでは関数の起動をまたいでブラウザを再利用し、Chromiumの起動時間を省く
+
+    Parameters:
+    ----------
+    max_pages : int
+        同時に開くページ数の上限
+    max_uses : int
+        ブラウザを再起動するまでに貸し出すページ数 (メモリリーク対策)
+    health_check_timeout : float
+        ヘルスチェックのタイムアウト(秒)
+    """
+
+    def __init__(self, max_pages=4, max_uses=100, health_check_timeout=5):
+        self.max_pages = max_pages
+        self.max_uses = max_uses
+        self.health_check_timeout = health_check_timeout
+        self._browser = None
+        self._uses = 0
+        self._active_pages = 0
+        self._semaphore = None
+        self._lock = None
+
+    async def _launch(self):
+        self._browser = await launch(
+            headless=True,
+            # Cloud Functionsのワーカースレッドからの起動ではシグナルハンドラを登録できない
+            handleSIGINT=False,
+            handleSIGTERM=False,
+            handleSIGHUP=False,
+            args=[
+                # '--user-agent=Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/116.0.0.0 Safari/537.36',
+                # "--start-maximized",
+            ],
+        )
+        self._uses = 0
+        print('Launched browser.')
+
+    async def _is_healthy(self):
+        if self._browser is None or self._browser.process.poll() is not None:
+            return False
+        try:
+            await asyncio.wait_for(self._browser.version(), self.health_check_timeout)
+            return True
+        except Exception as e:
+            print(f'Browser health check failed: {e}')
+            return False
+
+    async def _ensure_browser(self):
+        async with self._lock:
+            recycle = self._uses >= self.max_uses and self._active_pages == 0
+            if recycle or not await self._is_healthy():
+                await self._close_browser()
+                await self._launch()
+            return self._browser
+
+    async def _close_browser(self):
+        if self._browser is not None:
+            try:
+                await self._browser.close()
+                print('Closed browser.')
+            except Exception as e:
+                print(f'Failed to close browser: {e}')
+            self._browser = None
+
+    @contextlib.asynccontextmanager
+    async def page(self):
+        """ブラウザのページを貸し出す。ブロックを抜けるとページは閉じられる"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_pages)
+            self._lock = asyncio.Lock()
+        async with self._semaphore:
+            browser = await self._ensure_browser()
+            page = await browser.newPage()
+            self._active_pages += 1
+            try:
+                yield page
+            finally:
+                self._active_pages -= 1
+                self._uses += 1
+                try:
+                    await page.close()
+                except Exception as e:
+                    print(f'Failed to close page: {e}')
+
+    async def close(self):
+        await self._close_browser()
@@ -0,0 +1,93 @@
+import io
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from feature_store import MISSING_ODDS, get_race_grade
+
+# 学習時に使用していない値の出走表上の表記を、学習データ(db.netkeiba.comのレース結果)の表記に揃える
+SERVING_TO_TRAINING_VALUES = {
+    'race_type': {'ダート': 'ダ', '障害': '障'},
+    # 障害レースはscraping_race_cardでrace_turnを'障害'としている (学習データでは'芝')
+    'race_turn': {'直線': '直', '障害': '芝'},
+}
+
+
+class FeatureEncoder:
+    """
+    学習時に保存したOrdinalEncoder(ordinal_encoder.pkl)のカテゴリを辞書に展開し、推論時のエンコードを行うクラス
+    sklearnのtransformと同じコード(未知の値は-1)を、列ごとの辞書引きで返す
+
+    Parameters:
+    ----------
+    categories : dict
+        列名をkey、学習時のカテゴリ(エンコード後の値の順)のリストをvalueとする辞書
+    unknown_value : float
+        学習時に存在しなかった値に割り当てるコード
+    """
+
+    def __init__(self, categories, unknown_value=-1):
+        self.columns = list(categories)
+        self.unknown_value = unknown_value
+        self.lookups = {
+            column: {category: float(code) for code, category in enumerate(values)}
+            for column, values in categories.items()
+        }
+
+    @classmethod
+    def from_ordinal_encoder(cls, ordinal_encoder):
+        categories = {
+            column: list(values)
+            for column, values in zip(ordinal_encoder.feature_names_in_, ordinal_encoder.categories_)
+        }
+        return cls(categories, ordinal_encoder.unknown_value)
+
+    @classmethod
+    def from_bytes(cls, content):
+        return cls.from_ordinal_encoder(joblib.load(io.BytesIO(content)))
+
+    def transform(self, df):
+        df = df.copy()
+        for column in self.columns:
+            values = df[column].replace(SERVING_TO_TRAINING_VALUES.get(column, {})).astype(str)
+            df[column] = values.map(self.lookups[column]).fillna(self.unknown_value).astype(float)
+        return df
+
+
+def build_features(race_card_prep, feature_encoder, feature_names):
+    """
+    前処理済みの出走表から、学習時と同じ列名・列順・エンコードの特徴量を作成する
+    (ノートブック 04_新規データでの予測 のpreprocess_race_dataと同じ処理)
+
+    Parameters:
+    ----------
+    race_card_prep : pandas.DataFrame
+        preprocess_race_resultsで前処理した出走表
+    feature_encoder : FeatureEncoder
+        学習時のOrdinalEncoderから作成したエンコーダ
+    feature_names : list
+        予測モデルの特徴量名 (lgb.Booster.feature_name())
+
+    Returns:
+    ----------
+    features : pandas.DataFrame
+    """
+    df = race_card_prep.rename(columns={'course_length': 'course_len'})
+
+    # レースの出走頭数・レースグレード (複数レースをまとめて予測する場合もレースごとに集計)
+    df['horse_count'] = df.groupby('race_id')['race_id'].transform('size')
+    df['race_grade'] = get_race_grade(df['race_title'])
+
+    # オッズ未発表の馬
+    df['odds'] = pd.to_numeric(df['odds'], errors='coerce').fillna(MISSING_ODDS)
+
+    # 数値列は数値型に揃える (IDに英字が含まれる場合などはNaN)
+    numeric_columns = [c for c in feature_names if c in df.columns and c not in feature_encoder.columns]
+    df[numeric_columns] = df[numeric_columns].apply(pd.to_numeric, errors='coerce')
+
+    df = feature_encoder.transform(df)
+    missing_columns = [c for c in feature_names if c not in df.columns]
+    if missing_columns:
+        raise KeyError(f'Features are missing: {missing_columns}')
+    return df[feature_names].astype(np.float64)
@@ -0,0 +1,718 @@
+"""
+特徴量ストア
+
+BigQueryの生データテーブル(raw_race_results / raw_horse_results / raw_speed_results)から特徴量を計算し、
+開催日ごとに分割したParquet(event_date=yyyy-mm-dd/part-0.parquet)として保存する
+- 出走馬ごとの特徴量 (ノートブック 02_データの前処理 と同じ処理をベクトル化したもの)
+- 馬・騎手の過去成績の特徴量 (その開催日より前のレースのみから計算する)
+- 馬・騎手・調教師の直近の成績(フォーム)の特徴量 (form_index.FormIndexで直近window件を集計する)
+materializeは保存済みの最終開催日(watermark)より後の開催日のみを計算し、
+馬・騎手ごとの累積成績・FormIndex(_state)を更新する
+watermark以前の馬の成績が後から取り込まれた場合(初出走馬の過去の戦績・遅れて取得した馬の成績)は、
+その馬の累積成績を作り直し、保存済みの開催日の馬の特徴量も更新する
+materializeは 02_データの前処理 の最後のセル、または下記のコマンドで実行する
+学習(03_モデルの学習)はloadで学習データに結合し、予測サービス(race_prediction)は
+モデルの特徴量にHISTORY_FEATURESが含まれる場合のみlookupで同じ特徴量を参照する
+予測サービスには同じ内容のファイルを src_gcf-race_prediction/feature_store.py として配置している
+
+usage:
+    python feature_store.py <store_uri> <project.dataset> [to_date]
+"""
+
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+from form_index import FormIndex
+
+# race_titleから判定するレースグレード (ノートブック 02_データの前処理 と同じ定義)
+GRADE_LIST = ['新馬', '未勝利', '1勝', '2勝', '3勝', 'OP', 'L', 'GI', 'GII', 'GIII', 'JGI', 'JGII', 'JGIII', 'オープン']
+
+# オッズ未発表('---')の馬・取消/除外/中止の馬の着順に割り当てる値
+MISSING_ODDS = 999
+MISSING_FINISH_POSITION = 999
+
+# 出走頭数に含めない着順 (取消・除外)
+NOT_STARTED = ['取', '除']
+
+# 学習時に利用しない列 (horse_id・jockey_idと同じ情報、予測時には分からない情報)
+DROP_COLUMNS = ['horse_name', 'jockey', 'time', 'difference']
+
+HORSE_HISTORY_FEATURES = [
+    'horse_race_count', 'horse_top3_rate', 'horse_mean_finish',
+    'horse_last_finish', 'horse_days_since_last', 'horse_last_speed_index',
+]
+JOCKEY_HISTORY_FEATURES = ['jockey_ride_count', 'jockey_top3_rate']
+
+# 馬・騎手・調教師の直近window件の成績(フォーム)の集計 (集計項目 -> 特徴量名)
+FORM_WINDOWS = {'horse': 5, 'jockey': 100, 'trainer': 100}
+FORM_STATS = {
+    'horse': {
+        'finish': 'horse_form_finish', 'top3': 'horse_form_top3_rate',
+        'last_3f': 'horse_form_last_3f', 'time_index': 'horse_form_time_index',
+    },
+    'jockey': {'win': 'jockey_form_win_rate', 'top3': 'jockey_form_top3_rate'},
+    'trainer': {'win': 'trainer_form_win_rate', 'top3': 'trainer_form_top3_rate'},
+}
+FORM_FEATURES = ['horse_form_race_count'] + [feature for stats in FORM_STATS.values() for feature in stats.values()]
+
+HISTORY_FEATURES = HORSE_HISTORY_FEATURES + JOCKEY_HISTORY_FEATURES + FORM_FEATURES
+
+# 累積成績の列 (sum: 開催日ごとの増分を加算する列、last: 最新の値を引き継ぐ列)
+HORSE_SUM_COLUMNS = ['race_count', 'top3_count', 'finish_sum']
+HORSE_LAST_COLUMNS = ['last_finish', 'last_race_date', 'last_speed_index']
+JOCKEY_SUM_COLUMNS = ['race_count', 'top3_count']
+JOCKEY_LAST_COLUMNS = ['last_race_date']
+
+# 生データテーブルの取得クエリ (スピード指数は出走馬の行に結合する)
+RACE_RESULTS_QUERY = """
+SELECT r.*, s.spped_index AS speed_index
+FROM `{dataset}.raw_race_results` AS r
+LEFT JOIN `{dataset}.raw_speed_results` AS s
+  ON s.race_id = CAST(r.race_id AS STRING) AND s.uma_ban = r.horse_number
+WHERE r.event_date > @from_date AND r.event_date <= @to_date
+"""
+# 馬の成績はwatermarkより後の行に加え、直近(HORSE_RESULTS_LOOKBACK_DAYS日前以降)に出走した馬の全ての行を取得する
+# (取り込み済みの行はmaterializeで除外し、watermark以前の行が新たにあった馬の累積成績を作り直す)
+HORSE_RESULTS_QUERY = """
+SELECT horse_id, date, finish_position, last_3f, time_index
+FROM `{dataset}.raw_horse_results`
+WHERE date <= @to_date
+  AND (
+    date > @from_date
+    OR horse_id IN (
+      SELECT DISTINCT CAST(horse_id AS STRING)
+      FROM `{dataset}.raw_race_results`
+      WHERE event_date > DATE_SUB(@from_date, INTERVAL @lookback_days DAY) AND event_date <= @to_date
+    )
+  )
+"""
+HORSE_RESULTS_LOOKBACK_DAYS = 28
+
+# 後から取り込まれた成績で作り直す馬の特徴量 (スピード指数はraw_race_results側のため変わらない)
+HORSE_RESTATED_FEATURES = (
+    [feature for feature in HORSE_HISTORY_FEATURES if feature != 'horse_last_speed_index']
+    + ['horse_form_race_count'] + list(FORM_STATS['horse'].values())
+)
+
+
+def parse_finish_position(values, missing=MISSING_FINISH_POSITION):
+    """
+    着順を数値に変換する関数
+    降着('3(降)'など)は確定した着順とし、中止・除外・取消などの数値でない着順はmissingとする
+    """
+    values = pd.Series(values).astype(str).str.replace(r'(\d+)\(降\)', r'\1', regex=True)
+    return pd.to_numeric(values, errors='coerce').fillna(missing)
+
+
+def get_race_grade(race_titles):
+    """race_titleに含まれるレースグレードを判定する関数 (GRADE_LISTの先頭から最初に一致したもの)"""
+    race_titles = pd.Series(race_titles).astype(str)
+    conditions = [race_titles.str.contains(grade, regex=False) for grade in GRADE_LIST]
+    choices = ['障害オープン' if grade == 'オープン' else grade for grade in GRADE_LIST]
+    return pd.Series(np.select(conditions, choices, default=None), index=race_titles.index)
+
+
+def parse_entry_columns(df):
+    """
+    1つの列にまとめられている性齢・馬体重(増減)・調教師(東西)を分割し、開催日を年・月・日に分ける関数
+    学習データ(raw_race_results)と出走表の両方に利用する
+
+    Returns:
+    ----------
+    df : pandas.DataFrame
+        sex_age・trainerを除き、sex・age・horse_weight・weight_gain_loss・trainer_region・trainer_name・year・month・dayを追加したもの
+    """
+    df = df.copy()
+    sex_age = df['sex_age'].str.extract(r'([牝牡セ])(\d+)', expand=True)
+    df['sex'] = sex_age[0]
+    df['age'] = sex_age[1].astype(int)
+    weight = df['horse_weight'].str.extract(r'(\d{3}).([+-0]\d*)', expand=True)
+    df['horse_weight'] = weight[0].fillna(0).astype(int)
+    df['weight_gain_loss'] = weight[1].str.replace('+', '', regex=False).fillna(0).astype(int)
+    trainer = df['trainer'].str.extract(r'\[(.)\] (.+)', expand=True)
+    df['trainer_region'] = trainer[0]
+    df['trainer_name'] = trainer[1]
+    event_date = pd.to_datetime(df['event_date'])
+    df['year'] = event_date.dt.year
+    df['month'] = event_date.dt.month
+    df['day'] = event_date.dt.day
+    return df.drop(columns=['sex_age', 'trainer'])
+
+
+def derive_entry_features(race_results):
+    """
+    出走馬ごとの特徴量を作成する関数 (ノートブック 02_データの前処理 のエンコード前までと同じ処理)
+
+    Parameters:
+    ----------
+    race_results : pandas.DataFrame
+        raw_race_resultsの行
+
+    Returns:
+    ----------
+    df : pandas.DataFrame
+        event_date・race_id・horse_numberの順に並べたもの
+    """
+    df = parse_entry_columns(race_results)
+    df['event_date'] = pd.to_datetime(df['event_date'])
+
+    # 取消・除外になっている馬はレースに走っていないので出走頭数から外す
+    started = ~df['finish_position'].isin(NOT_STARTED)
+    df['horse_count'] = started.groupby(df['race_id']).transform('sum').astype(int)
+    df['race_grade'] = get_race_grade(df['race_title'])
+    df['odds'] = pd.to_numeric(df['odds'], errors='coerce').fillna(MISSING_ODDS)
+    df['finish_position'] = parse_finish_position(df['finish_position'])
+    df['target'] = (df['finish_position'] <= 3).astype(int)
+
+    df = df.drop(columns=[c for c in DROP_COLUMNS + ['speed_index'] if c in df.columns])
+    return df.sort_values(['event_date', 'race_id', 'horse_number'], kind='stable').reset_index(drop=True)
+
+
+def _to_key(values):
+    """ID列を文字列のキーに揃える (BigQueryのテーブルによってINTEGER・STRINGが異なるため)"""
+    values = pd.Series(values)
+    if pd.api.types.is_float_dtype(values):
+        values = values.astype('Int64')
+    return values.astype(str)
+
+
+def _horse_race_events(keys, dates, finish):
+    """馬ごと・開催日ごとの着順の増分 (finishは数値の着順。中止・取消などはNaN)"""
+    finish = np.asarray(finish, dtype=float)
+    races = pd.DataFrame({
+        'key': np.asarray(keys),
+        'date': np.asarray(dates, dtype='datetime64[ns]'),
+        'race_count': (~np.isnan(finish)).astype(int),
+        'top3_count': (finish <= 3).astype(int),
+        'finish_sum': np.nan_to_num(finish),
+        'last_finish': finish,
+    })
+    races['last_race_date'] = races['date']
+    return races
+
+
+def _horse_events(horse_results, race_results):
+    """馬ごと・開催日ごとの成績の増分 (着順はraw_horse_results、スピード指数はraw_speed_results)"""
+    races = _horse_race_events(
+        _to_key(horse_results['horse_id']).to_numpy(),
+        pd.to_datetime(horse_results['date']).to_numpy(),
+        parse_finish_position(horse_results['finish_position'], missing=np.nan).to_numpy(),
+    )
+    speed = race_results[race_results['speed_index'].notna()]
+    speeds = pd.DataFrame({
+        'key': _to_key(speed['horse_id']).to_numpy(),
+        'date': pd.to_datetime(speed['event_date']).to_numpy(),
+        'last_speed_index': pd.to_numeric(speed['speed_index'], errors='coerce').to_numpy(),
+    })
+    return pd.concat([races, speeds], ignore_index=True)
+
+
+def _jockey_events(race_results):
+    """騎手ごと・開催日ごとの騎乗成績の増分"""
+    finish = parse_finish_position(race_results['finish_position'], missing=np.nan).to_numpy()
+    events = pd.DataFrame({
+        'key': _to_key(race_results['jockey_id']).to_numpy(),
+        'date': pd.to_datetime(race_results['event_date']).to_numpy(),
+        'race_count': (~np.isnan(finish)).astype(int),
+        'top3_count': (finish <= 3).astype(int),
+    })
+    events['last_race_date'] = events['date']
+    return events
+
+
+def _trainer_names(df):
+    """
+    調教師のキー
+    出走表はtrainer_idを持つが、成績側のraw_race_resultsには調教師IDがないため、両方にある調教師名を利用する
+    """
+    if 'trainer_name' in df.columns:
+        return df['trainer_name']
+    return df['trainer'].str.extract(r'\[(.)\] (.+)', expand=True)[1]
+
+
+def _form_keys(df):
+    """FORM_STATSのキーごとの出走馬・成績のキー"""
+    return {
+        'horse': _to_key(df['horse_id']),
+        'jockey': _to_key(df['jockey_id']),
+        'trainer': _trainer_names(df),
+    }
+
+
+def _form_events(horse_results, race_results):
+    """FORM_STATSのキーごとの成績 (馬はraw_horse_results、騎手・調教師はraw_race_results)"""
+    horse_finish = parse_finish_position(horse_results['finish_position'], missing=np.nan).to_numpy()
+    race_finish = parse_finish_position(race_results['finish_position'], missing=np.nan).to_numpy()
+    race_keys = _form_keys(race_results)
+    events = {
+        'horse': pd.DataFrame({
+            'key': _to_key(horse_results['horse_id']).to_numpy(),
+            'date': horse_results['date'].to_numpy(),
+            'finish': horse_finish,
+            'top3': np.where(np.isnan(horse_finish), np.nan, horse_finish <= 3),
+            'last_3f': pd.to_numeric(horse_results['last_3f'], errors='coerce').to_numpy(),
+            'time_index': pd.to_numeric(horse_results['time_index'], errors='coerce').to_numpy(),
+        }),
+    }
+    for name in ['jockey', 'trainer']:
+        events[name] = pd.DataFrame({
+            'key': race_keys[name].to_numpy(),
+            'date': race_results['event_date'].to_numpy(),
+            'win': np.where(np.isnan(race_finish), np.nan, race_finish == 1),
+            'top3': np.where(np.isnan(race_finish), np.nan, race_finish <= 3),
+        })
+    return events
+
+
+def _form_features(entries, form_indexes, names=None):
+    """
+    出走馬ごとに、開催日より前の直近window件の成績の集計をFormIndexから参照する関数
+    namesを指定した場合はそのキー(FORM_STATSのキー)の特徴量のみを返す
+    """
+    keys = _form_keys(entries)
+    event_date = entries['event_date'].to_numpy()
+    features = {}
+    for name, stats in FORM_STATS.items():
+        if names is not None and name not in names:
+            continue
+        index = form_indexes[name]
+        count, means = index.lookup(keys[name].to_numpy(), event_date)
+        if name == 'horse':
+            features['horse_form_race_count'] = count
+        for stat, feature in stats.items():
+            features[feature] = means[:, index.stats.index(stat)]
+    return pd.DataFrame(features)[[feature for feature in FORM_FEATURES if feature in features]]
+
+
+def _running_totals(state, events, sum_columns, last_columns):
+    """
+    保存済みの累積成績に開催日ごとの増分を順に加え、キー・開催日ごとの(その日の終わり時点の)累積成績を返す関数
+    stateの行はその最終出走日の増分として扱うため、stateより後の開催日のイベントのみを渡すこと
+    """
+    events = pd.concat([state, events], ignore_index=True)
+    events[sum_columns] = events[sum_columns].fillna(0)
+    events = events.sort_values(['key', 'date'], kind='stable')
+    grouped = events.groupby('key', sort=False)
+    running = events[['key', 'date']].copy()
+    running[sum_columns] = grouped[sum_columns].cumsum()
+    running[last_columns] = grouped[last_columns].ffill()
+    return running.drop_duplicates(['key', 'date'], keep='last').reset_index(drop=True)
+
+
+def _as_of(entries, running, key_column):
+    """
+    出走馬ごとに、開催日より前(当日を含まない)の最新の累積成績を結合する関数 (point-in-time)
+
+    Returns:
+    ----------
+    totals : pandas.DataFrame
+        entriesと同じ行順の累積成績 (過去の成績がない場合はNaN)
+    """
+    left = pd.DataFrame({
+        'key': _to_key(entries[key_column]).to_numpy(),
+        'date': pd.to_datetime(entries['event_date']).to_numpy(),
+        'row': np.arange(len(entries)),
+    }).astype({'key': str, 'date': 'datetime64[ns]'}).sort_values('date', kind='stable')
+    right = running.astype({'key': str, 'date': 'datetime64[ns]'}).sort_values('date', kind='stable')
+    merged = pd.merge_asof(left, right, on='date', by='key', allow_exact_matches=False)
+    return merged.sort_values('row').reset_index(drop=True)
+
+
+def _horse_history_features(entries, horse_totals):
+    """累積成績から馬の過去成績の特徴量を計算する関数"""
+    event_date = pd.to_datetime(entries['event_date']).reset_index(drop=True)
+    horse_races = horse_totals['race_count'].fillna(0)
+    features = pd.DataFrame({
+        'horse_race_count': horse_races,
+        'horse_top3_rate': horse_totals['top3_count'] / horse_races.replace(0, np.nan),
+        'horse_mean_finish': horse_totals['finish_sum'] / horse_races.replace(0, np.nan),
+        'horse_last_finish': horse_totals['last_finish'],
+        'horse_days_since_last': (event_date - pd.to_datetime(horse_totals['last_race_date'])).dt.days,
+        'horse_last_speed_index': horse_totals['last_speed_index'],
+    })
+    return features.astype(float)
+
+
+def _history_features(entries, horse_totals, jockey_totals):
+    """累積成績から馬・騎手の過去成績の特徴量を計算する関数"""
+    jockey_rides = jockey_totals['race_count'].fillna(0)
+    features = _horse_history_features(entries, horse_totals)
+    features['jockey_ride_count'] = jockey_rides.astype(float)
+    features['jockey_top3_rate'] = (jockey_totals['top3_count'] / jockey_rides.replace(0, np.nan)).astype(float)
+    return features
+
+
+def _history(entries, horse_totals, jockey_totals, form_indexes):
+    """出走馬ごとのHISTORY_FEATURES (horse_totals・jockey_totalsは開催日より前の成績を含む累積成績)"""
+    entries = entries.reset_index(drop=True)
+    features = pd.concat([
+        _history_features(entries, _as_of(entries, horse_totals, 'horse_id'), _as_of(entries, jockey_totals, 'jockey_id')),
+        _form_features(entries, form_indexes),
+    ], axis=1)
+    return features[HISTORY_FEATURES].astype(float)
+
+
+def _empty_state(sum_columns, last_columns):
+    state = pd.DataFrame({'key': pd.Series(dtype=object), 'date': pd.Series(dtype='datetime64[ns]')})
+    for column in sum_columns + last_columns:
+        state[column] = pd.Series(dtype='datetime64[ns]' if column.endswith('_date') else float)
+    return state
+
+
+class FeatureStore:
+    """
+    開催日ごとに分割した特徴量と、馬・騎手ごとの累積成績を保存するストア
+
+    Parameters:
+    ----------
+    uri : str
+        保存先 (ローカルのディレクトリ、またはgs://bucket/prefix)
+    """
+
+    def __init__(self, uri):
+        if '://' not in uri:
+            uri = os.path.abspath(uri)
+        self.filesystem, self.root = pafs.FileSystem.from_uri(uri)
+        # lookupで利用する累積成績 (watermarkが変わった場合のみ読み込み直す)
+        self._state = None
+
+    # 保存先のパス
+    def _path(self, *parts):
+        return '/'.join([self.root.rstrip('/'), *parts])
+
+    def _partition_path(self, event_date):
+        return self._path(f'event_date={event_date:%Y-%m-%d}', 'part-0.parquet')
+
+    def _exists(self, path):
+        return self.filesystem.get_file_info(path).type != pafs.FileType.NotFound
+
+    def _read_parquet(self, path):
+        return pq.read_table(path, filesystem=self.filesystem).to_pandas()
+
+    def _write_parquet(self, df, path):
+        self.filesystem.create_dir(path.rsplit('/', 1)[0], recursive=True)
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), path, filesystem=self.filesystem)
+
+    def get_watermark(self):
+        """特徴量を保存済みの最終開催日 (未作成の場合はNone)"""
+        path = self._path('_state', 'watermark.json')
+        if not self._exists(path):
+            return None
+        with self.filesystem.open_input_stream(path) as f:
+            return pd.Timestamp(json.loads(f.read())['watermark'])
+
+    def _set_watermark(self, watermark):
+        self.filesystem.create_dir(self._path('_state'), recursive=True)
+        with self.filesystem.open_output_stream(self._path('_state', 'watermark.json')) as f:
+            f.write(json.dumps({'watermark': f'{watermark:%Y-%m-%d}'}).encode())
+
+    def _state_path(self, watermark, name):
+        """
+        watermark時点の累積成績・FormIndexのファイルのパス
+        状態はwatermarkごとのディレクトリに保存し、watermark.jsonの更新で切り替えるため、
+        materializeが途中で失敗しても前回の状態がそのまま残る
+        """
+        if watermark is None:
+            return None
+        path = self._path('_state', f'{watermark:%Y-%m-%d}', name)
+        # watermarkごとのディレクトリに分ける前に作成したストア
+        legacy_path = self._path('_state', name)
+        if not self._exists(path) and self._exists(legacy_path):
+            return legacy_path
+        return path
+
+    def _delete_state(self, watermark):
+        """切り替え前のwatermarkの状態を削除する (watermarkごとのディレクトリに分ける前のファイルを含む)"""
+        if watermark is None:
+            return
+        directory = self._path('_state', f'{watermark:%Y-%m-%d}')
+        if self._exists(directory):
+            self.filesystem.delete_dir(directory)
+        for name in ['horse.parquet', 'jockey.parquet'] + [f'form_{name}.npz' for name in FORM_STATS]:
+            if self._exists(self._path('_state', name)):
+                self.filesystem.delete_file(self._path('_state', name))
+
+    def _load_state(self, watermark, name, sum_columns, last_columns):
+        path = self._state_path(watermark, f'{name}.parquet')
+        if path is None or not self._exists(path):
+            return _empty_state(sum_columns, last_columns)
+        return self._read_parquet(path)
+
+    def _load_form_index(self, watermark, name):
+        path = self._state_path(watermark, f'form_{name}.npz')
+        if path is None or not self._exists(path):
+            return FormIndex.empty(list(FORM_STATS[name]), FORM_WINDOWS[name])
+        with self.filesystem.open_input_stream(path) as f:
+            return FormIndex.from_bytes(f.read())
+
+    def _save_form_index(self, watermark, name, index):
+        with self.filesystem.open_output_stream(self._path('_state', f'{watermark:%Y-%m-%d}', f'form_{name}.npz')) as f:
+            f.write(index.to_bytes())
+
+    def _load_horse_entries(self, watermark):
+        """保存済みの開催日の出走馬 (key: horse_idのキー, date: 開催日)"""
+        entries = pd.DataFrame({'key': pd.Series(dtype=str), 'date': pd.Series(dtype='datetime64[ns]')})
+        path = self._state_path(watermark, 'horse_entries.parquet')
+        if path is not None and self._exists(path):
+            entries = self._read_parquet(path)
+        elif watermark is not None:
+            # 出走馬の一覧を保存する前に作成したストアは、保存済みの特徴量から作成する
+            stored = self.load()
+            entries = pd.DataFrame({'key': _to_key(stored['horse_id']).to_numpy(), 'date': stored['event_date'].to_numpy()})
+        return entries.astype({'key': str, 'date': 'datetime64[ns]'})
+
+    def _get_state(self):
+        """(watermark, 馬の累積成績, 騎手の累積成績, FormIndexの辞書) をインスタンス内に保持して返す"""
+        watermark = self.get_watermark()
+        if self._state is None or self._state[0] != watermark:
+            self._state = (
+                watermark,
+                self._load_state(watermark, 'horse', HORSE_SUM_COLUMNS, HORSE_LAST_COLUMNS),
+                self._load_state(watermark, 'jockey', JOCKEY_SUM_COLUMNS, JOCKEY_LAST_COLUMNS),
+                {name: self._load_form_index(watermark, name) for name in FORM_STATS},
+            )
+        return self._state
+
+    def _restate_horses(self, late_results, horse_state, horse_index, horse_entries, watermark):
+        """
+        watermark以前の成績が後から取り込まれた馬の累積成績を作り直し、
+        その成績より後の保存済みの開催日の馬の特徴量(HORSE_RESTATED_FEATURES)を更新する関数
+
+        Parameters:
+        ----------
+        late_results : pandas.DataFrame
+            後から取り込まれたwatermark以前のraw_horse_resultsの行
+        horse_state : pandas.DataFrame
+            馬の累積成績
+        horse_index : form_index.FormIndex
+            late_resultsを追加した馬のFormIndex (取り込み済みの全ての馬の成績を持つ)
+        horse_entries : pandas.DataFrame
+            保存済みの開催日の出走馬
+
+        Returns:
+        ----------
+        horse_state : pandas.DataFrame
+            作り直した馬の行を置き換えた累積成績
+        """
+        keys = _to_key(late_results['horse_id']).to_numpy()
+        since = pd.Series(late_results['date'].to_numpy()).groupby(keys).min()
+
+        # 作り直す馬の着順の成績をFormIndexから取り出し、累積成績を計算し直す
+        events = horse_index.to_events()
+        events = events[events['key'].isin(since.index) & (events['date'] <= watermark.to_datetime64())]
+        running = _running_totals(
+            _empty_state(HORSE_SUM_COLUMNS, HORSE_LAST_COLUMNS),
+            _horse_race_events(events['key'].to_numpy(), events['date'].to_numpy(), events['finish'].to_numpy()),
+            HORSE_SUM_COLUMNS, HORSE_LAST_COLUMNS,
+        )
+
+        # 後から取り込まれた成績より後の開催日に出走している保存済みの特徴量を更新する
+        targets = horse_entries[horse_entries['key'].isin(since.index)]
+        targets = targets[targets['date'] > targets['key'].map(since)]
+        form_index = {'horse': horse_index}
+        for event_date in sorted(targets['date'].unique()):
+            path = self._partition_path(pd.Timestamp(event_date))
+            if not self._exists(path):
+                continue
+            partition = self._read_parquet(path)
+            rows = np.flatnonzero(_to_key(partition['horse_id']).isin(since.index).to_numpy())
+            target = partition.iloc[rows].reset_index(drop=True)
+            features = pd.concat([
+                _horse_history_features(target, _as_of(target, running, 'horse_id')),
+                _form_features(target, form_index, names=['horse']),
+            ], axis=1)
+            partition.loc[partition.index[rows], HORSE_RESTATED_FEATURES] = features[HORSE_RESTATED_FEATURES].to_numpy()
+            self._write_parquet(partition, path)
+        print(f'Restated {len(since)} horses with late results ({targets["date"].nunique()} stored event dates)')
+
+        # スピード指数はraw_race_results側の値のため、作り直す前の累積成績の値を引き継ぐ
+        restated = running.groupby('key', sort=False).tail(1).copy()
+        restated['last_speed_index'] = restated['key'].map(horse_state.set_index('key')['last_speed_index'])
+        return pd.concat([horse_state[~horse_state['key'].isin(since.index)], restated], ignore_index=True)
+
+    def materialize(self, race_results, horse_results, to_date=None):
+        """
+        watermarkより後、to_date以前の開催日の特徴量を計算して保存する関数
+
+        Parameters:
+        ----------
+        race_results : pandas.DataFrame
+            raw_race_resultsの行 (スピード指数をspeed_index列に結合したもの)
+        horse_results : pandas.DataFrame
+            raw_horse_resultsの行 (horse_id・date・finish_position・last_3f・time_index)
+            watermark以前の行も含めてよい (取り込み済みの馬・開催日の行は除外し、新たな行があった馬は作り直す)
+        to_date : str
+            計算する最終開催日 (yyyy-mm-dd)。Noneの場合はrace_resultsの最終開催日
+
+        Returns:
+        ----------
+        event_dates : list
+            特徴量を保存した開催日
+        """
+        watermark, horse_state, jockey_state, form_indexes = self._get_state()
+        race_results = race_results.assign(event_date=pd.to_datetime(race_results['event_date']))
+        horse_results = horse_results.assign(date=pd.to_datetime(horse_results['date']))
+        if 'speed_index' not in race_results.columns:
+            race_results['speed_index'] = np.nan
+        to_date = pd.Timestamp(to_date) if to_date is not None else race_results['event_date'].max()
+        if pd.isna(to_date) or (watermark is not None and to_date <= watermark):
+            return []
+
+        # 保存済みの開催日より後のみ計算する
+        from_date = watermark if watermark is not None else pd.Timestamp.min
+        race_results = race_results[(race_results['event_date'] > from_date) & (race_results['event_date'] <= to_date)]
+
+        # 馬の成績は取り込み済み(FormIndexにある)馬・開催日の行を除外し、watermark以前の行があった馬は作り直す
+        horse_results = horse_results[horse_results['date'] <= to_date].drop_duplicates(['horse_id', 'date'], keep='last')
+        ingested = form_indexes['horse'].contains(_to_key(horse_results['horse_id']).to_numpy(), horse_results['date'].to_numpy())
+        horse_results = horse_results[~ingested]
+        form_indexes = {
+            name: form_indexes[name].update(events)
+            for name, events in _form_events(horse_results, race_results).items()
+        }
+        horse_entries = self._load_horse_entries(watermark)
+        late = (horse_results['date'] <= from_date).to_numpy()
+        if late.any():
+            horse_state = self._restate_horses(horse_results[late], horse_state, form_indexes['horse'], horse_entries, watermark)
+        horse_results = horse_results[~late]
+
+        horse_running = _running_totals(
+            horse_state, _horse_events(horse_results, race_results), HORSE_SUM_COLUMNS, HORSE_LAST_COLUMNS
+        )
+        jockey_running = _running_totals(
+            jockey_state, _jockey_events(race_results), JOCKEY_SUM_COLUMNS, JOCKEY_LAST_COLUMNS
+        )
+
+        entries = derive_entry_features(race_results)
+        features = pd.concat([entries, _history(entries, horse_running, jockey_running, form_indexes)], axis=1)
+
+        event_dates = sorted(features['event_date'].unique())
+        for event_date, partition in features.groupby('event_date', sort=True):
+            self._write_parquet(partition, self._partition_path(event_date))
+
+        # 累積成績をto_dateのディレクトリに保存してからwatermarkを進める (途中で失敗した場合は次回同じ開催日から計算し直す)
+        horse_state = horse_running.groupby('key', sort=False).tail(1)
+        jockey_state = jockey_running.groupby('key', sort=False).tail(1)
+        horse_entries = pd.concat([
+            horse_entries,
+            pd.DataFrame({'key': _to_key(entries['horse_id']).to_numpy(), 'date': entries['event_date'].to_numpy()}),
+        ], ignore_index=True).drop_duplicates()
+        state_dir = self._path('_state', f'{to_date:%Y-%m-%d}')
+        self._write_parquet(horse_state, f'{state_dir}/horse.parquet')
+        self._write_parquet(jockey_state, f'{state_dir}/jockey.parquet')
+        self._write_parquet(horse_entries, f'{state_dir}/horse_entries.parquet')
+        for name, index in form_indexes.items():
+            self._save_form_index(to_date, name, index)
+        self._set_watermark(to_date)
+        self._delete_state(watermark)
+        self._state = (to_date, horse_state, jockey_state, form_indexes)
+        print(f'Materialized features for {len(event_dates)} event dates ({len(features)} rows). watermark: {to_date:%Y-%m-%d}')
+        return [pd.Timestamp(d) for d in event_dates]
+
+    def materialize_from_bigquery(self, bq_client, dataset, to_date=None):
+        """
+        BigQueryの生データテーブルからwatermarkより後の行を取得し、materializeする関数
+
+        Parameters:
+        ----------
+        bq_client : google.cloud.bigquery.Client
+        dataset : str
+            生データテーブルのデータセット (project.dataset)
+        to_date : str
+            計算する最終開催日 (yyyy-mm-dd)。Noneの場合はraw_race_resultsの最終開催日
+        """
+        # google-cloud-bigqueryは特徴量を作成する場合のみ必要なため、ここでimportする
+        from google.cloud import bigquery
+
+        watermark = self.get_watermark()
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter('from_date', 'DATE', (watermark or pd.Timestamp('1900-01-01')).date()),
+            bigquery.ScalarQueryParameter('to_date', 'DATE', pd.Timestamp(to_date or '2999-12-31').date()),
+            bigquery.ScalarQueryParameter('lookback_days', 'INT64', HORSE_RESULTS_LOOKBACK_DAYS),
+        ])
+        race_results = bq_client.query(RACE_RESULTS_QUERY.format(dataset=dataset), job_config=job_config).to_dataframe()
+        horse_results = bq_client.query(HORSE_RESULTS_QUERY.format(dataset=dataset), job_config=job_config).to_dataframe()
+        return self.materialize(race_results, horse_results, to_date)
+
+    def load(self, from_=None, to_=None):
+        """
+        保存済みの特徴量を開催日の範囲(yyyy-mm-dd、両端を含む)で読み込む関数 (学習用)
+
+        Returns:
+        ----------
+        features : pandas.DataFrame
+            event_date・race_id・horse_numberの順に並べたもの
+        """
+        from_ = pd.Timestamp(from_ or pd.Timestamp.min)
+        to_ = pd.Timestamp(to_ or pd.Timestamp.max)
+        selector = pafs.FileSelector(self.root, allow_not_found=True)
+        partitions = []
+        for info in self.filesystem.get_file_info(selector):
+            name = info.base_name
+            if info.type != pafs.FileType.Directory or not name.startswith('event_date='):
+                continue
+            if from_ <= pd.Timestamp(name.split('=', 1)[1]) <= to_:
+                partitions.append(self._read_parquet(self._path(name, 'part-0.parquet')))
+        if not partitions:
+            return pd.DataFrame()
+        features = pd.concat(partitions, ignore_index=True)
+        return features.sort_values(['event_date', 'race_id', 'horse_number'], kind='stable').reset_index(drop=True)
+
+    def lookup(self, entries):
+        """
+        出走馬ごとの馬・騎手の過去成績の特徴量を返す関数 (学習・予測で共通のpoint-in-time参照)
+        保存済みの開催日はその開催日の特徴量を(race_id, horse_number)で、
+        watermarkより後の開催日は累積成績・FormIndexを(horse_id, jockey_id, 調教師名)で参照する
+
+        Parameters:
+        ----------
+        entries : pandas.DataFrame
+            event_date・race_id・horse_number・horse_id・jockey_id・trainer(またはtrainer_name)を含む出走馬の行 (出走表など)
+
+        Returns:
+        ----------
+        features : pandas.DataFrame
+            entriesと同じindexのHISTORY_FEATURESの列 (過去の成績がない場合はNaN)
+        """
+        watermark, horse_state, jockey_state, form_indexes = self._get_state()
+        event_date = pd.to_datetime(entries['event_date']).reset_index(drop=True)
+        features = pd.DataFrame(np.nan, index=range(len(entries)), columns=HISTORY_FEATURES)
+
+        # watermarkより後の開催日: 保存済みの累積成績は全て開催日より前の成績
+        upcoming = (event_date > watermark).to_numpy() if watermark is not None else np.ones(len(entries), bool)
+        if upcoming.any():
+            target = entries[upcoming].assign(event_date=event_date[upcoming].to_numpy())
+            features.loc[upcoming, :] = _history(target, horse_state, jockey_state, form_indexes).to_numpy()
+
+        # 保存済みの開催日: 開催日の特徴量を出走馬のキーで参照する
+        for date in event_date[~upcoming].unique():
+            path = self._partition_path(pd.Timestamp(date))
+            if not self._exists(path):
+                continue
+            partition = self._read_parquet(path)
+            stored = partition.set_index([_to_key(partition['race_id']), _to_key(partition['horse_number'])])
+            rows = np.flatnonzero((~upcoming) & (event_date == date).to_numpy())
+            keys = pd.MultiIndex.from_arrays([
+                _to_key(entries['race_id'].iloc[rows]).to_numpy(),
+                _to_key(entries['horse_number'].iloc[rows]).to_numpy(),
+            ])
+            features.loc[rows, :] = stored.reindex(index=keys, columns=HISTORY_FEATURES).to_numpy()
+
+        features.index = entries.index
+        return features.astype(float)
+
+
+if __name__ == '__main__':
+    # google-cloud-bigqueryは特徴量を作成する場合のみ必要なため、ここでimportする
+    from google.cloud import bigquery
+
+    store_uri, dataset = sys.argv[1], sys.argv[2]
+    to_date = sys.argv[3] if len(sys.argv) > 3 else None
+    FeatureStore(store_uri).materialize_from_bigquery(bigquery.Client(), dataset, to_date)
@@ -0,0 +1,237 @@
+import dataclasses
+import email.utils
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# 環境変数取得
+# HTTP_CACHE_BUCKETが設定されている場合はGCS、それ以外はローカルディレクトリにキャッシュする
+HTTP_CACHE_DIR = os.environ.get(
+    "HTTP_CACHE_DIR",
+    os.path.join(os.environ.get("DOWNLOAD_FOLDER") or "/tmp", "http_cache"),
+)
+HTTP_CACHE_BUCKET = os.environ.get("HTTP_CACHE_BUCKET")
+HTTP_CACHE_MAX_BYTES = int(os.environ.get("HTTP_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+
+def cache_key(url):
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+@dataclasses.dataclass
+class CacheEntry:
+    url: str
+    status: int
+    content: bytes
+    headers: dict
+    fetched_at: float
+
+    @property
+    def age(self):
+        return time.time() - self.fetched_at
+
+    def validators(self):
+        """条件付きリクエスト(再検証)用のHTTPヘッダを返す"""
+        headers = {}
+        lowered = {k.lower(): v for k, v in self.headers.items()}
+        if "etag" in lowered:
+            headers["If-None-Match"] = lowered["etag"]
+        if "last-modified" in lowered:
+            headers["If-Modified-Since"] = lowered["last-modified"]
+        elif not headers:
+            headers["If-Modified-Since"] = email.utils.formatdate(
+                self.fetched_at, usegmt=True
+            )
+        return headers
+
+    def _meta(self):
+        return {
+            "url": self.url,
+            "status": self.status,
+            "headers": self.headers,
+            "fetched_at": self.fetched_at,
+        }
+
+
+class LocalCacheStore:
+    """
+    ローカルディレクトリにレスポンスを保存するストア
+    合計サイズがmax_bytesを超えた場合、最終アクセスが古いものから削除する(LRU)
+    """
+
+    def __init__(self, directory, max_bytes=HTTP_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._total_bytes = sum(
+            os.path.getsize(os.path.join(directory, f))
+            for f in os.listdir(directory)
+            if f.endswith(".body")
+        )
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + ".json", base + ".body"
+
+    def get(self, key):
+        meta_path, body_path = self._paths(key)
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            with open(body_path, "rb") as f:
+                body = f.read()
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        # LRU判定用に最終アクセス時刻を更新
+        os.utime(body_path)
+        return meta, body
+
+    def put(self, key, meta, body):
+        meta_path, body_path = self._paths(key)
+        with self._lock:
+            if os.path.exists(body_path):
+                self._total_bytes -= os.path.getsize(body_path)
+            with open(body_path, "wb") as f:
+                f.write(body)
+            with open(meta_path, "w") as f:
+                json.dump(meta, f)
+            self._total_bytes += len(body)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        bodies = [
+            os.path.join(self.directory, f)
+            for f in os.listdir(self.directory)
+            if f.endswith(".body")
+        ]
+        bodies.sort(key=os.path.getmtime)
+        for body_path in bodies:
+            if self._total_bytes <= self.max_bytes:
+                break
+            self._total_bytes -= os.path.getsize(body_path)
+            os.remove(body_path)
+            meta_path = body_path[: -len(".body")] + ".json"
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+        logger.info(f"HTTP cache evicted down to {self._total_bytes} bytes")
+
+    def delete(self, key):
+        meta_path, body_path = self._paths(key)
+        with self._lock:
+            if os.path.exists(body_path):
+                self._total_bytes -= os.path.getsize(body_path)
+                os.remove(body_path)
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+
+
+class GCSCacheStore:
+    """
+    GCSバケットにレスポンスを保存するストア
+    Cloud Functionsの/tmpはインスタンス終了で消えるため、本番ではこちらを利用する
+    容量の上限はバケットのライフサイクルルールで管理する
+    """
+
+    def __init__(self, bucket_name, prefix="http_cache/"):
+        # google-cloud-storageはGCSを利用する関数でのみ必要なため、ここでimportする
+        from google.cloud import storage as gcs
+
+        self.bucket = gcs.Client().bucket(bucket_name)
+        self.prefix = prefix
+
+    def get(self, key):
+        blob = self.bucket.get_blob(self.prefix + key)
+        if blob is None or not blob.metadata or "cache_meta" not in blob.metadata:
+            return None
+        return json.loads(blob.metadata["cache_meta"]), blob.download_as_bytes()
+
+    def put(self, key, meta, body):
+        blob = self.bucket.blob(self.prefix + key)
+        blob.metadata = {"cache_meta": json.dumps(meta)}
+        blob.upload_from_string(body, content_type="application/octet-stream")
+
+    def delete(self, key):
+        blob = self.bucket.get_blob(self.prefix + key)
+        if blob is not None:
+            blob.delete()
+
+
+class ResponseCache:
+    """
+    URLをkeyとしたHTTPレスポンスキャッシュ
+
+    Parameters:
+    ----------
+    store : LocalCacheStore or GCSCacheStore
+        レスポンスの保存先
+    default_ttl : float
+        再検証せずにキャッシュを返す期間(秒)
+    """
+
+    def __init__(self, store, default_ttl=0):
+        self.store = store
+        self.default_ttl = default_ttl
+
+    def get(self, url):
+        try:
+            cached = self.store.get(cache_key(url))
+        except Exception as e:
+            logger.warning(f"Failed to read HTTP cache for {url}: {e}")
+            return None
+        if cached is None:
+            return None
+        meta, body = cached
+        return CacheEntry(
+            meta["url"], meta["status"], body, meta["headers"], meta["fetched_at"]
+        )
+
+    def put(self, url, status, content, headers):
+        entry = CacheEntry(url, status, content, dict(headers), time.time())
+        try:
+            self.store.put(cache_key(url), entry._meta(), content)
+        except Exception as e:
+            logger.warning(f"Failed to write HTTP cache for {url}: {e}")
+        return entry
+
+    def invalidate(self, url):
+        """
+        URLのキャッシュを削除する
+        メンテナンス中のページ・結果が未掲載のページなど、200でも内容を抽出できなかったレスポンスを
+        再試行時にキャッシュから返さないよう、呼び出し側がパースに失敗した時点で呼ぶ
+        """
+        try:
+            self.store.delete(cache_key(url))
+        except Exception as e:
+            logger.warning(f"Failed to invalidate HTTP cache for {url}: {e}")
+
+    def refresh(self, entry):
+        """再検証(304)に成功したエントリの取得時刻を更新する"""
+        return self.put(entry.url, entry.status, entry.content, entry.headers)
+
+    def is_fresh(self, entry, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        return entry.age < ttl
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache():
+    """環境変数の設定に応じたResponseCacheをインスタンス内で1つだけ作成して返す"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            if HTTP_CACHE_BUCKET:
+                store = GCSCacheStore(HTTP_CACHE_BUCKET)
+            else:
+                store = LocalCacheStore(HTTP_CACHE_DIR)
+            _default_cache = ResponseCache(store)
+        return _default_cache
@@ -1,11 +1,12 @@
+import asyncio
 import dataclasses
 import json
 import os
-import subprocess
+import threading
+import time
 import traceback
 
 import lightgbm as lgb
-import numpy as np
 import pandas as pd
 import requests
 # from dotenv import load_dotenv
@@ -13,50 +14,57 @@ from google.cloud import bigquery
 from google.cloud import scheduler_v1 as schdlr
 from google.cloud import secretmanager
 from google.cloud import storage as gcs
-from sklearn.preprocessing import OrdinalEncoder
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 
+import scraper
+from browser_pool import BrowserPool, run
+from feature_encoder import FeatureEncoder, build_features
+from feature_store import HISTORY_FEATURES, FeatureStore, parse_entry_columns
+from ranking import top_k_flags
+
 # load_dotenv()
 PROJECT_ID = os.environ.get('PROJECT_ID')
 MODEL_BUCKET = os.environ.get('MODEL_BUCKET')
 CSV_BUCKET = os.environ.get('CSV_BUCKET')
 MODEL_NAME_PREFIX = os.environ.get('MODEL_NAME_PREFIX')
+# 学習時に保存したOrdinalEncoder (ノートブック 02_データの前処理 で作成)
+ENCODER_NAME = os.environ.get('ENCODER_NAME', 'ordinal_encoder.pkl')
 DOWNLOAD_FOLDER = os.environ.get('DOWNLOAD_FOLDER')
 # SECRET_ID_LINE = os.environ.get('SECRET_ID_LINE')
 SLACK_BOT_TOKEN = os.environ.get('SLACK_BOT_TOKEN')
 SLACK_CHANNEL_ID = os.environ.get("SLACK_CHANNEL_ID")
 BQ_DATASET = os.environ.get('BQ_DATASET')
+# 保持しているモデルが最新かをGCSに確認する間隔(秒)
+MODEL_REVALIDATE_INTERVAL = int(os.environ.get('MODEL_REVALIDATE_INTERVAL', 300))
+# 馬・騎手の過去成績の特徴量を保存している特徴量ストア (gs://bucket/prefix。未設定の場合は利用しない)
+FEATURE_STORE_URI = os.environ.get('FEATURE_STORE_URI')
+
+# ウォームインスタンスで関数の起動をまたいで再利用するブラウザ
+browser_pool = BrowserPool()
 
 @dataclasses.dataclass(frozen=True)
 class UrlPaths:
     # 出馬表ページ
     RACE_CARD_URL: str = 'https://race.netkeiba.com/race/shutuba.html'
 
-def get_race_card(race_id, race_date):
+def get_race_cards(race_id_list, race_date):
 
-    command = [
-        'python',
-        'scraper.py',
-        race_id,
-        race_date,
-        UrlPaths.RACE_CARD_URL,
-        DOWNLOAD_FOLDER,
-    ]
-
-    # ウェブスクレイピング実行
-    try:
-        result = subprocess.run(command, capture_output=True, text=True)
-        print(result.stdout)
-        print(result.stderr)
-    except Exception as e:
-        print(e)
-        return
+    # ウェブスクレイピング実行 (複数レースを並行に取得。ブラウザはインスタンス内で起動済みのものを利用)
+    async def _scrape():
+        return await asyncio.gather(
+            *(scraper.get_race_card(browser_pool, race_id, race_date, UrlPaths.RACE_CARD_URL) for race_id in race_id_list),
+            return_exceptions=True,
+        )
 
-    # スクレイピング結果取得
-    race_card = pd.read_csv(f'{DOWNLOAD_FOLDER}/race_card.csv')
+    race_cards = {}
+    for race_id, race_card in zip(race_id_list, run(_scrape())):
+        if isinstance(race_card, Exception):
+            print(f'Failed to scrape race card (race_id: {race_id}): {race_card}')
+            continue
+        race_cards[race_id] = race_card
 
-    return race_card
+    return race_cards
 
 
 # データ前処理関数の定義
@@ -65,37 +73,38 @@ def preprocess_race_results(df):
     print(df["odds"])
     # df["odds"] = df["odds"].replace("---", np.nan).astype(float)
     df['odds'] = pd.to_numeric(df['odds'], errors='coerce')
-    df_sex = df['sex_age'].str.extract(r'([牝牡セ])(\d+)', expand=True)
-    df['sex'] = df_sex[0]
-    df['age'] = df_sex[1].astype(int)
-    df = df.drop(['sex_age'], axis=1)
-    df_weight = df['horse_weight'].str.extract(r'(\d{3}).([+-0]\d*)', expand=True)
-    df['馬体重'] = df_weight[0].fillna(0).astype(int)
-    df['体重増減'] = df_weight[1].str.replace(r'\+', '', regex=True).fillna(0).astype(int)
-    df = df.drop(['horse_weight'], axis=1)
-    df = df.drop(['jockey'], axis=1)
-    df[['year', 'month', 'day']] = df['event_date'].str.split('-', expand=True).astype(int)
-    df_trainner = df['trainer'].str.extract(r'\[(.)\] (.+)', expand=True)
-    df['trainer_region'] = df_trainner[0]
-    df['trainer_name'] = df_trainner[1]
-    df = df.drop(['trainer', 'event_date'], axis=1)
+    # 性齢・馬体重・調教師・開催日の分割は学習データ(特徴量ストア)と同じ処理を利用する
+    df = parse_entry_columns(df)
+    # trainer_idは出走表にのみ保持する (raw_race_predictionのスキーマにはない)
+    df = df.drop(['jockey', 'event_date', 'trainer_id'], axis=1)
 
     return df
 
-def get_model_lgb():
-    gcs_client = gcs.Client()
-    blobs = gcs_client.list_blobs(MODEL_BUCKET, prefix=MODEL_NAME_PREFIX)
-    blob_list = list(blobs)
-
-    if len(blob_list) == 1:
-        blob = blob_list[0]
-        print(f'Model file: {blob.name}')
-
-        # モデルImport
-        model_lgb_path = f'../tmp/{blob.name}'
-        blob.download_to_filename(model_lgb_path)
-        model_lgb = lgb.Booster(model_file=model_lgb_path)
-    else:
+class ModelRegistry:
+    """
+    予測モデル・エンコーダをインスタンス内のメモリに保持し、ウォームインスタンスでは関数の起動をまたいで再利用するクラス
+    revalidate_interval秒ごとにGCS上のファイルのgenerationを確認し、ファイルが更新されていれば読み込み直す
+    loaderにはダウンロードしたバイト列から読み込み済みのオブジェクトを作成する関数を指定する
+    """
+
+    def __init__(self, bucket_name, prefix, loader, revalidate_interval=300):
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.loader = loader
+        self.revalidate_interval = revalidate_interval
+        self._gcs_client = None
+        self._model = None
+        self._generation = None
+        self._validated_at = None
+        self._lock = threading.Lock()
+
+    def _find_blob(self):
+        if self._gcs_client is None:
+            self._gcs_client = gcs.Client()
+        blob_list = list(self._gcs_client.list_blobs(self.bucket_name, prefix=self.prefix))
+        if len(blob_list) == 1:
+            return blob_list[0]
+
         # エラー処理: ファイル数が1つではない場合
         if len(blob_list) == 0:
             print("Error: No blobs found with the specified prefix.")
@@ -103,7 +112,61 @@ def get_model_lgb():
             print("Error: Multiple blobs found with the specified prefix. Expecting only one.")
         return
 
-    return model_lgb
+    def get(self):
+        with self._lock:
+            if self._model is not None and time.monotonic() - self._validated_at < self.revalidate_interval:
+                return self._model
+
+            try:
+                blob = self._find_blob()
+                if blob is None:
+                    return self._model
+                if blob.generation != self._generation:
+                    # モデルImport (ファイルを経由せずメモリ上で読み込む)
+                    print(f'Model file: {blob.name} (generation: {blob.generation})')
+                    self._model = self.loader(blob.download_as_bytes(if_generation_match=blob.generation))
+                    self._generation = blob.generation
+                self._validated_at = time.monotonic()
+            except Exception as e:
+                # 確認・読み込みに失敗した場合は保持しているモデルを使い続ける
+                print(f'Failed to revalidate model: {e}')
+            return self._model
+
+
+# ウォームインスタンスで関数の起動をまたいで再利用する予測モデル・エンコーダ
+model_registry = ModelRegistry(
+    MODEL_BUCKET, MODEL_NAME_PREFIX,
+    lambda content: lgb.Booster(model_str=content.decode('utf-8')),
+    MODEL_REVALIDATE_INTERVAL,
+)
+encoder_registry = ModelRegistry(MODEL_BUCKET, ENCODER_NAME, FeatureEncoder.from_bytes, MODEL_REVALIDATE_INTERVAL)
+
+
+def get_model_lgb():
+    return model_registry.get()
+
+
+def get_feature_encoder():
+    return encoder_registry.get()
+
+
+# ウォームインスタンスで関数の起動をまたいで再利用する特徴量ストア (累積成績はwatermarkが変わった場合のみ読み込み直す)
+feature_store = FeatureStore(FEATURE_STORE_URI) if FEATURE_STORE_URI else None
+
+
+def get_history_features(race_card, feature_names):
+    """
+    出走馬ごとの馬・騎手の過去成績の特徴量を特徴量ストアから取得する関数
+    特徴量ストアを利用しない場合・モデルが過去成績の特徴量を使わない場合・取得に失敗した場合はNoneを返す
+    """
+    if feature_store is None or not set(HISTORY_FEATURES) & set(feature_names):
+        return
+    try:
+        return feature_store.lookup(race_card)
+    except Exception as e:
+        print(f'Failed to look up history features: {e}')
+        print(traceback.format_exc())
+        return
 
 # def gcs_uploader(filename):
 #     src_file_path = os.path.join(DOWNLOAD_FOLDER, filename)
@@ -247,58 +310,75 @@ def delete_schdlr_job(scheduler_job_id):
     return
 
 
+def predict_races(race_card):
+
+    # データ前処理
+    model_lgb = get_model_lgb()
+    feature_names = model_lgb.feature_name()
+    history_features = get_history_features(race_card, feature_names)
+    race_card_prep = preprocess_race_results(race_card)
+
+    # 特徴量作成 (学習時のエンコーダ・特徴量の並びに合わせる。過去成績は予測結果の保存対象に含めない)
+    feature_input = race_card_prep if history_features is None else race_card_prep.join(history_features)
+    race_card_feature = build_features(feature_input, get_feature_encoder(), feature_names)
+
+    # 予測モデル実行 (複数レース分をまとめて1回で予測)
+    y_pred_loaded = model_lgb.predict(race_card_feature, num_iteration=model_lgb.best_iteration)
+    race_card_prep['y_pred_loaded'] = y_pred_loaded
+    # 予測結果をレースごとに二値クラスに変換 (予測値の上位3頭を1とする)
+    race_card_prep['pred_labels'] = top_k_flags(race_card_prep['race_id'].to_numpy(), y_pred_loaded, k=3)
+
+    return race_card_prep
+
+
 # エントリポイント
 def main(event, context):
 
     scheduler_job_id = event['attributes']['scheduler_job_id']
-    race_id = event['attributes']['race_id']
     race_date = event['attributes']['race_date']
-    print(f'race_id: {race_id}')
+    # 複数レースをまとめて予測する場合、race_idsにカンマ区切りでrace_idが指定される
+    if 'race_ids' in event['attributes']:
+        race_id_list = event['attributes']['race_ids'].split(',')
+    else:
+        race_id_list = [event['attributes']['race_id']]
+    print(f'race_id_list: {race_id_list}')
 
+    notified_race_ids = set()
     try:
         # 出走表を取得
-        race_card = get_race_card(race_id, race_date)
-
-        # データ前処理
-        race_card_prep = preprocess_race_results(race_card)
-
-        # 特徴量のみ取得
-        race_card_feature = race_card_prep.drop(['race_id', 'race_title', 'location', 'race_turn', 'year', 'month', 'day', 'horse_name'], axis=1)
-
-        # カテゴリカル変数のエンコーディング
-        categorical_columns = race_card_feature.select_dtypes(include='object').columns
-        race_card_feature[categorical_columns] = race_card_feature[categorical_columns].astype(str)
-        ordinal_encoder = OrdinalEncoder(handle_unknown="use_encoded_value", unknown_value=-1)
-        race_card_feature[categorical_columns] = ordinal_encoder.fit_transform(race_card_feature[categorical_columns])
-
-        # 予測モデル実行
-        model_lgb = get_model_lgb()
-        y_pred_loaded = model_lgb.predict(race_card_feature, num_iteration=model_lgb.best_iteration)
-        # 予測結果を二値クラスに変換
-        pred_labels = (y_pred_loaded >= np.sort(y_pred_loaded)[-3]).astype(int)
-        race_card_prep['y_pred_loaded'] = y_pred_loaded
-        race_card_prep['pred_labels'] = pred_labels
-
-        # 予測結果の保存
-        race_info = f'{race_date.replace('-', '')}-{race_id}'
-        race_card_prep = race_card_prep.rename(columns={'馬体重': 'horse_weight', '体重増減': 'weight_gain_loss'})
-        bq_uploader(race_card_prep, race_info)
-
-        # レース場とレース名を抽出
-        unique_race_info = race_card_prep[['location', 'race_title']].drop_duplicates().iloc[0]
-        race_location = unique_race_info['location']
-        race_name = unique_race_info['race_title']
-
-        # 予測結果通知
-        # ## LINE ver.
-        # send_line(race_location, race_name, race_card_prep)
-        ## Slack ver.
-        send_slack(race_id, race_location, race_name, race_card_prep)
+        race_cards = get_race_cards(race_id_list, race_date)
+        for race_id in race_id_list:
+            if race_id not in race_cards:
+                send_slack(race_id)
+                notified_race_ids.add(race_id)
+
+        if race_cards:
+            # 予測実行
+            race_card_prep = predict_races(pd.concat(race_cards.values(), ignore_index=True))
+
+            # 予測結果の保存
+            race_info = ', '.join(f'{race_date.replace('-', '')}-{race_id}' for race_id in race_cards)
+            bq_uploader(race_card_prep, race_info)
+
+            for race_id, race_card_result in race_card_prep.groupby('race_id', sort=False):
+                # レース場とレース名を抽出
+                unique_race_info = race_card_result[['location', 'race_title']].drop_duplicates().iloc[0]
+                race_location = unique_race_info['location']
+                race_name = unique_race_info['race_title']
+
+                # 予測結果通知
+                # ## LINE ver.
+                # send_line(race_location, race_name, race_card_result)
+                ## Slack ver.
+                send_slack(race_id, race_location, race_name, race_card_result)
+                notified_race_ids.add(str(race_id))
 
     except Exception as e:
         print(e)
         print(traceback.format_exc())
-        send_slack(race_id)
+        for race_id in race_id_list:
+            if race_id not in notified_race_ids:
+                send_slack(race_id)
     finally:
         # GCF関数の起動元Scheduler Jobを削除
         delete_schdlr_job(scheduler_job_id)
@@ -0,0 +1,104 @@
+"""
+レースごとの予測値の順位付け
+
+学習時の評価(03_モデルの学習)、馬券の購入シミュレーション(05)、予測サービス(race_prediction)で共通して利用する
+予測サービスには同じ内容のファイルを src_gcf-race_prediction/ranking.py として配置している
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def _race_order(race_ids, scores):
+    """
+    レースごとに予測値の降順で並べた行番号と、並べ替え後の各行のレース内順位(1始まり)を返す
+    予測値が同じ場合は元の行順を優先する (pandasのrank(method='first')と同じ)
+    """
+    codes, _ = pd.factorize(race_ids)
+    order = np.lexsort((-scores, codes))
+    sorted_codes = codes[order]
+    is_start = np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]
+    starts = np.flatnonzero(is_start)
+    group_start = np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+    return codes, order, np.arange(len(order)) - group_start + 1
+
+
+def rank_within_race(race_ids, scores):
+    """
+    レース内での予測値の順位を計算する関数
+
+    Parameters:
+    ----------
+    race_ids : array-like
+        各行のレースID
+    scores : array-like
+        各行の予測値
+
+    Returns:
+    ----------
+    rank : numpy.ndarray
+        予測値が高い順の順位(1始まり)。入力と同じ行順
+    """
+    scores = np.asarray(scores, dtype=float)
+    _, order, sorted_rank = _race_order(np.asarray(race_ids), scores)
+    rank = np.empty(len(order), dtype=int)
+    rank[order] = sorted_rank
+    return rank
+
+
+def top_k_flags(race_ids, scores, k=3):
+    """
+    レースごとに予測値の上位k頭に1、それ以外に0を付与する関数
+
+    Returns:
+    ----------
+    flags : numpy.ndarray
+        入力と同じ行順のフラグ
+    """
+    return (rank_within_race(race_ids, scores) <= k).astype(int)
+
+
+def normalize_within_race(race_ids, scores):
+    """
+    予測値をレース内の合計が1になるように正規化する関数
+
+    Returns:
+    ----------
+    prob : numpy.ndarray
+        入力と同じ行順の正規化済み予測値
+    """
+    scores = np.asarray(scores, dtype=float)
+    codes, _ = pd.factorize(np.asarray(race_ids))
+    totals = np.bincount(codes, weights=scores)
+    return scores / totals[codes]
+
+
+def add_race_rankings(df, score='pred', race_id='race_id', k=3):
+    """
+    レース内順位・上位k頭フラグ・レース内で正規化した予測値の列を追加する関数
+
+    Parameters:
+    ----------
+    df : pandas.DataFrame
+        予測値を含むデータ
+    score : str
+        予測値の列名
+    race_id : str
+        レースIDの列名
+    k : int
+        フラグを付与する上位頭数
+
+    Returns:
+    ----------
+    df : pandas.DataFrame
+        以下の列を追加したデータ (行順は入力のまま)
+        pred_rank: レース内順位, pred_class: 上位k頭フラグ, pred_norm: レース内で正規化した予測値
+    """
+    df = df.copy()
+    race_ids = df[race_id].to_numpy()
+    scores = df[score].to_numpy(dtype=float)
+    rank = rank_within_race(race_ids, scores)
+    df['pred_rank'] = rank
+    df['pred_class'] = (rank <= k).astype(int)
+    df['pred_norm'] = normalize_within_race(race_ids, scores)
+    return df
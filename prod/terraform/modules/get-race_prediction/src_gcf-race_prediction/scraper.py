@@ -1,36 +1,203 @@
-import sys
 import asyncio
-from pyppeteer import launch
+import json
+import sys
 import re
+
+import lxml.html
 import pandas as pd
 
-async def extract_horse_jockey_trainer_data(page):
-    rows = await page.querySelectorAll('.HorseList')
+from browser_pool import BrowserPool, run
+from fetcher import AsyncFetcher
+
+# 単勝オッズ・人気を返すAPI (出走表ページのJSが呼び出しているもの)
+ODDS_API_URL = 'https://race.netkeiba.com/api/api_get_jra_odds.html'
+
+# 出走表(.HorseList)とレース情報(.RaceList_Item02)を1回のpage.evaluateでまとめて取得するスクリプト
+# セルごとにevaluateするとCDPの往復がセル数分発生するため、ページ内でJSONに変換して返す
+EXTRACT_RACE_CARD_JS = """() => {
+    const linkedClasses = ['HorseInfo', 'Jockey', 'Trainer'];
+    const rows = Array.from(document.querySelectorAll('.HorseList')).map(row =>
+        Array.from(row.querySelectorAll('td')).map(column => {
+            const className = column.getAttribute('class');
+            const a = linkedClasses.includes(className) ? column.querySelector('a') : null;
+            return {
+                className,
+                href: a ? a.getAttribute('href') : null,
+                text: column.textContent,
+            };
+        })
+    );
+    const raceData = document.querySelector('.RaceList_Item02');
+    return { rows, raceText: raceData ? raceData.textContent : null };
+}"""
+
+# 出走取消・競走除外の馬の出走表上の表記 (オッズ・人気が発表されない)
+SCRATCHED_MARKERS = ('取消', '除外')
+
+# parse_horse_jockey_trainer_dataの行でのオッズ・人気の位置 (process_horse_jockey_trainer_dataと同じ)
+ODDS_COLUMN = 12
+POPULARITY_COLUMN = 13
+
+# IDを抽出するセルのclass名と、hrefからIDを取り出す正規表現
+ID_PATTERNS = {
+    'HorseInfo': r'horse/(\d*)',
+    'Jockey': r'jockey/result/recent/(\w*)',
+    'Trainer': r'trainer/result/recent/(\w*)',
+}
+
+
+class FallbackStats:
+    """HTTPのみでの取得に失敗し、ブラウザにフォールバックした割合を集計するクラス"""
+
+    def __init__(self):
+        self.total = 0
+        self.fallbacks = 0
+
+    def record(self, fallback):
+        self.total += 1
+        if fallback:
+            self.fallbacks += 1
+        print(f'Browser fallback rate: {self.fallbacks}/{self.total} ({self.fallbacks / self.total:.1%})')
+
+
+# ウォームインスタンス内での累計
+fallback_stats = FallbackStats()
+
+
+async def extract_race_card(page):
+    result = await page.evaluate(EXTRACT_RACE_CARD_JS)
+    data = parse_horse_jockey_trainer_data(result['rows'])
+    race_info, race_title, hurdle_race_flg = parse_race_info(result['raceText'])
+    return data, race_info, race_title, hurdle_race_flg
+
+
+def parse_horse_jockey_trainer_data(rows):
     data = []
 
     for row in rows:
-        columns = await row.querySelectorAll('td')
         row_data = []
 
-        for column in columns:
-            class_name = await page.evaluate('(element) => element.getAttribute("class")', column)
-            if class_name in ['HorseInfo']:
-                href = await column.querySelectorEval('a', '(element) => element.getAttribute("href")')
-                row_data.append(re.findall(r'horse/(\d*)', href)[0])
-            elif class_name in ['Jockey']:
-                href = await column.querySelectorEval('a', '(element) => element.getAttribute("href")')
-                row_data.append(re.findall(r'jockey/result/recent/(\w*)', href)[0])
-            elif class_name in ['Trainer']:
-                href = await column.querySelectorEval('a', '(element) => element.getAttribute("href")')
-                row_data.append(re.findall(r'trainer/result/recent/(\w*)', href)[0])
-            row_data.append(await page.evaluate('(element) => element.textContent', column))
+        for column in row:
+            pattern = ID_PATTERNS.get(column['className'])
+            if pattern is not None:
+                row_data.append(re.findall(pattern, column['href'])[0])
+            row_data.append(column['text'])
         data.append(row_data)
     return data
 
 
-async def extract_race_info(page):
-    race_data = await page.querySelector('.RaceList_Item02')
-    race_text = await page.evaluate('(element) => element.textContent', race_data)
+def _has_class(class_name):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')"
+
+
+def extract_race_card_from_html(root):
+    # EXTRACT_RACE_CARD_JSと同じ構造のデータをlxmlで作成する
+    rows = []
+    for row in root.xpath(f'//*[{_has_class("HorseList")}]'):
+        columns = []
+        for column in row.iter('td'):
+            class_name = column.get('class')
+            a = column.find('.//a') if class_name in ID_PATTERNS else None
+            columns.append({
+                'className': class_name,
+                'href': a.get('href') if a is not None else None,
+                'text': column.text_content(),
+            })
+        rows.append(columns)
+    race_data = root.xpath(f'//*[{_has_class("RaceList_Item02")}]')
+    return {'rows': rows, 'raceText': race_data[0].text_content() if race_data else None}
+
+
+def apply_odds(root, odds_json):
+    """
+    オッズAPIのレスポンスを出走表のオッズ・人気欄に反映する (ページのJSが行う処理と同じ)
+    オッズ発売前でデータがない場合は反映せず、ページの初期表示のままとする
+    """
+    odds = (odds_json.get('data') or {}).get('odds') or {}
+    for horse_number, values in (odds.get('1') or {}).items():
+        for prefix, value in (('odds', values[0]), ('ninki', values[2])):
+            span = root.get_element_by_id(f'{prefix}-1_{horse_number}', None)
+            if span is not None and value:
+                span.text = value
+
+
+def has_required_fields(result):
+    # process_horse_jockey_trainer_dataで参照する列と、各IDのリンクが揃っているか
+    if not result['rows'] or not result['raceText']:
+        return False
+    for row in result['rows']:
+        ids = [column for column in row if column['className'] in ID_PATTERNS]
+        if len(ids) != len(ID_PATTERNS) or any(column['href'] is None for column in ids):
+            return False
+        if len(row) + len(ids) < 14:
+            return False
+    return True
+
+
+def has_odds(data):
+    """
+    出走取消・競走除外以外の全ての馬に、数値のオッズ・人気が反映されているか
+    (オッズAPIのデータがない・形式が変わった場合は、ページの初期表示('---.-'・'**')のまま残る)
+    """
+    for row in data:
+        if any(marker in str(value) for value in row for marker in SCRATCHED_MARKERS):
+            continue
+        try:
+            float(row[ODDS_COLUMN].strip())
+            int(row[POPULARITY_COLUMN].strip())
+        except (ValueError, IndexError):
+            return False
+    return True
+
+
+def _decode(result, default_encoding):
+    content_type = {k.lower(): v for k, v in result.headers.items()}.get('content-type', '')
+    charset = re.findall(r'charset=([\w-]+)', content_type)
+    return result.text(charset[0] if charset else default_encoding)
+
+
+async def fetch_race_card_http(race_id, RACE_CARD_URL):
+    """
+    出走表をブラウザを使わずHTTPのみで取得する
+    必要な項目が揃わない場合はNoneを返す (呼び出し元でブラウザにフォールバックする)
+    """
+    url = RACE_CARD_URL + '?' + 'race_id=' + str(race_id)
+    odds_url = ODDS_API_URL + '?' + '&'.join([
+        'pid=api_get_jra_odds', 'input=UTF-8', 'output=json', 'race_id=' + str(race_id),
+        'type=1', 'action=init', 'compress=0',
+    ])
+    print(f'fetching: {url}')
+
+    async with AsyncFetcher(max_retries=2) as fetcher:
+        page_result, odds_result = await asyncio.gather(fetcher.fetch(url), fetcher.fetch(odds_url))
+
+    if page_result is None or page_result.status != 200:
+        print(f'Failed to fetch race card: {url}')
+        return None
+    if odds_result is None or odds_result.status != 200:
+        print(f'Failed to fetch odds: {odds_url}')
+        return None
+
+    try:
+        root = lxml.html.fromstring(_decode(page_result, 'EUC-JP'))
+        apply_odds(root, json.loads(_decode(odds_result, 'UTF-8')))
+        result = extract_race_card_from_html(root)
+    except Exception as e:
+        print(f'Failed to parse race card: {e}')
+        return None
+    if not has_required_fields(result):
+        print(f'Required fields are missing in race card: {url}')
+        return None
+
+    data = parse_horse_jockey_trainer_data(result['rows'])
+    if not has_odds(data):
+        print(f'Odds are missing in race card: {url}')
+        return None
+    race_info, race_title, hurdle_race_flg = parse_race_info(result['raceText'])
+    return data, race_info, race_title, hurdle_race_flg
+
+
+def parse_race_info(race_text):
     texts = re.findall(r'\w+', race_text)
 
     text_patterns = {
@@ -83,63 +250,28 @@ def process_horse_jockey_trainer_data(data):
     df.columns = ['frame_number', 'horse_number', 'horse_name', 'sex_age', 'carried_weight', 'odds', 'popularity', 'horse_weight', 'horse_id', 'jockey_id', 'jockey', 'trainer_id', 'trainer']
     return df
 
-async def scraping_race_card(race_id, race_date, RACE_CARD_URL):
+async def scraping_race_card(browser_pool, race_id, RACE_CARD_URL):
 
-    # ブラウザ起動
-    browser = await launch(
-        headless=True,
-        args = [
-            # '--user-agent=Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/116.0.0.0 Safari/537.36',
-            # "--start-maximized",
-        ],
-    )
-    print('Launched browser.')
+    query = [
+        'race_id=' + str(race_id)
+    ]
+    url = RACE_CARD_URL + '?' + '&'.join(query)
+    print(f'scraping: {url}')
 
-    try:
-        query = [
-            'race_id=' + str(race_id)
-        ]
-        url = RACE_CARD_URL + '?' + '&'.join(query)
-        print(f'scraping: {url}')
-
-        # 出走表Webページへアクセス
-        page = await browser.newPage()
+    # 出走表Webページへアクセス (ブラウザはBrowserPoolで起動済みのものを再利用)
+    async with browser_pool.page() as page:
         await page.goto(url, {'timeout': 180000})
-        await page.waitForSelector('.HorseList', {'visible': True}) 
-
-        data = await extract_horse_jockey_trainer_data(page)
-        race_info, race_title, hurdle_race_flg = await extract_race_info(page)
-        print(f'race_info: {race_info}')
-        print(f'race_title: {race_title}')
-        print(f'hurdle_race_flg: {hurdle_race_flg}')
-    except asyncio.TimeoutError:
-        print("Timeout error!")
-        return None
-    except Exception as e:
-        print(e)
-    finally:
-        # ページを閉じる
-        if 'page' in locals():  # pageが定義されている場合のみcloseする
-            await page.close()
+        await page.waitForSelector('.HorseList', {'visible': True})
 
-    await browser.close()
-    print('Closed browser.')
+        data, race_info, race_title, hurdle_race_flg = await extract_race_card(page)
+    print(f'race_info: {race_info}')
+    print(f'race_title: {race_title}')
+    print(f'hurdle_race_flg: {hurdle_race_flg}')
 
     return data, race_info, race_title, hurdle_race_flg
 
-if __name__ == "__main__":
-  
-    # コマンドライン引数から変数を取得
-    race_id = sys.argv[1]
-    race_date = sys.argv[2]
-    RACE_CARD_URL = sys.argv[3]
-    DOWNLOAD_FOLDER = sys.argv[4]
-
-    # race_id = '202410030801'
-    # race_date = '2024-07-21'
-    # RACE_CARD_URL = 'https://race.netkeiba.com/race/shutuba.html'
 
-    data, race_info, race_title, hurdle_race_flg = asyncio.run(scraping_race_card(race_id, race_date, RACE_CARD_URL))
+def build_race_card(race_id, race_date, data, race_info, race_title, hurdle_race_flg):
 
     # tableデータ作成
     df = process_horse_jockey_trainer_data(data)
@@ -158,7 +290,7 @@ if __name__ == "__main__":
         'course_length', 'weather', 'ground_condition', 'frame_number', 
         'horse_number', 'horse_id', 'horse_name', 'sex_age', 'carried_weight', 
         'jockey_id', 'jockey', 'odds', 'popularity', 
-        'horse_weight', 'trainer'
+        'horse_weight', 'trainer_id', 'trainer'
     ]
     df = df[new_order]
 
@@ -168,4 +300,42 @@ if __name__ == "__main__":
     df['popularity'] = df['popularity'].str.replace(r'[\n\t]', '', regex=True)
     df['horse_weight'] = df['horse_weight'].str.replace(r'[\n\t]', '', regex=True)
 
-    df.to_csv(f'{DOWNLOAD_FOLDER}/race_card.csv', index=False)
\ No newline at end of file
+    return infer_dtypes(df)
+
+
+def infer_dtypes(df):
+    # 数値のみからなる列を数値型に変換 (CSV経由で読み込んでいた頃のpd.read_csvの型推定と同じ結果にする)
+    for column in df.select_dtypes(include='object').columns:
+        values = df[column].str.strip().replace('', None)
+        converted = pd.to_numeric(values, errors='coerce')
+        if converted.notna().sum() == values.notna().sum():
+            df[column] = converted
+    return df
+
+
+async def get_race_card(browser_pool, race_id, race_date, RACE_CARD_URL):
+    # HTTPのみで取得し、必要な項目が揃わない場合のみブラウザで取得する
+    scraped = await fetch_race_card_http(race_id, RACE_CARD_URL)
+    fallback_stats.record(scraped is None)
+    if scraped is None:
+        scraped = await scraping_race_card(browser_pool, race_id, RACE_CARD_URL)
+    return build_race_card(race_id, race_date, *scraped)
+
+
+if __name__ == "__main__":
+  
+    # コマンドライン引数から変数を取得
+    race_id = sys.argv[1]
+    race_date = sys.argv[2]
+    RACE_CARD_URL = sys.argv[3]
+
+    # race_id = '202410030801'
+    # race_date = '2024-07-21'
+    # RACE_CARD_URL = 'https://race.netkeiba.com/race/shutuba.html'
+
+    browser_pool = BrowserPool()
+    try:
+        df = run(get_race_card(browser_pool, race_id, race_date, RACE_CARD_URL))
+        print(df)
+    finally:
+        run(browser_pool.close())
@@ -30,6 +30,43 @@ resource "google_storage_bucket" "race_results-archive" {
   storage_class               = "STANDARD"
   uniform_bucket_level_access = true
 }
+resource "google_storage_bucket" "scraping-http_cache" {
+  force_destroy               = true
+  location                    = var.region
+  name                        = "scraping-http_cache-prod-${var.project_number}"
+  project                     = var.project_id
+  public_access_prevention    = "inherited"
+  storage_class               = "STANDARD"
+  uniform_bucket_level_access = true
+  # HTTPレスポンスキャッシュの容量上限: 90日間更新のないキャッシュを削除
+  lifecycle_rule {
+    condition {
+      age = 90
+    }
+    action {
+      type = "Delete"
+    }
+  }
+}
+
+resource "google_storage_bucket" "scraping-crawl_state" {
+  force_destroy               = true
+  location                    = var.region
+  name                        = "scraping-crawl_state-prod-${var.project_number}"
+  project                     = var.project_id
+  public_access_prevention    = "inherited"
+  storage_class               = "STANDARD"
+  uniform_bucket_level_access = true
+  # 中断したクロールの再開用の状態: 30日間更新のない状態を削除
+  lifecycle_rule {
+    condition {
+      age = 30
+    }
+    action {
+      type = "Delete"
+    }
+  }
+}
 
 # BigQuery
 resource "google_bigquery_dataset" "race_results_raw_prod" {
@@ -60,6 +97,12 @@ resource "google_bigquery_table" "raw_horse_results" {
   schema              = file("${path.module}/bq_schema/raw_horse_results.json")
   description         = "馬ごとのレース結果詳細（データソース: netkeiba ネットケイバ）"
   deletion_protection = true
+  # 分割・クラスタ化の変更はテーブルの再作成になるため、既存テーブルは sql/migrate_partitioned_raw_tables.sql の手順で移行する
+  time_partitioning {
+    type  = "MONTH"
+    field = "date"
+  }
+  clustering = ["horse_id"]
 }
 resource "google_bigquery_table" "raw_race_results" {
   project             = var.project_id
@@ -68,6 +111,11 @@ resource "google_bigquery_table" "raw_race_results" {
   schema              = file("${path.module}/bq_schema/raw_race_results.json")
   description         = "レース結果（データソース: netkeiba ネットケイバ）"
   deletion_protection = true
+  time_partitioning {
+    type  = "MONTH"
+    field = "event_date"
+  }
+  clustering = ["race_id", "horse_id"]
 }
 resource "google_bigquery_table" "raw_race_return_all" {
   project             = var.project_id
@@ -76,6 +124,8 @@ resource "google_bigquery_table" "raw_race_return_all" {
   schema              = file("${path.module}/bq_schema/raw_race_return_all.json")
   description         = "払戻金情報（データソース: netkeiba ネットケイバ）"
   deletion_protection = true
+  # 日付の列がないため分割せず、race_idでクラスタ化する
+  clustering = ["race_id"]
 }
 resource "google_bigquery_table" "raw_speed_results" {
   project             = var.project_id
@@ -84,6 +134,7 @@ resource "google_bigquery_table" "raw_speed_results" {
   schema              = file("${path.module}/bq_schema/raw_speed_results.json")
   description         = "スピード指数（データソース: 個人Webサイト「競馬新聞&スピード指数」）"
   deletion_protection = true
+  clustering          = ["race_id"]
 }
 
 
@@ -94,7 +145,7 @@ data "archive_file" "src_gcf-scraping-race_results" {
   type        = "zip"
   source_dir  = "./modules/get-race_results/src_gcf-scraping-race_results"
   output_path = "./modules/tmp/src_gcf-scraping-race_results.zip"
-  excludes    = []
+  excludes    = ["bench_extractor.py", "backfill.py"]
 }
 ### GCFソースコードUpload https://registry.terraform.io/providers/hashicorp/google/latest/docs/resources/storage_bucket_object
 resource "google_storage_bucket_object" "src_gcf-scraping-race_results" {
@@ -126,12 +177,18 @@ resource "google_cloudfunctions2_function" "functions-scraping-race_results" {
     timeout_seconds                  = 3600
     max_instance_request_concurrency = 1
     environment_variables = {
-      EMAIL            = var.netkeiba_login_id
-      PASSWORD         = var.netkeiba_login_password
-      PROJECT_ID       = var.project_id
-      DST_BUCKET       = google_storage_bucket.race_results-landing.name
-      DOWNLOAD_FOLDER  = "/tmp"
-      LOG_EXECUTION_ID = "true"
+      EMAIL                 = var.netkeiba_login_id
+      PASSWORD              = var.netkeiba_login_password
+      PROJECT_ID            = var.project_id
+      DST_BUCKET            = google_storage_bucket.race_results-landing.name
+      DATASET_NAME          = google_bigquery_dataset.race_results_raw_prod.dataset_id
+      DOWNLOAD_FOLDER       = "/tmp"
+      HTTP_CACHE_BUCKET     = google_storage_bucket.scraping-http_cache.name
+      CRAWL_STATE_BUCKET    = google_storage_bucket.scraping-crawl_state.name
+      CALENDAR_CACHE_BUCKET = var.calendar_cache_bucket
+      LOG_EXECUTION_ID      = "true"
+      OUTPUT_FORMAT         = "parquet"
+      PARQUET_COMPRESSION   = "zstd"
     }
     service_account_email = local.service_account_email
   }
@@ -199,9 +256,13 @@ resource "google_cloudfunctions_function" "functions-bq_uploader" {
   docker_registry       = "ARTIFACT_REGISTRY"
   max_instances         = 5
   environment_variables = {
-    PROJECT_ID     = var.project_id
-    DATASET_NAME   = google_bigquery_dataset.race_results_raw_prod.dataset_id
-    ARCHIVE_BUCKET = google_storage_bucket.race_results-archive.name
+    PROJECT_ID               = var.project_id
+    DATASET_NAME             = google_bigquery_dataset.race_results_raw_prod.dataset_id
+    ARCHIVE_BUCKET           = google_storage_bucket.race_results-archive.name
+    LOAD_MODE                = "coalesce"
+    WRITE_MODE               = "upsert"
+    COALESCE_WINDOW_SECONDS  = "60"
+    FUNCTION_TIMEOUT_SECONDS = "540"
   }
 }
 
@@ -0,0 +1,61 @@
+-- 生データテーブルを分割・クラスタ化したテーブルへ移行し、重複行を除く (1回のみ実行)
+--
+-- 分割(time_partitioning)・クラスタ化(clustering)の追加はテーブルの再作成になり、
+-- deletion_protection = true のままでは terraform apply できないため、以下の手順で移行する
+--   1. bq_uploaderを停止する (またはランディングバケットへの出力がない時間帯に実施する)
+--   2. このファイルの「1. バックアップ」を実行する
+--   3. main.tf の4テーブルの deletion_protection を一時的に false にして terraform apply し、テーブルを再作成する
+--      (再作成後に deletion_protection を true に戻して再度 terraform apply する)
+--   4. このファイルの「2. 重複を除いて書き戻す」を実行する
+--   5. 件数を確認した後、「3. バックアップの削除」を実行する
+-- 自然キーは bq_uploader の FILE_TABLE_MAPPING の merge_keys と同じ
+-- 追記されたテーブルには取り込み順を表す列がないため、重複する行は値がNULLの列が少ない行を残し、
+-- 同じ場合は行の内容の順で決める (bq_uploader の build_merge_query と同じ。実行するたびに同じ行が残る)
+
+
+-- 1. バックアップ
+CREATE TABLE `race_results_raw_prod.raw_horse_results_backup` COPY `race_results_raw_prod.raw_horse_results`;
+CREATE TABLE `race_results_raw_prod.raw_race_results_backup` COPY `race_results_raw_prod.raw_race_results`;
+CREATE TABLE `race_results_raw_prod.raw_race_return_all_backup` COPY `race_results_raw_prod.raw_race_return_all`;
+CREATE TABLE `race_results_raw_prod.raw_speed_results_backup` COPY `race_results_raw_prod.raw_speed_results`;
+
+
+-- 2. 重複を除いて書き戻す
+INSERT INTO `race_results_raw_prod.raw_horse_results`
+SELECT * FROM `race_results_raw_prod.raw_horse_results_backup` AS R
+WHERE TRUE
+QUALIFY ROW_NUMBER() OVER (
+  PARTITION BY horse_id, date
+  ORDER BY ARRAY_LENGTH(REGEXP_EXTRACT_ALL(TO_JSON_STRING(R), r'":null')), TO_JSON_STRING(R) DESC
+) = 1;
+
+INSERT INTO `race_results_raw_prod.raw_race_results`
+SELECT * FROM `race_results_raw_prod.raw_race_results_backup` AS R
+WHERE TRUE
+QUALIFY ROW_NUMBER() OVER (
+  PARTITION BY race_id, horse_number
+  ORDER BY ARRAY_LENGTH(REGEXP_EXTRACT_ALL(TO_JSON_STRING(R), r'":null')), TO_JSON_STRING(R) DESC
+) = 1;
+
+INSERT INTO `race_results_raw_prod.raw_race_return_all`
+SELECT * FROM `race_results_raw_prod.raw_race_return_all_backup` AS R
+WHERE TRUE
+QUALIFY ROW_NUMBER() OVER (
+  PARTITION BY race_id, baken_types, horse_number
+  ORDER BY ARRAY_LENGTH(REGEXP_EXTRACT_ALL(TO_JSON_STRING(R), r'":null')), TO_JSON_STRING(R) DESC
+) = 1;
+
+INSERT INTO `race_results_raw_prod.raw_speed_results`
+SELECT * FROM `race_results_raw_prod.raw_speed_results_backup` AS R
+WHERE TRUE
+QUALIFY ROW_NUMBER() OVER (
+  PARTITION BY race_id, uma_ban
+  ORDER BY ARRAY_LENGTH(REGEXP_EXTRACT_ALL(TO_JSON_STRING(R), r'":null')), TO_JSON_STRING(R) DESC
+) = 1;
+
+
+-- 3. バックアップの削除
+-- DROP TABLE `race_results_raw_prod.raw_horse_results_backup`;
+-- DROP TABLE `race_results_raw_prod.raw_race_results_backup`;
+-- DROP TABLE `race_results_raw_prod.raw_race_return_all_backup`;
+-- DROP TABLE `race_results_raw_prod.raw_speed_results_backup`;
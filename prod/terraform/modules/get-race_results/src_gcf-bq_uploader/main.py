@@ -1,6 +1,12 @@
+import concurrent.futures
+import datetime
 import os
+import threading
+import time
 import traceback
+import uuid
 
+from google.api_core import exceptions as gapi_exceptions
 from google.cloud import bigquery
 from google.cloud import storage as gcs
 
@@ -11,23 +17,60 @@ from google.cloud import storage as gcs
 PROJECT_ID = os.environ.get("PROJECT_ID")
 DATASET_NAME = os.environ.get("DATASET_NAME")
 ARCHIVE_BUCKET = os.environ.get("ARCHIVE_BUCKET")
-SUPPORTED_CONTENT_TYPE = "text/csv"
+# ロード方式
+# per_file: イベントのファイルを1ファイルずつロードする
+# coalesce: 同じテーブル宛の未ロードのファイルをまとめて1つのロードジョブでロードする
+LOAD_MODE = os.environ.get("LOAD_MODE", "per_file")
+# coalesce: 最も古い未ロードのファイルの作成からこの秒数が経つまで、後続のファイルを待ってまとめる
+COALESCE_WINDOW_SECONDS = int(os.environ.get("COALESCE_WINDOW_SECONDS", 60))
+# coalesce: 未ロードのファイルの合計サイズがこのバイト数に達した場合は待たずにロードする
+COALESCE_MAX_BYTES = int(os.environ.get("COALESCE_MAX_BYTES", 1024 * 1024 * 1024))
+# coalesce: 1つのロードジョブでまとめるファイル数の上限 (BigQueryの上限は1ジョブあたり10,000 URI)
+COALESCE_MAX_FILES = int(os.environ.get("COALESCE_MAX_FILES", 1000))
+# coalesce: この秒数が経過した後は待たずにロードし、FUNCTION_TIMEOUT_SECONDSの60秒前には終了する
+COALESCE_SOFT_DEADLINE_SECONDS = int(os.environ.get("COALESCE_SOFT_DEADLINE_SECONDS", 360))
+FUNCTION_TIMEOUT_SECONDS = int(os.environ.get("FUNCTION_TIMEOUT_SECONDS", 540))
+# 書き込み方式
+# append: ロード先テーブルに追記する (write_disposition)
+# upsert: ステージングテーブルにロードし、merge_keysが一致する行を更新・それ以外の行を追加する (MERGE)
+WRITE_MODE = os.environ.get("WRITE_MODE", "append")
+# upsertで作成するステージングテーブル名の接頭辞 (ロード先と同じデータセットに作成し、MERGE後に削除する)
+STAGING_TABLE_PREFIX = "_staging_"
+# 1度にアーカイブ(コピー・削除)するファイル数
+ARCHIVE_WORKERS = int(os.environ.get("ARCHIVE_WORKERS", 16))
+# テーブル単位のロックの保存先 (ARCHIVE_BUCKET内。ロード先のバケットに置くと書き込みで関数が起動するため)
+LOCK_PREFIX = "_bq_uploader_locks/"
+# Content-Typeごとのロード形式
+SUPPORTED_CONTENT_TYPES = {
+    "text/csv": bigquery.SourceFormat.CSV,
+    "application/vnd.apache.parquet": bigquery.SourceFormat.PARQUET,
+}
+# merge_keys: upsertで行を一意に特定する列 (自然キー)
+# partition_field: ロード先テーブルの分割列 (MERGEで対象のパーティションのみ走査するために利用)
 FILE_TABLE_MAPPING = {
     "horse_results": {
         "table_name": "raw_horse_results",
         "write_disposition": "WRITE_APPEND",
+        "merge_keys": ["horse_id", "date"],
+        "partition_field": "date",
     },
     "race_results": {
         "table_name": "raw_race_results",
         "write_disposition": "WRITE_APPEND",
+        "merge_keys": ["race_id", "horse_number"],
+        "partition_field": "event_date",
     },
     "race_return_all": {
         "table_name": "raw_race_return_all",
         "write_disposition": "WRITE_APPEND",
+        "merge_keys": ["race_id", "baken_types", "horse_number"],
+        "partition_field": None,
     },
     "speed_results": {
         "table_name": "raw_speed_results",
         "write_disposition": "WRITE_APPEND",
+        "merge_keys": ["race_id", "uma_ban"],
+        "partition_field": None,
     },
 }
 
@@ -45,28 +88,187 @@ def _get_dst_table_info(filename):
     return None, None
 
 
-def _upload_to_bigquery(uri, filename, table_name, write_disposition):
+# テーブルのスキーマ (インスタンス内でキャッシュし、ロードのたびにget_tableを呼ばない)
+_schema_cache = {}
+_schema_cache_lock = threading.Lock()
+
+
+def _get_schema(table_id):
+    with _schema_cache_lock:
+        if table_id not in _schema_cache:
+            _schema_cache[table_id] = bq_client.get_table(
+                table_id
+            ).schema  # ref: https://cloud.google.com/python/docs/reference/bigquery/latest/google.cloud.bigquery.client.Client#google_cloud_bigquery_client_Client_get_table
+        return _schema_cache[table_id]
+
+
+def _get_table_config(table_name):
+    for value in FILE_TABLE_MAPPING.values():
+        if value["table_name"] == table_name:
+            return value
+    return {}
+
+
+def build_merge_query(table_id, staging_table_id, columns, merge_keys, partition_field=None):
+    """
+    ステージングテーブルの行をロード先テーブルにMERGEするクエリを作成する関数
+    ステージング内で自然キーが重複する行は1行にまとめ、キーが一致する行は更新・それ以外は追加する
+    (重複する行は値がNULLの列が少ない行を残し、同じ場合は行の内容の順で決める。
+    複数のファイルにまたがる重複は_upload_to_bigqueryで1ファイルずつMERGEし直すため、ここでは1ファイル内の重複のみ)
+    partition_fieldを指定した場合は、ステージングの値の範囲(@partition_min - @partition_max)と
+    NULLのパーティションのみを走査する
+
+    Parameters:
+    ----------
+    table_id : str
+        ロード先テーブル
+    staging_table_id : str
+        ステージングテーブル
+    columns : list
+        テーブルの列名
+    merge_keys : list
+        自然キーの列名
+    partition_field : str
+        ロード先テーブルの分割列
+
+    Returns:
+    ----------
+    query : str
+    """
+    keys = ", ".join(f"`{key}`" for key in merge_keys)
+    conditions = [f"T.`{key}` IS NOT DISTINCT FROM S.`{key}`" for key in merge_keys]
+    if partition_field:
+        conditions.append(
+            f"(T.`{partition_field}` BETWEEN @partition_min AND @partition_max"
+            f" OR T.`{partition_field}` IS NULL)"
+        )
+    on = "\n  AND ".join(conditions)
+    updates = ",\n    ".join(
+        f"`{column}` = S.`{column}`" for column in columns if column not in merge_keys
+    )
+    return f"""MERGE `{table_id}` T
+USING (
+  SELECT * FROM `{staging_table_id}` AS R
+  WHERE TRUE
+  QUALIFY ROW_NUMBER() OVER (
+    PARTITION BY {keys}
+    ORDER BY ARRAY_LENGTH(REGEXP_EXTRACT_ALL(TO_JSON_STRING(R), r'":null')), TO_JSON_STRING(R) DESC
+  ) = 1
+) S
+ON {on}
+WHEN MATCHED THEN
+  UPDATE SET
+    {updates}
+WHEN NOT MATCHED THEN
+  INSERT ROW"""
+
+
+def _has_duplicate_keys(staging_table_id, merge_keys):
+    """ステージングテーブルに自然キーが重複する行があるか"""
+    keys = ", ".join(f"`{key}`" for key in merge_keys)
+    row = next(
+        iter(
+            bq_client.query(
+                f"SELECT COUNT(*) AS duplicates FROM ("
+                f"SELECT {keys} FROM `{staging_table_id}` GROUP BY {keys} HAVING COUNT(*) > 1)"
+            ).result()
+        )
+    )
+    return row["duplicates"] > 0
+
+
+def _merge_from_staging(table_id, staging_table_id, schema, merge_keys, partition_field):
+    """ステージングテーブルの行をロード先テーブルにMERGEし、影響を受けた行数を返す"""
+    query_parameters = []
+    if partition_field:
+        # ステージングに含まれる分割列の値の範囲 (すべてNULLの場合はNULLのパーティションのみ走査する)
+        row = next(
+            iter(
+                bq_client.query(
+                    f"SELECT MIN(`{partition_field}`) AS partition_min, MAX(`{partition_field}`) AS partition_max"
+                    f" FROM `{staging_table_id}`"
+                ).result()
+            )
+        )
+        field_type = next(field.field_type for field in schema if field.name == partition_field)
+        query_parameters = [
+            bigquery.ScalarQueryParameter("partition_min", field_type, row["partition_min"]),
+            bigquery.ScalarQueryParameter("partition_max", field_type, row["partition_max"]),
+        ]
+    query = build_merge_query(
+        table_id,
+        staging_table_id,
+        [field.name for field in schema],
+        merge_keys,
+        partition_field,
+    )
+    query_job = bq_client.query(
+        query, job_config=bigquery.QueryJobConfig(query_parameters=query_parameters)
+    )
+    query_job.result()
+    return query_job.num_dml_affected_rows
+
+
+def _upload_to_bigquery(uri, filename, table_name, write_disposition, source_format):
+    """
+    1つ(uri: str)または複数(uri: list)のファイルを1つのロードジョブでBigQueryにロードする
+    WRITE_MODEがupsertの場合はステージングテーブルにロードしてからロード先テーブルにMERGEする
+    複数のファイルに同じ自然キーの行がある場合(馬の再取得・再送したパートファイルなど)は、
+    どのファイルの行を残すかが決まらないためMERGEせずにFalseを返す
+    (_load_batchが作成順に1ファイルずつロードし直し、後に作成されたファイルの行で更新する)
+    """
 
     try:
         # BigQueryロードジョブ設定
         table_id = f"{PROJECT_ID}.{DATASET_NAME}.{table_name}"
-        schema = bq_client.get_table(
-            table_id
-        ).schema  # ref: https://cloud.google.com/python/docs/reference/bigquery/latest/google.cloud.bigquery.client.Client#google_cloud_bigquery_client_Client_get_table
+        schema = _get_schema(table_id)
+        table_config = _get_table_config(table_name)
+        merge_keys = table_config.get("merge_keys") if WRITE_MODE == "upsert" else None
+        if merge_keys:
+            load_table_id = f"{PROJECT_ID}.{DATASET_NAME}.{STAGING_TABLE_PREFIX}{table_name}_{uuid.uuid4().hex[:12]}"
+        else:
+            load_table_id = table_id
         job_config = bigquery.LoadJobConfig(
             # Properties: https://cloud.google.com/python/docs/reference/bigquery/latest/google.cloud.bigquery.job.LoadJobConfig
-            source_format=bigquery.SourceFormat.CSV,
-            skip_leading_rows=1,
+            source_format=source_format,
             max_bad_records=0,
-            write_disposition=write_disposition,
+            write_disposition="WRITE_TRUNCATE" if merge_keys else write_disposition,
             schema=schema,
         )
+        # CSVはヘッダ行を読み飛ばし列の位置で、Parquetは列名でスキーマの列に対応付けられる
+        if source_format == bigquery.SourceFormat.CSV:
+            job_config.skip_leading_rows = 1
 
-        # BigQueryへのデータアップロード実行
-        load_job = bq_client.load_table_from_uri(
-            uri, table_id, job_config=job_config
-        )  # ref: https://cloud.google.com/python/docs/reference/bigquery/latest/google.cloud.bigquery.client.Client#google_cloud_bigquery_client_Client_load_table_from_uri
-        load_job.result()
+        try:
+            # BigQueryへのデータアップロード実行
+            load_job = bq_client.load_table_from_uri(
+                uri, load_table_id, job_config=job_config
+            )  # ref: https://cloud.google.com/python/docs/reference/bigquery/latest/google.cloud.bigquery.client.Client#google_cloud_bigquery_client_Client_load_table_from_uri
+            load_job.result()
+            if (
+                merge_keys
+                and isinstance(uri, list)
+                and len(uri) > 1
+                and _has_duplicate_keys(load_table_id, merge_keys)
+            ):
+                print(
+                    f"Duplicate natural keys across files in '{filename}'. Files will be merged one by one in creation order."
+                )
+                return False
+            if merge_keys:
+                affected_rows = _merge_from_staging(
+                    table_id,
+                    load_table_id,
+                    schema,
+                    merge_keys,
+                    table_config.get("partition_field"),
+                )
+                print(
+                    f"Merged {load_job.output_rows} rows into '{table_id}' ({affected_rows} rows affected)."
+                )
+        finally:
+            if merge_keys:
+                bq_client.delete_table(load_table_id, not_found_ok=True)
         print(
             f"File name: '{filename}' was successfully uploaded to BigQuery. (job_id: '{load_job.job_id}')"
         )
@@ -93,6 +295,156 @@ def _archive_src_obeject(filename, src_bucket_name):
     )
 
 
+def _archive_src_objects(filenames, src_bucket_name):
+    """ロードしたファイルを並行にアーカイブ(コピー・削除)する"""
+    with concurrent.futures.ThreadPoolExecutor(ARCHIVE_WORKERS) as executor:
+        futures = {
+            executor.submit(_archive_src_obeject, filename, src_bucket_name): filename
+            for filename in filenames
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to archive '{futures[future]}': {e}")
+
+
+def _list_pending_blobs(src_bucket_name, file_prefix, exclude=()):
+    """ロード先のバケットに残っている、file_prefixで始まる未ロードのファイルを作成順に返す"""
+    blobs = [
+        blob
+        for blob in gcs_client.list_blobs(src_bucket_name, prefix=file_prefix)
+        if blob.content_type in SUPPORTED_CONTENT_TYPES and blob.name not in exclude
+    ]
+    return sorted(blobs, key=lambda blob: (blob.time_created, blob.name))
+
+
+def _acquire_lock(file_prefix):
+    """
+    テーブル単位のロックを取得する (ロックのオブジェクトが存在しない場合のみ作成できる)
+    関数のタイムアウトを過ぎても残っているロックは、異常終了したインスタンスのものとして削除する
+    """
+    blob = gcs_client.bucket(ARCHIVE_BUCKET).blob(f"{LOCK_PREFIX}{file_prefix}.lock")
+    for _ in range(2):
+        try:
+            blob.upload_from_string("", if_generation_match=0)
+            return blob
+        except gapi_exceptions.PreconditionFailed:
+            existing = gcs_client.bucket(ARCHIVE_BUCKET).get_blob(blob.name)
+            if existing is None:
+                continue
+            age = datetime.datetime.now(datetime.timezone.utc) - existing.time_created
+            if age.total_seconds() < FUNCTION_TIMEOUT_SECONDS:
+                return None
+            print(f"Removing stale lock '{existing.name}' (age: {age})")
+            try:
+                existing.delete(if_generation_match=existing.generation)
+            except gapi_exceptions.GoogleAPICallError:
+                return None
+    return None
+
+
+def _release_lock(lock_blob):
+    try:
+        lock_blob.delete(if_generation_match=lock_blob.generation)
+    except gapi_exceptions.GoogleAPICallError as e:
+        print(f"Failed to release lock '{lock_blob.name}': {e}")
+
+
+def _wait_for_window(src_bucket_name, file_prefix, started_at, exclude=()):
+    """
+    最も古い未ロードのファイルの作成からCOALESCE_WINDOW_SECONDSが経つか、
+    合計サイズがCOALESCE_MAX_BYTESに達するまで待ち、その時点の未ロードのファイルを返す
+    """
+    while True:
+        blobs = _list_pending_blobs(src_bucket_name, file_prefix, exclude)
+        if not blobs:
+            return blobs
+        age = datetime.datetime.now(datetime.timezone.utc) - blobs[0].time_created
+        remaining = COALESCE_WINDOW_SECONDS - age.total_seconds()
+        if (
+            remaining <= 0
+            or sum(blob.size or 0 for blob in blobs) >= COALESCE_MAX_BYTES
+            or time.monotonic() - started_at >= COALESCE_SOFT_DEADLINE_SECONDS
+        ):
+            return blobs
+        time.sleep(min(remaining, 5))
+
+
+def _load_batch(blobs, src_bucket_name, table_name, write_disposition):
+    """
+    未ロードのファイルをファイル形式ごと・COALESCE_MAX_FILESごとに1つのロードジョブでロードし、
+    ロードしたファイルをまとめてアーカイブする
+    まとめたロードに失敗した場合は、正常なファイルだけでもロードするため1ファイルずつロードし直す
+    (ファイル間で自然キーが重複する場合も、作成順に1ファイルずつロードし直す)
+
+    Returns:
+    ----------
+    failed : list
+        ロードに失敗したファイル名 (ロード先のバケットに残る)
+    """
+    failed = []
+    groups = {}
+    for blob in blobs:
+        groups.setdefault(SUPPORTED_CONTENT_TYPES[blob.content_type], []).append(blob.name)
+
+    for source_format, filenames in groups.items():
+        for i in range(0, len(filenames), COALESCE_MAX_FILES):
+            chunk = filenames[i : i + COALESCE_MAX_FILES]
+            uris = [f"gs://{src_bucket_name}/{filename}" for filename in chunk]
+            label = chunk[0] if len(chunk) == 1 else f"{chunk[0]} (+{len(chunk) - 1} files)"
+            if _upload_to_bigquery(uris, label, table_name, write_disposition, source_format):
+                _archive_src_objects(chunk, src_bucket_name)
+                continue
+            if len(chunk) == 1:
+                failed.extend(chunk)
+                continue
+            print(f"Retrying {len(chunk)} files one by one. ({label})")
+            loaded = [
+                filename
+                for filename, uri in zip(chunk, uris)
+                if _upload_to_bigquery(
+                    uri, filename, table_name, write_disposition, source_format
+                )
+            ]
+            _archive_src_objects(loaded, src_bucket_name)
+            failed.extend(filename for filename in chunk if filename not in loaded)
+    return failed
+
+
+def _coalesce_and_load(src_bucket_name, file_prefix, table_name, write_disposition):
+    """
+    同じテーブル宛の未ロードのファイルをまとめてロードする
+    ロックを取得できなかった(別のインスタンスがロード中の)場合は、そのインスタンスに任せて終了する
+    ロックを解放した後に未ロードのファイルが残っていれば、再度ロックを取得して続ける
+    (ロック中に到着したファイルのイベントは何もせず終了するため、ロックを持つ側で拾う)
+    ロードに失敗したファイルは、この起動の間は再試行しない
+    """
+    started_at = time.monotonic()
+    failed = set()
+    while True:
+        lock_blob = _acquire_lock(file_prefix)
+        if lock_blob is None:
+            print(f"Another instance is loading '{file_prefix}' files.")
+            return
+        try:
+            blobs = _wait_for_window(src_bucket_name, file_prefix, started_at, failed)
+            if blobs:
+                failed.update(
+                    _load_batch(blobs, src_bucket_name, table_name, write_disposition)
+                )
+        finally:
+            _release_lock(lock_blob)
+
+        if not _list_pending_blobs(src_bucket_name, file_prefix, failed):
+            return
+        if time.monotonic() - started_at >= FUNCTION_TIMEOUT_SECONDS - 60:
+            print(
+                f"Pending '{file_prefix}' files are left for the next event (time budget exceeded)."
+            )
+            return
+
+
 # Entry Point
 def bq_uploader(event, context):
 
@@ -104,7 +456,8 @@ def bq_uploader(event, context):
     print(f"Source URI: '{uri}'")
 
     # ファイル形式判定
-    if content_type != SUPPORTED_CONTENT_TYPE:
+    source_format = SUPPORTED_CONTENT_TYPES.get(content_type)
+    if not source_format:
         print(f"'{content_type}' is not supported file type. (File name: '{filename}')")
         return
 
@@ -114,8 +467,15 @@ def bq_uploader(event, context):
         print(f"Undefined file name: '{filename}'")
         return
 
+    if LOAD_MODE == "coalesce":
+        file_prefix = next(key for key in FILE_TABLE_MAPPING if filename.startswith(key))
+        _coalesce_and_load(src_bucket_name, file_prefix, table_name, write_disposition)
+        return
+
     # BigQuery宛先テーブルデータアップロード
-    upload_success = _upload_to_bigquery(uri, filename, table_name, write_disposition)
+    upload_success = _upload_to_bigquery(
+        uri, filename, table_name, write_disposition, source_format
+    )
 
     # Cloud Storge ソースファイルのアーカイブと削除
     if upload_success:
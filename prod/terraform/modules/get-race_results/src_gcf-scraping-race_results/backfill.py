@@ -0,0 +1,219 @@
+"""
+過去期間のレース結果の一括取得(バックフィル)
+
+取得対象期間を月または開催日ごとのシャードに分割し、シャードごとにmain.run_crawlを複数プロセスで並行に実行する
+馬の過去成績は同じ馬が複数のシャードに出走するため、全シャードのレース結果を取得した後に
+馬IDの順に一定数ずつのシャードに分割して1頭につき1回だけ取得する
+
+- レート制限: 各プロセスのホストごとのレート制限を (既定値 / プロセス数) に設定し、全体で既定値を超えないようにする
+- 中断・再開: シャードごとにクロール状態を保存するため、同じ期間で再実行すると未完了の分のみを取得する
+- 出力: DST_BUCKETが設定されている場合は封印したパートファイルから順にCloud Storageへ転送する
+        未設定の場合はシャードごとのパートファイルを、シャード順・ファイル名順に連結して
+        <output_dir>/<file_prefix>_<from>_<to>.(parquet|csv) に出力する (実行ごとに同じ順序になる)
+
+usage:
+    python backfill.py <from yyyy-mm-dd> <to yyyy-mm-dd> <output_dir> [month|kaisai_date] [workers]
+"""
+
+import concurrent.futures
+import datetime
+import glob
+import logging
+import multiprocessing
+import os
+import sys
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# シャードの分割単位
+SHARD_UNITS = ("month", "kaisai_date")
+# 馬の過去成績のシャード1つあたりの馬の数
+HORSE_SHARD_SIZE = 2000
+# 出力ファイル名の接頭辞 (bq_uploaderのFILE_TABLE_MAPPINGと同じ)
+FILE_PREFIXES = ["race_results", "race_return_all", "speed_results", "horse_results"]
+
+
+def make_month_shards(from_str, to_str):
+    """取得対象期間を月ごとの(開始日, 終了日)に分割する"""
+    start = pd.Timestamp(from_str)
+    end = pd.Timestamp(to_str)
+    shards = []
+    for month_start in pd.date_range(start.replace(day=1), end, freq="MS"):
+        month_end = month_start + pd.offsets.MonthEnd(0)
+        shards.append(
+            (
+                max(month_start, start).strftime("%Y-%m-%d"),
+                min(month_end, end).strftime("%Y-%m-%d"),
+            )
+        )
+    return shards
+
+
+def make_kaisai_date_shards(from_str, to_str):
+    """取得対象期間を開催日ごとの(開始日, 終了日)に分割する"""
+    from main import get_kaisai_date
+
+    kaisai_date_list = sorted(set(get_kaisai_date(from_str, to_str)))
+    dates = [f"{d[:4]}-{d[4:6]}-{d[6:]}" for d in kaisai_date_list]
+    return [(d, d) for d in dates]
+
+
+def make_shards(from_str, to_str, unit="month"):
+    if unit == "month":
+        return make_month_shards(from_str, to_str)
+    if unit == "kaisai_date":
+        return make_kaisai_date_shards(from_str, to_str)
+    raise ValueError(f"Unsupported shard unit: {unit} (expected one of {SHARD_UNITS})")
+
+
+def _init_shard_process(shard_dir, output_dir, workers):
+    """
+    シャードを実行するプロセスの環境設定
+    mainは環境変数を読み込み時に参照するため、設定後にimportする
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    os.environ["DOWNLOAD_FOLDER"] = shard_dir
+    # HTTPキャッシュ・クロール状態はシャード間で共有する (GCSのバケットが設定されている場合はそちらを優先)
+    os.environ.setdefault("HTTP_CACHE_DIR", os.path.join(output_dir, "http_cache"))
+    os.environ.setdefault("CRAWL_STATE_DIR", os.path.join(output_dir, "crawl_state"))
+
+    import fetcher
+
+    # 全プロセスの合計で既定のレート制限を超えないよう、プロセス数で按分する
+    for host, (rate, capacity) in fetcher.DEFAULT_RATE_LIMITS.items():
+        fetcher.configure_rate_limit(host, rate / workers, capacity)
+
+
+def _run_race_shard(shard, output_dir, today_str, workers):
+    from_str, to_str = shard
+    _init_shard_process(os.path.join(output_dir, f"{from_str}_{to_str}"), output_dir, workers)
+    import main
+
+    return main.run_crawl(from_str, to_str, today_str, include_horses=False)
+
+
+def _run_horse_shard(shard_name, horse_last_race_dates, output_dir, today_str, workers):
+    _init_shard_process(os.path.join(output_dir, shard_name), output_dir, workers)
+    import main
+    from crawl_state import CrawlState
+
+    state = CrawlState.load(shard_name)
+    main.get_horse_results(horse_last_race_dates, today_str, state)
+    logger.info(f"{shard_name}: {state.summary()}")
+
+
+def _run_pool(func, tasks, workers):
+    """
+    タスクを複数プロセスで実行し、タスク順に結果を返す (失敗したタスクの結果はNone)
+    シャードごとに新しいプロセスで実行し、環境変数・レート制限の設定をシャード間で持ち越さない
+    """
+    results = [None] * len(tasks)
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(
+        workers, mp_context=context, max_tasks_per_child=1
+    ) as executor:
+        futures = {executor.submit(func, *args): i for i, args in enumerate(tasks)}
+        for future in concurrent.futures.as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                logger.error(f"Shard {tasks[i][0]} failed: {e}")
+    return results
+
+
+def merge_shard_outputs(output_dir, shard_names, from_str, to_str):
+    """
+    シャードごとのパートファイルを、シャード順・ファイル名順に連結して出力する関数
+
+    Returns:
+    ----------
+    paths : list
+        出力したファイルのパス
+    """
+    from main import OUTPUT_FORMAT, PARQUET_COMPRESSION
+    from table_writer import OUTPUT_FORMATS, merge_part_files
+
+    extension = OUTPUT_FORMATS[OUTPUT_FORMAT]["extension"]
+    paths = []
+    for file_prefix in FILE_PREFIXES:
+        part_paths = [
+            part_path
+            for shard_name in shard_names
+            for part_path in sorted(
+                glob.glob(os.path.join(output_dir, shard_name, f"{file_prefix}_*{extension}"))
+            )
+        ]
+        if not part_paths:
+            continue
+        path = os.path.join(output_dir, f"{file_prefix}_{from_str}_{to_str}{extension}")
+        merge_part_files(part_paths, path, OUTPUT_FORMAT, PARQUET_COMPRESSION)
+        logger.info(f"Merged {len(part_paths)} part files into {path}")
+        paths.append(path)
+    return paths
+
+
+def run_backfill(from_str, to_str, output_dir, unit="month", workers=4):
+    """
+    指定期間のレース結果・払い戻し表・スピード指数・馬の過去成績を一括取得する関数
+
+    Parameters:
+    ----------
+    from_str : str
+        取得対象期間の開始日(yyyy-mm-dd)
+    to_str : str
+        取得対象期間の終了日(yyyy-mm-dd)
+    output_dir : str
+        シャードごとの出力・連結したファイルの出力先ディレクトリ
+    unit : str
+        シャードの分割単位 ("month" または "kaisai_date")
+    workers : int
+        並行に実行するプロセス数
+
+    Returns:
+    ----------
+    paths : list
+        連結して出力したファイルのパス (Cloud Storageへ転送した場合は空)
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    today_str = datetime.date.today().strftime("%Y%m%d")
+
+    # レース結果・払い戻し表・スピード指数 (期間のシャードごと)
+    shards = make_shards(from_str, to_str, unit)
+    logger.info(f"Backfill {from_str} - {to_str}: {len(shards)} shards, {workers} workers")
+    results = _run_pool(
+        _run_race_shard, [(shard, output_dir, today_str, workers) for shard in shards], workers
+    )
+
+    # 馬の過去成績 (全シャードの出走馬を馬IDの順に分割)
+    horse_last_race_dates = {}
+    for shard_dates in results:
+        for horse_id, event_date in (shard_dates or {}).items():
+            if event_date > horse_last_race_dates.get(horse_id, ""):
+                horse_last_race_dates[horse_id] = event_date
+    horse_ids = sorted(horse_last_race_dates)
+    horse_tasks = []
+    for i in range(0, len(horse_ids), HORSE_SHARD_SIZE):
+        shard_name = f"horses_{from_str}_{to_str}_{i // HORSE_SHARD_SIZE:04d}"
+        chunk = {h: horse_last_race_dates[h] for h in horse_ids[i : i + HORSE_SHARD_SIZE]}
+        horse_tasks.append((shard_name, chunk, output_dir, today_str, workers))
+    logger.info(f"Horse results: {len(horse_ids)} horses, {len(horse_tasks)} shards")
+    _run_pool(_run_horse_shard, horse_tasks, workers)
+
+    shard_names = [f"{f}_{t}" for f, t in shards] + [task[0] for task in horse_tasks]
+    return merge_shard_outputs(output_dir, shard_names, from_str, to_str)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    run_backfill(
+        sys.argv[1],
+        sys.argv[2],
+        sys.argv[3],
+        sys.argv[4] if len(sys.argv) > 4 else "month",
+        int(sys.argv[5]) if len(sys.argv) > 5 else 4,
+    )
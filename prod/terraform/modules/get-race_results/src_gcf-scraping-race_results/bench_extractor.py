@@ -0,0 +1,111 @@
+"""
+抽出レイヤ(extractor.py)と従来のBeautifulSoup + pd.read_htmlによる抽出の速度比較
+
+保存済みのHTMLを以下の構成で配置して実行する (ファイルはEUC-JPのまま保存)
+    <fixture_dir>/race/*.html   : https://db.netkeiba.com/race/<race_id> のページ
+    <fixture_dir>/horse/*.html  : https://db.netkeiba.com/horse/<horse_id> のページ
+
+usage:
+    python bench_extractor.py <fixture_dir> [repeat]
+"""
+
+import glob
+import io
+import os
+import sys
+import time
+
+import pandas as pd
+from bs4 import BeautifulSoup
+
+from extractor import (
+    extract_horse_results,
+    extract_pay_tables,
+    extract_race_info,
+    extract_race_results,
+    parse_html,
+)
+
+
+def legacy_race_page(html):
+    soup = BeautifulSoup(html, "html.parser")
+    table = soup.find("table", class_="race_table_01")
+    df = pd.read_html(io.StringIO(str(table)))[0]
+    soup.find(class_="racedata fc").find("h1").text
+    soup.find(class_="racedata fc").find("span").contents[0]
+    soup.find(class_="smalltxt").contents[0]
+    results_table = soup.find("table", attrs={"summary": "レース結果"})
+    results_table.find_all("a", attrs={"href": lambda h: h and h.startswith("/horse")})
+    results_table.find_all("a", attrs={"href": lambda h: h and h.startswith("/jockey")})
+    # 払い戻し表は従来別リクエストで取得・パースしていた
+    pay_soup = BeautifulSoup(html.replace("<br />", "br"), "html.parser")
+    pay_tables = [
+        pd.read_html(io.StringIO(str(table)))[0]
+        for table in pay_soup.find_all("table", class_="pay_table_01")
+    ]
+    return df, pay_tables
+
+
+def new_race_page(html):
+    root = parse_html(html)
+    df, _, _ = extract_race_results(root)
+    extract_race_info(root)
+    return df, extract_pay_tables(root)
+
+
+def legacy_horse_page(content):
+    df_list = pd.read_html(io.BytesIO(content), encoding="euc-jp")
+    df = df_list[3]
+    if df.columns[0] == "受賞歴":
+        df = df_list[4]
+    return df
+
+
+def new_horse_page(content):
+    return extract_horse_results(parse_html(content.decode("EUC-JP", errors="replace")))
+
+
+def _bench(name, func, inputs, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for x in inputs:
+            func(x)
+    elapsed = time.perf_counter() - start
+    per_page_ms = elapsed / (repeat * len(inputs)) * 1000
+    print(f"{name:<24} {per_page_ms:8.2f} ms/page")
+    return per_page_ms
+
+
+def main(fixture_dir, repeat=3):
+    race_pages = [
+        open(path, "rb").read().decode("EUC-JP", errors="replace")
+        for path in sorted(glob.glob(os.path.join(fixture_dir, "race", "*.html")))
+    ]
+    horse_pages = [
+        open(path, "rb").read()
+        for path in sorted(glob.glob(os.path.join(fixture_dir, "horse", "*.html")))
+    ]
+
+    if race_pages:
+        # 抽出結果が従来と一致することを確認
+        for html in race_pages:
+            legacy_df, legacy_pay = legacy_race_page(html)
+            new_df, new_pay = new_race_page(html)
+            assert legacy_df.equals(new_df)
+            assert all(a.equals(b) for a, b in zip(legacy_pay, new_pay))
+        print(f"race pages: {len(race_pages)}")
+        legacy = _bench("legacy (bs4+read_html)", legacy_race_page, race_pages, repeat)
+        new = _bench("extractor (lxml)", new_race_page, race_pages, repeat)
+        print(f"speedup: x{legacy / new:.1f}")
+
+    if horse_pages:
+        for content in horse_pages:
+            assert legacy_horse_page(content).equals(new_horse_page(content))
+        print(f"horse pages: {len(horse_pages)}")
+        legacy = _bench("legacy (read_html)", legacy_horse_page, horse_pages, repeat)
+        new = _bench("extractor (lxml)", new_horse_page, horse_pages, repeat)
+        print(f"speedup: x{legacy / new:.1f}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 3)
@@ -0,0 +1,278 @@
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# 環境変数取得
+# CRAWL_STATE_BUCKETが設定されている場合はGCS、それ以外はローカルディレクトリに保存する
+CRAWL_STATE_DIR = os.environ.get(
+    "CRAWL_STATE_DIR",
+    os.path.join(os.environ.get("DOWNLOAD_FOLDER") or "/tmp", "crawl_state"),
+)
+CRAWL_STATE_BUCKET = os.environ.get("CRAWL_STATE_BUCKET")
+# 取得に失敗したIDを再試行する回数の上限
+CRAWL_MAX_ATTEMPTS = int(os.environ.get("CRAWL_MAX_ATTEMPTS", 3))
+
+# IDごとの状態
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+
+class LocalStateStore:
+    """ローカルディレクトリにクロール状態(JSON)を保存するストア"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, crawl_id):
+        return os.path.join(self.directory, f"{crawl_id}.json")
+
+    def load(self, crawl_id):
+        try:
+            with open(self._path(crawl_id), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def save(self, crawl_id, manifest):
+        # 書き込み途中で中断されても前回の状態が残るよう、一時ファイルから置き換える
+        path = self._path(crawl_id)
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(path + ".tmp", path)
+
+
+class GCSStateStore:
+    """
+    GCSバケットにクロール状態(JSON)を保存するストア
+    Cloud Functionsの/tmpはインスタンス終了で消えるため、本番ではこちらを利用する
+    """
+
+    def __init__(self, bucket_name, prefix="crawl_state/"):
+        # google-cloud-storageはGCSを利用する関数でのみ必要なため、ここでimportする
+        from google.cloud import storage as gcs
+
+        self.bucket = gcs.Client().bucket(bucket_name)
+        self.prefix = prefix
+
+    def load(self, crawl_id):
+        blob = self.bucket.get_blob(f"{self.prefix}{crawl_id}.json")
+        if blob is None:
+            return None
+        return json.loads(blob.download_as_text())
+
+    def save(self, crawl_id, manifest):
+        blob = self.bucket.blob(f"{self.prefix}{crawl_id}.json")
+        blob.upload_from_string(json.dumps(manifest), content_type="application/json")
+
+
+def get_default_store():
+    """環境変数の設定に応じたストアを返す"""
+    if CRAWL_STATE_BUCKET:
+        return GCSStateStore(CRAWL_STATE_BUCKET)
+    return LocalStateStore(CRAWL_STATE_DIR)
+
+
+class CrawlState:
+    """
+    1回のクロール(取得対象期間)の進捗を、タスク(race_results, horse_results など)・IDごとに保持するクラス
+    タイムアウト等で中断した場合も、同じcrawl_idで読み込み直すことで未完了のIDのみを再開できる
+
+    manifestの形式:
+        {
+            "crawl_id": str,
+            "values": {任意のkey: 値 (取得対象のレースIDなど)},
+            "tasks": {タスク名: {ID: {"status": "pending"|"done"|"failed", "attempts": int, "error": str}}},
+            "updated_at": float,
+        }
+
+    Parameters:
+    ----------
+    store : LocalStateStore or GCSStateStore
+        状態の保存先
+    crawl_id : str
+        クロールの識別子
+    manifest : dict
+        保存済みの状態 (新規の場合はNone)
+    max_attempts : int
+        失敗したIDを再試行する回数の上限
+    """
+
+    def __init__(self, store, crawl_id, manifest=None, max_attempts=CRAWL_MAX_ATTEMPTS):
+        self.store = store
+        self.crawl_id = crawl_id
+        self.max_attempts = max_attempts
+        self.manifest = manifest or {"crawl_id": crawl_id, "values": {}, "tasks": {}}
+        self._lock = threading.RLock()
+
+    @classmethod
+    def load(cls, crawl_id, store=None):
+        store = store or get_default_store()
+        manifest = store.load(crawl_id)
+        if manifest is not None:
+            logger.info(f"Resuming crawl '{crawl_id}' (updated at {manifest.get('updated_at')})")
+        return cls(store, crawl_id, manifest)
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self.manifest["values"].get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self.manifest["values"][key] = value
+
+    def update(self, key, mapping):
+        """辞書型の値にmappingを追加・上書きする"""
+        with self._lock:
+            self.manifest["values"].setdefault(key, {}).update(mapping)
+
+    def _items(self, task):
+        return self.manifest["tasks"].setdefault(task, {})
+
+    def pending(self, task, ids):
+        """
+        idsのうち未完了のIDを返す (未登録のIDは登録する)
+        再試行回数の上限に達したIDは除外する
+        """
+        with self._lock:
+            items = self._items(task)
+            pending_ids = []
+            for item_id in ids:
+                item = items.setdefault(item_id, {"status": PENDING, "attempts": 0})
+                if item["status"] == DONE:
+                    continue
+                if item["status"] == FAILED and item["attempts"] >= self.max_attempts:
+                    continue
+                pending_ids.append(item_id)
+            return pending_ids
+
+    def mark_done(self, task, ids):
+        with self._lock:
+            items = self._items(task)
+            for item_id in ids:
+                item = items.setdefault(item_id, {"attempts": 0})
+                item.update(status=DONE, attempts=item["attempts"] + 1, error=None)
+
+    def mark_failed(self, task, ids, error):
+        with self._lock:
+            items = self._items(task)
+            for item_id in ids:
+                item = items.setdefault(item_id, {"attempts": 0})
+                item.update(status=FAILED, attempts=item["attempts"] + 1, error=error)
+
+    def summary(self):
+        """タスクごとの状態別のID数を返す"""
+        with self._lock:
+            return {
+                task: dict(collections.Counter(item["status"] for item in items.values()))
+                for task, items in self.manifest["tasks"].items()
+            }
+
+    def save(self):
+        with self._lock:
+            self.manifest["updated_at"] = time.time()
+            try:
+                self.store.save(self.crawl_id, self.manifest)
+            except Exception as e:
+                logger.warning(f"Failed to save crawl state '{self.crawl_id}': {e}")
+
+    def start(self, task, ids):
+        """タスクの未完了のIDを処理するためのTaskProgressを返す"""
+        return TaskProgress(self, task, self.pending(task, ids))
+
+
+class TaskProgress:
+    """
+    ストリーム処理に流したIDと行数を記録し、転送済みの出力ファイルに含まれる行までのIDを完了(done)にするクラス
+    パートファイルを封印・転送するたびにsealedを呼ぶことで、転送済みのIDだけが再開時にスキップされる
+    転送に失敗したファイルがある場合、そのファイル以降の行のIDはこの実行では完了にしない
+    (ローカルに残ったファイルは後で再送されるが、再開時にはもう一度取得する)
+
+    Parameters:
+    ----------
+    state : CrawlState
+        クロール状態
+    task : str
+        タスク名
+    ids : list
+        処理対象(未完了)のID
+    """
+
+    def __init__(self, state, task, ids):
+        self.state = state
+        self.task = task
+        self.ids = ids
+        self.recorded = set()
+        # (ID, ストリーム上の最終行の位置)
+        self._items = collections.deque()
+        self._fed_rows = 0
+        self._written_rows = 0
+        # 転送済みのファイルに含まれる行数 (ストリーム上の位置)
+        self._durable_rows = 0
+        self._lost = False
+
+    def record(self, item_id, rows):
+        """IDとその行数をストリームに流したことを記録する"""
+        self.recorded.add(item_id)
+        self._fed_rows += rows
+        self._items.append((item_id, self._fed_rows))
+
+    def track(self, items):
+        """(ID, DataFrame)のイテレータを記録しながらDataFrameを返すジェネレータ"""
+        for item_id, df in items:
+            self.record(item_id, len(df))
+            yield df
+
+    def written(self, rows):
+        """出力ファイルに書き込んだ行数を加算する"""
+        self._written_rows += rows
+
+    def discard(self):
+        """書き込みに失敗した場合に呼ぶ。書き込み中のファイル以降の行のIDを完了にしない"""
+        self._lost = True
+
+    def sealed(self, durable):
+        """
+        パートファイルを封印した時に呼ぶ
+        durableがTrue(ファイルを転送できた)の場合は、書き込み済みの行のみで構成されるIDを完了にする
+        """
+        if not durable and not self._lost:
+            logger.warning(
+                f"{self.task}: a part file was not uploaded. "
+                "Remaining ids will not be marked as done in this run."
+            )
+        if not durable:
+            self._lost = True
+        if not self._lost:
+            self._durable_rows = self._written_rows
+        self.commit()
+
+    def commit(self):
+        """転送済みのファイルの行のみで構成されるIDを完了にして保存する"""
+        done_ids = []
+        while self._items and self._items[0][1] <= self._durable_rows:
+            done_ids.append(self._items.popleft()[0])
+        if done_ids:
+            self.state.mark_done(self.task, done_ids)
+            self.state.save()
+
+    def finish(self):
+        """
+        タスクの完了時(全てのファイルの封印後)に呼ぶ。ストリームに流したIDをすべて完了にし、
+        流れてこなかった(取得・パースに失敗した)IDを失敗として記録する
+        転送に失敗したファイルがある場合は、転送済みのファイルに含まれるIDのみを完了にする
+        """
+        if not self._lost:
+            self._durable_rows = self._fed_rows
+        failed_ids = [item_id for item_id in self.ids if item_id not in self.recorded]
+        if failed_ids:
+            self.state.mark_failed(self.task, failed_ids, "no records were retrieved")
+            logger.warning(f"{self.task}: {len(failed_ids)} ids failed")
+        self.commit()
+        self.state.save()
@@ -0,0 +1,234 @@
+import re
+
+import lxml.html
+from pandas.io.parsers import TextParser
+
+# pd.read_htmlと同様、非表示要素(display:none)はテーブルから除外する
+_HIDDEN_STYLE = re.compile(r"display:\s*none")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def parse_html(html, encoding=None):
+    """
+    HTMLをlxmlでパースする関数
+    1ページにつき1度だけパースし、以降の抽出関数でDOMを共有する
+
+    Parameters:
+    ----------
+    html : str or bytes
+        HTML文字列またはバイト列
+    encoding : str
+        バイト列の場合の文字コード (例: EUC-JP)
+
+    Returns:
+    ----------
+    root : lxml.html.HtmlElement
+    """
+    if isinstance(html, bytes):
+        parser = lxml.html.HTMLParser(encoding=encoding)
+        return lxml.html.fromstring(html, parser=parser)
+    return lxml.html.fromstring(html)
+
+
+def _is_hidden(el):
+    return el.tag == "style" or bool(_HIDDEN_STYLE.search(el.get("style", "")))
+
+
+def _raw_text(el, br):
+    parts = [el.text or ""]
+    for child in el:
+        if child.tag == "br":
+            parts.append(br)
+        elif isinstance(child.tag, str) and not _is_hidden(child):
+            parts.append(_raw_text(child, br))
+        parts.append(child.tail or "")
+    return "".join(parts)
+
+
+def cell_text(el, br="\n"):
+    """
+    セルのテキストを取得する関数
+    pd.read_htmlと同様に<br>を改行として扱い、連続する空白を1つにまとめる
+
+    Parameters:
+    ----------
+    el : lxml.html.HtmlElement
+        対象要素
+    br : str
+        <br>タグを置き換える文字列
+    """
+    return _WHITESPACE.sub(" ", _raw_text(el, br).strip())
+
+
+def _has_class(class_name):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')"
+
+
+def find_by_class(root, tag, *class_names):
+    conditions = " and ".join(_has_class(c) for c in class_names)
+    return root.xpath(f".//{tag}[{conditions}]")
+
+
+def _rows(table):
+    """colspan/rowspanを展開したセル要素の行リストと、ヘッダ行かどうかのフラグを返す"""
+    rows = []
+    pending = {}  # 列位置 -> (残り行数, セル要素)
+    for tr in table.xpath("./tr | ./thead/tr | ./tbody/tr | ./tfoot/tr"):
+        if _is_hidden(tr):
+            continue
+        row = []
+        cells = [c for c in tr if c.tag in ("td", "th") and not _is_hidden(c)]
+        col = 0
+        for cell in cells:
+            while col in pending:
+                remaining, spanned = pending[col]
+                row.append(spanned)
+                if remaining <= 1:
+                    del pending[col]
+                else:
+                    pending[col] = (remaining - 1, spanned)
+                col += 1
+            colspan = int(cell.get("colspan", 1) or 1)
+            rowspan = int(cell.get("rowspan", 1) or 1)
+            for _ in range(colspan):
+                row.append(cell)
+                if rowspan > 1:
+                    pending[col] = (rowspan - 1, cell)
+                col += 1
+        while col in pending:
+            remaining, spanned = pending.pop(col)
+            row.append(spanned)
+            if remaining > 1:
+                pending[col] = (remaining - 1, spanned)
+            col += 1
+        in_thead = tr.getparent() is not None and tr.getparent().tag == "thead"
+        is_header = in_thead or (bool(row) and all(c.tag == "th" for c in row))
+        rows.append((row, is_header))
+    return rows
+
+
+def table_to_frame(table, br="\n"):
+    """
+    テーブル要素をDataFrameに変換する関数
+    先頭のヘッダ行を列名とし、型推定はpd.read_htmlと同じTextParserで行う
+
+    Parameters:
+    ----------
+    table : lxml.html.HtmlElement
+        table要素
+    br : str
+        <br>タグを置き換える文字列
+
+    Returns:
+    ----------
+    df : pandas.DataFrame
+    """
+    rows = _rows(table)
+    header = None
+    if rows and rows[0][1]:
+        header = [cell_text(c, br) for c in rows.pop(0)[0]]
+    body = [[cell_text(c, br) for c in row] for row, _ in rows if row]
+    width = max([len(header or [])] + [len(r) for r in body])
+    body = [r + [""] * (width - len(r)) for r in body]
+    if header is None:
+        with TextParser(body, header=None, thousands=",") as parser:
+            return parser.read()
+    header = header + [""] * (width - len(header))
+    with TextParser([header] + body, header=0, thousands=",") as parser:
+        return parser.read()
+
+
+def extract_race_results(root):
+    """
+    レース結果テーブルと馬ID・騎手IDを1回の走査で抽出する関数
+
+    Returns:
+    ----------
+    df : pandas.DataFrame
+        レース結果テーブル
+    horse_id_list : list
+        馬IDのリスト (テーブルの行順)
+    jockey_id_list : list
+        騎手IDのリスト (テーブルの行順)
+    """
+    table = find_by_class(root, "table", "race_table_01")[0]
+    horse_id_list = []
+    jockey_id_list = []
+    for a in table.iter("a"):
+        href = a.get("href", "")
+        if href.startswith("/horse"):
+            horse_id_list.append(re.findall(r"\d+", href)[0])
+        elif href.startswith("/jockey"):
+            jockey_id_list.append(re.findall(r"\d+", href)[0])
+    return table_to_frame(table), horse_id_list, jockey_id_list
+
+
+def extract_race_info(root):
+    """
+    レース名・レース条件・開催情報のテキストを抽出する関数
+
+    Returns:
+    ----------
+    race_info : dict
+        race_title: レース名, race_data: コース・天候・馬場状態のテキスト,
+        small_text: 開催日・開催場所のテキスト
+    """
+    racedata = find_by_class(root, "*", "racedata", "fc")[0]
+    small_text = find_by_class(root, "*", "smalltxt")[0]
+    return {
+        "race_title": racedata.xpath(".//h1")[0].text_content(),
+        "race_data": racedata.xpath(".//span")[0].text or "",
+        "small_text": small_text.text or "",
+    }
+
+
+def extract_pay_tables(root):
+    """
+    払い戻しテーブルを抽出する関数
+    複数の払い戻し(複勝・ワイドなど)を区切る<br>は文字列"br"に置き換える
+
+    Returns:
+    ----------
+    df_list : list
+        払い戻しテーブル(pandas.DataFrame)のリスト
+    """
+    return [
+        table_to_frame(table, br="br")
+        for table in find_by_class(root, "table", "pay_table_01")
+    ]
+
+
+def extract_horse_results(root):
+    """
+    馬の過去成績テーブルを抽出する関数
+
+    Returns:
+    ----------
+    df : pandas.DataFrame
+    """
+    return table_to_frame(find_by_class(root, "table", "db_h_race_results")[0])
+
+
+def extract_speed_index(root):
+    """
+    スピード指数テーブルから馬番と前走の各指数を抽出する関数
+
+    Returns:
+    ----------
+    index_list : list
+        [馬番, スピード指数, 上がり指数, ペース指数, 先行指数] のリスト
+        指数が掲載されていない馬は0とする
+    """
+    table = find_by_class(root, "table", "c1")[0]
+    index_list = []
+    for i, tr in enumerate(table.iter("tr")):
+        tds = tr.xpath(".//td")
+        if i >= 1 and len(tds) > 7:
+            uma_ban = int(tds[1].text_content())
+            spans = find_by_class(tds[8], "span", "sn22")
+            if spans:
+                indexes = [float(spans[k].text_content()) for k in range(4)]
+            else:
+                indexes = [0, 0, 0, 0]
+            index_list.append([uma_ban] + indexes)
+    return index_list
@@ -0,0 +1,274 @@
+"""
+開催日カレンダー (calendar.html) の取得・キャッシュ
+
+過去の月の開催日は変わらないため、確定した月(日本時間の当月より前の月)はパース済みの開催日を
+ストアに保存して以降は再取得しない。当月以降の月は開催の追加・中止があり得るため、
+CALENDAR_CACHE_TTL秒だけプロセス内・HTTPキャッシュに保持する
+get-race_results / get-race_plan の両関数に同じファイルを配置している
+"""
+
+import datetime
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import pytz
+from bs4 import BeautifulSoup
+
+from fetcher import fetch_all, invalidate
+
+logger = logging.getLogger(__name__)
+
+CALENDAR_URL = "https://race.netkeiba.com/top/calendar.html"
+
+# 環境変数取得
+# CALENDAR_CACHE_BUCKETが設定されている場合はGCS、それ以外はローカルディレクトリに保存する
+CALENDAR_CACHE_DIR = os.environ.get(
+    "CALENDAR_CACHE_DIR",
+    os.path.join(os.environ.get("DOWNLOAD_FOLDER") or "/tmp", "kaisai_calendar"),
+)
+CALENDAR_CACHE_BUCKET = os.environ.get("CALENDAR_CACHE_BUCKET")
+# 当月以降の月のキャッシュ有効期間(秒)
+CALENDAR_CACHE_TTL = int(os.environ.get("CALENDAR_CACHE_TTL", 60 * 60))
+
+TOKYO_TZ = pytz.timezone("Asia/Tokyo")
+
+
+class LocalCalendarStore:
+    """ローカルディレクトリに確定した月の開催日(JSON)を保存するストア"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, year, month):
+        return os.path.join(self.directory, f"{year:04d}{month:02d}.json")
+
+    def load(self, year, month):
+        try:
+            with open(self._path(year, month), "r") as f:
+                return json.load(f)["kaisai_dates"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return None
+
+    def save(self, year, month, kaisai_dates):
+        path = self._path(year, month)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"kaisai_dates": kaisai_dates}, f)
+        os.replace(path + ".tmp", path)
+
+
+class GCSCalendarStore:
+    """
+    GCSバケットに確定した月の開催日(JSON)を保存するストア
+    Cloud Functionsの/tmpはインスタンス終了で消えるため、本番ではこちらを利用する
+    """
+
+    def __init__(self, bucket_name, prefix="kaisai_calendar/"):
+        # google-cloud-storageはGCSを利用する関数でのみ必要なため、ここでimportする
+        from google.cloud import storage as gcs
+
+        self.bucket = gcs.Client().bucket(bucket_name)
+        self.prefix = prefix
+
+    def load(self, year, month):
+        blob = self.bucket.get_blob(f"{self.prefix}{year:04d}{month:02d}.json")
+        if blob is None:
+            return None
+        return json.loads(blob.download_as_text()).get("kaisai_dates")
+
+    def save(self, year, month, kaisai_dates):
+        blob = self.bucket.blob(f"{self.prefix}{year:04d}{month:02d}.json")
+        blob.upload_from_string(
+            json.dumps({"kaisai_dates": kaisai_dates}), content_type="application/json"
+        )
+
+
+def get_default_store():
+    """環境変数の設定に応じたストアを返す"""
+    if CALENDAR_CACHE_BUCKET:
+        return GCSCalendarStore(CALENDAR_CACHE_BUCKET)
+    return LocalCalendarStore(CALENDAR_CACHE_DIR)
+
+
+def iter_year_months(from_, to_):
+    """yyyy-mm-ddの形式で指定した期間に含まれる(年, 月)を順に返す"""
+    from_date = datetime.date.fromisoformat(from_)
+    to_date = datetime.date.fromisoformat(to_)
+    year, month = from_date.year, from_date.month
+    while (year, month) <= (to_date.year, to_date.month):
+        yield year, month
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def parse_calendar(content):
+    """calendar.htmlから開催日(yyyymmdd)の一覧を抽出する"""
+    soup = BeautifulSoup(content, "html.parser")
+    table = soup.find("table", class_="Calendar_Table")
+    if table is None:
+        raise ValueError("Calendar_Table not found")
+    kaisai_date_list = []
+    for a in table.find_all("a"):
+        match = re.search(r"(?<=kaisai_date=)\d+", a.get("href", ""))
+        if match:
+            kaisai_date_list.append(match.group())
+    return sorted(set(kaisai_date_list))
+
+
+class KaisaiCalendar:
+    """
+    月ごとの開催日をキャッシュし、期間の問い合わせに答えるクラス
+    インスタンス内で取得済みの月は再取得せず、未取得の月のみまとめて並行に取得する
+
+    Parameters:
+    ----------
+    store : LocalCalendarStore or GCSCalendarStore
+        確定した月の開催日の保存先 (Noneの場合は環境変数の設定に応じたストアを利用する)
+    ttl : float
+        当月以降の月のキャッシュ有効期間(秒)
+    url : str
+        カレンダーページのURL
+    """
+
+    def __init__(self, store=None, ttl=CALENDAR_CACHE_TTL, url=CALENDAR_URL):
+        self._store = store
+        self.ttl = ttl
+        self.url = url
+        # (年, 月) -> (開催日の一覧, 取得時刻, 確定した月かどうか)
+        self._months = {}
+        self._lock = threading.Lock()
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = get_default_store()
+        return self._store
+
+    def month_url(self, year, month):
+        return self.url + "?" + "&".join(["year=" + str(year), "month=" + str(month)])
+
+    @staticmethod
+    def is_final(year, month):
+        """日本時間の当月より前の月は開催日が確定している"""
+        today = datetime.datetime.now(TOKYO_TZ).date()
+        return (year, month) < (today.year, today.month)
+
+    def _get_cached(self, year_month):
+        entry = self._months.get(year_month)
+        if entry is None:
+            return None
+        kaisai_dates, fetched_at, final = entry
+        if final or time.monotonic() - fetched_at < self.ttl:
+            return kaisai_dates
+        return None
+
+    def _load_stored(self, year, month):
+        try:
+            return self.store.load(year, month)
+        except Exception as e:
+            logger.warning(f"Failed to load calendar cache for {year}-{month:02d}: {e}")
+            return None
+
+    def _save_stored(self, year, month, kaisai_dates):
+        try:
+            self.store.save(year, month, kaisai_dates)
+        except Exception as e:
+            logger.warning(f"Failed to save calendar cache for {year}-{month:02d}: {e}")
+
+    def get_months(self, year_month_list, raise_on_error=True):
+        """
+        月ごとの開催日を返す関数
+
+        Parameters:
+        ----------
+        year_month_list : list
+            (年, 月)のリスト
+        raise_on_error : bool
+            取得・パースに失敗した月がある場合に例外を送出するかどうか
+            Falseの場合はログを出力し、その月を結果から除く (失敗した月はキャッシュしない)
+
+        Returns:
+        ----------
+        months : dict
+            (年, 月) -> 開催日(yyyymmdd)のリスト
+        """
+        months = {}
+        missing = []
+        with self._lock:
+            for year_month in year_month_list:
+                kaisai_dates = self._get_cached(year_month)
+                if kaisai_dates is None:
+                    missing.append(year_month)
+                else:
+                    months[year_month] = kaisai_dates
+
+        # 確定した月は保存済みの開催日を利用する
+        to_fetch = []
+        for year, month in missing:
+            final = self.is_final(year, month)
+            kaisai_dates = self._load_stored(year, month) if final else None
+            if kaisai_dates is None:
+                to_fetch.append((year, month))
+                continue
+            months[(year, month)] = kaisai_dates
+            with self._lock:
+                self._months[(year, month)] = (kaisai_dates, time.monotonic(), True)
+
+        urls = {year_month: self.month_url(*year_month) for year_month in to_fetch}
+        responses = fetch_all(urls.values(), ttl=self.ttl) if urls else {}
+        for (year, month), url in urls.items():
+            response = responses[url]
+            try:
+                if response is None or response.status != 200:
+                    raise RuntimeError(f"Failed to fetch calendar page: {url}")
+                kaisai_dates = parse_calendar(response.content)
+            except Exception as e:
+                if response is not None and response.status == 200:
+                    invalidate(url)
+                if raise_on_error:
+                    raise RuntimeError(f"Failed to get calendar from {url}: {e}") from e
+                logger.error(f"Failed to get calendar from {url}: {e}")
+                continue
+            # 取得時点で確定していた月のみ保存する
+            final = self.is_final(year, month)
+            if final:
+                self._save_stored(year, month, kaisai_dates)
+            months[(year, month)] = kaisai_dates
+            with self._lock:
+                self._months[(year, month)] = (kaisai_dates, time.monotonic(), final)
+        return months
+
+    def get_kaisai_date(self, from_, to_, raise_on_error=True):
+        """
+        yyyy-mm-ddの形式でfrom_とto_を指定すると、間の開催日(yyyymmdd)の一覧を昇順で返す関数
+        """
+        year_month_list = list(iter_year_months(from_, to_))
+        months = self.get_months(year_month_list, raise_on_error)
+        from_date = from_.replace("-", "")
+        to_date = to_.replace("-", "")
+        return [
+            d
+            for year_month in year_month_list
+            for d in months.get(year_month, [])
+            if from_date <= d <= to_date
+        ]
+
+
+_default_calendar = None
+_default_calendar_lock = threading.Lock()
+
+
+def get_default_calendar():
+    """KaisaiCalendarをインスタンス内で1つだけ作成して返す"""
+    global _default_calendar
+    with _default_calendar_lock:
+        if _default_calendar is None:
+            _default_calendar = KaisaiCalendar()
+        return _default_calendar
+
+
+def get_kaisai_date(from_, to_, raise_on_error=True):
+    return get_default_calendar().get_kaisai_date(from_, to_, raise_on_error)
@@ -1,28 +1,37 @@
 import ast
+import asyncio
+import concurrent.futures
 import dataclasses
 import datetime
-import io
-import json
 import logging
 import os
 import re
-import ssl
-import subprocess
-import time
 import traceback
-import urllib.request
 
-import certifi
 import functions_framework
 import numpy as np
 import pandas as pd
 import pytz
 import requests
-from bs4 import BeautifulSoup
 
 # from dotenv import load_dotenv
+from google.cloud import bigquery
 from google.cloud import storage as gcs
-from tqdm import tqdm
+
+import kaisai_calendar
+import scraper
+from crawl_state import CrawlState
+from extractor import (
+    extract_horse_results,
+    extract_pay_tables,
+    extract_race_info,
+    extract_race_results,
+    extract_speed_index,
+    parse_html,
+)
+from fetcher import fetch_all, invalidate
+from pipeline import RecordBatcher, batched, iter_record_batches
+from table_writer import OUTPUT_FORMATS, PartFileWriter
 
 # ロギングの設定
 logging.basicConfig(
@@ -37,6 +46,30 @@ PASSWORD = os.environ.get("PASSWORD")
 PROJECT_ID = os.environ.get("PROJECT_ID")
 DST_BUCKET = os.environ.get("DST_BUCKET")
 DOWNLOAD_FOLDER = os.environ.get("DOWNLOAD_FOLDER")
+DATASET_NAME = os.environ.get("DATASET_NAME")
+# 馬の過去成績を前回取得分以降のみ差分取得する (falseの場合は全件取得)
+INCREMENTAL_HORSE_RESULTS = (
+    os.environ.get("INCREMENTAL_HORSE_RESULTS", "true").lower() == "true"
+)
+# 出力ファイル形式 (parquet: BigQueryのスキーマに合わせた型で出力, csv: 従来の形式)
+OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "parquet")
+# Parquetの圧縮形式
+PARQUET_COMPRESSION = os.environ.get("PARQUET_COMPRESSION", "zstd")
+# 1回にまとめて取得・パースするページ数 (メモリに保持するページはこの件数まで)
+FETCH_CHUNK_SIZE = int(os.environ.get("FETCH_CHUNK_SIZE", 200))
+# 出力ファイルへ書き込むレコードバッチの行数
+RECORD_BATCH_SIZE = int(os.environ.get("RECORD_BATCH_SIZE", 2000))
+# パートファイル1つあたりの行数 (この行数に達したファイルから順にCloud Storageへ転送する)
+ROWS_PER_PART_FILE = int(os.environ.get("ROWS_PER_PART_FILE", 50000))
+# パートファイルを開いておく秒数 (経過したファイルは行数によらず封印・転送し、クロール状態を保存する)
+PART_FILE_MAX_SECONDS = float(os.environ.get("PART_FILE_MAX_SECONDS", 300))
+
+# HTTPキャッシュを再検証せずに利用する期間(秒)
+# レース結果ページ・スピード指数は確定後に変わらないため長く、馬の過去成績は毎回再検証する
+# 内容を抽出できなかったページ(メンテナンス中・結果やスピード指数が未掲載)はその時点でキャッシュから削除する
+RACE_PAGE_CACHE_TTL = 30 * 24 * 60 * 60
+SPEED_INDEX_CACHE_TTL = 30 * 24 * 60 * 60
+HORSE_PAGE_CACHE_TTL = 0
 
 
 # 文字列をリストに変換
@@ -72,99 +105,95 @@ class UrlPaths:
     # 出馬表ページ
     SHUTUBA_TABLE: str = "https://race.netkeiba.com/race/shutuba.html"
 
+    # スピード指数ページ (個人Webサイト「競馬新聞&スピード指数」)
+    SPEED_INDEX_URL: str = "https://jiro8.sakura.ne.jp/index2.php?code="
 
-class Results:
+
+class RacePage:
     @staticmethod
     def scrape(race_id_list):
         """
-        レース結果データをスクレイピングする関数
+        レース結果ページ(db.netkeiba.com/race/)を1レースにつき1回だけ取得・パースする関数
+        レース結果テーブル、レース情報、払い戻しテーブルは同じページに含まれるため、
+        パースしたDOMをResults.parse、Return.parseで共有する
+
         Parameters:
         ----------
         race_id_list : list
             レースIDのリスト
+
         Returns:
         ----------
-        race_results_df : pandas.DataFrame
-            全レース結果データをまとめてDataFrame型にしたもの
+        race_pages : dict
+            race_idをkey、パース済みのDOM(lxml.html.HtmlElement)をvalueとする辞書
         """
-        # race_idをkeyにしてDataFrame型を格納
-        race_results = {}
-        for race_id in tqdm(race_id_list):
-            time.sleep(1)
-            logger.info(f"Retrieving race results... (race_id: {race_id})")
-            try:
-                url = "https://db.netkeiba.com/race/" + race_id
-                html = requests.get(url)
-                html.encoding = "EUC-JP"
-                soup = BeautifulSoup(html.content, "html.parser")
-                table = soup.find("table", class_="race_table_01")
-                df = pd.read_html(io.StringIO(str(table)))[0]
-
-                # 列名に半角スペースがあれば除去する
-                df = df.rename(columns=lambda x: x.replace(" ", ""))
-                # レース情報の取得
-                df["race_title"] = [
-                    soup.find(class_="racedata fc").find("h1").text
-                ] * len(df)
-                race_info = soup.find(class_="racedata fc").find("span").contents[0]
-                df["race_type"] = [race_info[0]] * len(df)
-                df["race_turn"] = [race_info[1]] * len(df)
-                df["course_len"] = [re.findall(r"\d{4}", race_info)[0]] * len(df)
-                df["weather"] = [
-                    re.findall(r"天候\s*:\s*([^\/]+)", race_info.replace("\xa0", ""))[0]
-                ] * len(df)
-                df["ground_condition"] = [
-                    re.findall(r"良|稍重|重|不良", race_info)[0]
-                ] * len(df)
-                df["year"] = [
-                    re.findall(r"(\d{4})", soup.find(class_="smalltxt").contents[0])[0]
-                ] * len(df)
-                df["date"] = [
-                    re.findall(
-                        r"(\d{1,2}月\d{1,2}日)",
-                        soup.find(class_="smalltxt").contents[0],
-                    )[0]
-                ] * len(df)
-                df["location"] = [
-                    re.findall(r"\d+回(..)", soup.find(class_="smalltxt").contents[0])[
-                        0
-                    ]
-                ] * len(df)
-                # 馬ID、騎手IDをスクレイピング
-                horse_id_list = []
-                horse_a_list = soup.find(
-                    "table", attrs={"summary": "レース結果"}
-                ).find_all("a", attrs={"href": re.compile("^/horse")})
-                for a in horse_a_list:
-                    horse_id = re.findall(r"\d+", a["href"])
-                    horse_id_list.append(horse_id[0])
-                jockey_id_list = []
-                jockey_a_list = soup.find(
-                    "table", attrs={"summary": "レース結果"}
-                ).find_all("a", attrs={"href": re.compile("^/jockey")})
-                for a in jockey_a_list:
-                    jockey_id = re.findall(r"\d+", a["href"])
-                    jockey_id_list.append(jockey_id[0])
-                df["horse_id"] = horse_id_list
-                df["jockey_id"] = jockey_id_list
-                # インデックスをrace_idにする
-                df["race_id"] = [race_id] * len(df)
-                race_results[race_id] = df
-            except IndexError:
-                logger.warning(f"IndexError occurred for race_id: {race_id}")
-                print(traceback.format_exc())
+        logger.info(f"Retrieving {len(race_id_list)} race pages...")
+        urls = {race_id: UrlPaths.RACE_URL + race_id for race_id in race_id_list}
+        responses = fetch_all(urls.values(), ttl=RACE_PAGE_CACHE_TTL)
+
+        race_pages = {}
+        for race_id, url in urls.items():
+            response = responses[url]
+            if response is None or response.status != 200:
+                status = response.status if response else None
+                logger.error(f"Failed to retrieve race_id {race_id}. Status code: {status}")
                 continue
-            except AttributeError:
-                logger.warning(f"AttributeError occurred for race_id: {race_id}")
-                print(traceback.format_exc())
-                continue
-            except Exception as e:
-                logger.error(f"An error occurred while scraping race_id {race_id}: {e}")
-                logger.debug(traceback.format_exc())
-                break
-        # pd.DataFrame型にして一つのデータにまとめる
-        race_results_df = pd.concat([race_results[key] for key in race_results])
-        return race_results_df
+            race_pages[race_id] = parse_html(response.text("EUC-JP"))
+        logger.info(f"Retrieved {len(race_pages)} / {len(race_id_list)} race pages")
+        return race_pages
+
+    @staticmethod
+    def iter_scrape(race_id_list, chunk_size):
+        """
+        レース結果ページをchunk_sizeレースずつ取得・パースし、(race_id, DOM)を順に返すジェネレータ
+        メモリに保持するDOMは1チャンク分のみ
+        """
+        for chunk in batched(race_id_list, chunk_size):
+            yield from RacePage.scrape(chunk).items()
+
+
+class Results:
+    @staticmethod
+    def parse(race_id, root):
+        """
+        1レース分のレース結果データをスクレイピングする関数
+        Parameters:
+        ----------
+        race_id : str
+            レースID
+        root : lxml.html.HtmlElement
+            RacePage.scrapeで取得したレース結果ページのDOM
+        Returns:
+        ----------
+        df : pandas.DataFrame
+            レース結果データ
+        """
+        logger.info(f"Parsing race results... (race_id: {race_id})")
+        df, horse_id_list, jockey_id_list = extract_race_results(root)
+
+        # 列名に半角スペースがあれば除去する
+        df = df.rename(columns=lambda x: x.replace(" ", ""))
+        # レース情報の取得
+        race_page_info = extract_race_info(root)
+        df["race_title"] = [race_page_info["race_title"]] * len(df)
+        race_info = race_page_info["race_data"]
+        df["race_type"] = [race_info[0]] * len(df)
+        df["race_turn"] = [race_info[1]] * len(df)
+        df["course_len"] = [re.findall(r"\d{4}", race_info)[0]] * len(df)
+        df["weather"] = [
+            re.findall(r"天候\s*:\s*([^\/]+)", race_info.replace("\xa0", ""))[0]
+        ] * len(df)
+        df["ground_condition"] = [re.findall(r"良|稍重|重|不良", race_info)[0]] * len(df)
+        small_text = race_page_info["small_text"]
+        df["year"] = [re.findall(r"(\d{4})", small_text)[0]] * len(df)
+        df["date"] = [re.findall(r"(\d{1,2}月\d{1,2}日)", small_text)[0]] * len(df)
+        df["location"] = [re.findall(r"\d+回(..)", small_text)[0]] * len(df)
+        # 馬ID、騎手ID
+        df["horse_id"] = horse_id_list
+        df["jockey_id"] = jockey_id_list
+        # インデックスをrace_idにする
+        df["race_id"] = [race_id] * len(df)
+        return df
 
 
 class RaceScraper:
@@ -206,9 +235,9 @@ class RaceScraper:
             raise
 
     @staticmethod
-    def scrape(horse_id_list, session):
+    def iter_scrape(horse_id_list, session, chunk_size):
         """
-        馬の過去成績データをスクレイピングする関数
+        馬の過去成績データをchunk_size頭ずつ取得し、1頭ずつ返すジェネレータ
 
         Parameters:
         ----------
@@ -216,282 +245,289 @@ class RaceScraper:
             馬IDのリスト
         session : requests.Session
             ログイン済みのセッション
+        chunk_size : int
+            1回にまとめて取得する馬の数
 
-        Returns:
+        Yields:
         ----------
-        horse_results_df : pandas.DataFrame
-            全馬の過去成績データをまとめてDataFrame型にしたもの
+        horse_id : str
+            馬ID
+        df : pandas.DataFrame
+            1頭分の過去成績データ
         """
-
-        horse_results = {}
-        for horse_id in tqdm(horse_id_list):
-            time.sleep(1)
-            try:
-                url = f"https://db.netkeiba.com/horse/{horse_id}"
-                response = session.get(url)
-                if response.status_code == 200:
-                    df_list = pd.read_html(response.content, encoding="euc-jp")
-                    df = df_list[3]
-                    if df.columns[0] == "受賞歴":
-                        df = df_list[4]
-                    df["horse_id"] = [horse_id] * len(df)
-                    horse_results[horse_id] = df
-                else:
-                    logger.warning(
-                        f"Failed to retrieve data for horse_id: {horse_id}. Status code: {response.status_code}"
-                    )
-            except IndexError:
-                logger.warning(f"IndexError occurred for horse_id: {horse_id}")
-                continue
-            except requests.RequestException as e:
-                logger.error(f"Network error occurred for horse_id {horse_id}: {e}")
-                continue
-            except Exception as e:
-                logger.error(f"Unexpected error occurred for horse_id {horse_id}: {e}")
-                continue
-
-        if horse_results:
-            horse_results_df = pd.concat([horse_results[key] for key in horse_results])
-        else:
-            logger.warning("No horse results were successfully scraped.")
-            horse_results_df = pd.DataFrame()
-
-        return horse_results_df
+        # ログイン済みセッションのCookieを引き継いで並行取得する
+        cookies = session.cookies.get_dict()
+        for chunk in batched(horse_id_list, chunk_size):
+            urls = {horse_id: UrlPaths.HORSE_URL + horse_id for horse_id in chunk}
+            responses = fetch_all(urls.values(), ttl=HORSE_PAGE_CACHE_TTL, cookies=cookies)
+
+            for horse_id, url in urls.items():
+                response = responses[url]
+                try:
+                    if response is None:
+                        continue
+                    if response.status == 200:
+                        # 過去成績テーブルのみを抽出する
+                        df = extract_horse_results(parse_html(response.text("EUC-JP")))
+                        df["horse_id"] = [horse_id] * len(df)
+                        yield horse_id, df
+                    else:
+                        logger.warning(
+                            f"Failed to retrieve data for horse_id: {horse_id}. Status code: {response.status}"
+                        )
+                except IndexError:
+                    logger.warning(f"IndexError occurred for horse_id: {horse_id}")
+                    invalidate(url)
+                    continue
+                except Exception as e:
+                    logger.error(f"Unexpected error occurred for horse_id {horse_id}: {e}")
+                    invalidate(url)
+                    continue
 
 
 class Return:
     @staticmethod
-    def scrape(race_id_list):
+    def parse(race_id, root):
         """
-        払い戻し表データをスクレイピングする関数
+        1レース分の払い戻し表データをスクレイピングする関数
 
         Parameters:
         ----------
-        race_id_list : list
-            レースIDのリスト
+        race_id : str
+            レースID
+        root : lxml.html.HtmlElement
+            RacePage.scrapeで取得したレース結果ページのDOM
 
         Returns:
         ----------
-        return_tables_df : pandas.DataFrame
-            全払い戻し表データをまとめてDataFrame型にしたもの
+        df : pandas.DataFrame
+            払い戻し表データ
         """
+        dfs = extract_pay_tables(root)
+        df = pd.concat(dfs, ignore_index=True)
+        df["race_id"] = [race_id] * len(df)
+        return df
 
-        return_tables = {}
-        for race_id in tqdm(race_id_list):
-            time.sleep(1)
-            try:
-                url = "https://db.netkeiba.com/race/" + race_id
-                html = requests.get(url)
-                html.encoding = "EUC-JP"
-                soup = BeautifulSoup(html.text.replace("<br />", "br"), "html.parser")
-
-                dfs = [
-                    pd.read_html(io.StringIO(str(table)))[0]
-                    for table in soup.find_all("table", class_="pay_table_01")
-                ]
-                df = pd.concat(dfs, ignore_index=True)
-                df["race_id"] = [race_id] * len(df)
-                return_tables[race_id] = df
-            except IndexError:
-                logger.warning(f"IndexError occurred for race_id: {race_id}")
-                print(traceback.format_exc())
-                continue
-            except AttributeError:
-                logger.warning(f"AttributeError occurred for race_id: {race_id}")
-                print(traceback.format_exc())
-                continue
-            except urllib.error.URLError as e:
-                logger.error(f"Network error occurred for race_id {race_id}: {e}")
-                print(traceback.format_exc())
-                continue
-            except Exception as e:
-                logger.error(f"Unexpected error occurred for race_id {race_id}: {e}")
-                print(traceback.format_exc())
-                continue
 
-        # pd.DataFrame型にして一つのデータにまとめる
-        if return_tables:
-            return_tables_df = pd.concat([return_tables[key] for key in return_tables])
-        else:
-            logger.warning("No return tables were successfully scraped.")
-            return_tables_df = pd.DataFrame()
+def _parse_race_page(parse, race_id, root):
+    """
+    Results.parse / Return.parse を実行し、失敗したレースはログを出力してNoneを返す
+    1レースの失敗で他のレースの処理を止めない
+    """
+    try:
+        return parse(race_id, root)
+    except IndexError:
+        logger.warning(f"IndexError occurred for race_id: {race_id}")
+        print(traceback.format_exc())
+    except AttributeError:
+        logger.warning(f"AttributeError occurred for race_id: {race_id}")
+        print(traceback.format_exc())
+    except Exception as e:
+        logger.error(f"An error occurred while scraping race_id {race_id}: {e}")
+        print(traceback.format_exc())
+    return None
+
 
-        return return_tables_df
+def iter_race_records(race_pages):
+    """
+    レース結果ページから、レース結果と払い戻し表のDataFrameを1レースずつ返すジェネレータ
+
+    Parameters:
+    ----------
+    race_pages : iterable
+        RacePage.iter_scrapeで取得した(race_id, DOM)のイテレータ
+
+    Yields:
+    ----------
+    race_id : str
+        レースID
+    race_results : pandas.DataFrame
+        レース結果データ (取得失敗時はNone)
+    returns : pandas.DataFrame
+        払い戻し表データ (取得失敗時はNone)
+    """
+    for race_id, root in race_pages:
+        race_results = _parse_race_page(Results.parse, race_id, root)
+        returns = _parse_race_page(Return.parse, race_id, root)
+        if race_results is None or race_results.empty or returns is None:
+            # 再試行時に同じページを再取得するよう、キャッシュから削除する
+            invalidate(UrlPaths.RACE_URL + race_id)
+        yield race_id, race_results, returns
 
 
 class SpeedScraper:
     @staticmethod
-    def get_index(original_race_id_list):
+    def iter_index(original_race_id_list, chunk_size):
         """
-        指定された複数のレースIDのレース結果データをスクレイピングしてDataFrameとして返すメソッド
+        指定された複数のレースIDのスピード指数をchunk_sizeレースずつ取得し、1レースずつ返すジェネレータ
 
         Parameters:
         ----------
         original_race_id_list : list
             レースIDのリスト
+        chunk_size : int
+            1回にまとめて取得するレース数
 
-        Returns:
+        Yields:
         ----------
-        all_race_df : pandas.DataFrame
-            すべてのレース結果データをまとめたDataFrame
+        race_id : str
+            レースID (変換前)
+        df_index : pandas.DataFrame
+            1レース分のスピード指数データ
         """
         # ID変換の対応を保持
         id_mapping = {int(str(id)[2:]): id for id in original_race_id_list}
-        converted_race_id_list = list(id_mapping.keys())
-
-        all_index_list = []
-
-        for race_id in tqdm(converted_race_id_list):
-            time.sleep(1)
-            try:
-
-                url = "https://jiro8.sakura.ne.jp/index2.php?code=" + str(race_id)
-                url_html = requests.get(url)
-                url_html.raise_for_status()
-                html = BeautifulSoup(url_html.content, "html.parser")
-                RaceTable01 = html.findAll("table", {"class": "c1"})[0]
-
-                index_list = []
-                for i, RaceTable01_tr in enumerate(RaceTable01.findAll("tr")):
-                    if i >= 1 and len(RaceTable01_tr.findAll("td")) > 7:
-                        uma_ban = int(RaceTable01_tr.findAll("td")[1].get_text())
-                        zensou = RaceTable01_tr.findAll("td")[8]
-
-                        speed_index = 0
-                        rasing_index = 0
-                        pace_index = 0
-                        leading_index = 0
-
-                        if len(zensou.findAll("span", {"class": "sn22"})) != 0:
-                            speed_index = zensou.findAll("span", {"class": "sn22"})[
-                                0
-                            ].get_text()
-                            speed_index = float(speed_index)
-
-                            rasing_index = zensou.findAll("span", {"class": "sn22"})[
-                                1
-                            ].get_text()
-                            rasing_index = float(rasing_index)
-
-                            pace_index = zensou.findAll("span", {"class": "sn22"})[
-                                2
-                            ].get_text()
-                            pace_index = float(pace_index)
-
-                            leading_index = zensou.findAll("span", {"class": "sn22"})[
-                                3
-                            ].get_text()
-                            leading_index = float(leading_index)
-
-                        temp_list = [
-                            id_mapping[race_id],
-                            uma_ban,
-                            speed_index,
-                            rasing_index,
-                            pace_index,
-                            leading_index,
-                        ]
-                        index_list.append(temp_list)
-
-                df_index = pd.DataFrame(
-                    index_list,
-                    columns=[
-                        "race_id",
-                        "uma_ban",
-                        "speed_index",
-                        "rasing_index",
-                        "pace_index",
-                        "leading_index",
-                    ],
-                )
-                all_index_list.append(df_index)
-
-            except requests.RequestException as e:
-                logger.error(f"Network error occurred for race_id {race_id}: {e}")
-                continue
-            except Exception as e:
-                logger.error(f"Unexpected error occurred for race_id {race_id}: {e}")
-                continue
 
-        if all_index_list:
-            all_race_df = pd.concat(all_index_list, ignore_index=True)
-        else:
-            logger.warning("No speed results were successfully scraped.")
-            all_race_df = pd.DataFrame()
+        for chunk in batched(id_mapping, chunk_size):
+            urls = {race_id: UrlPaths.SPEED_INDEX_URL + str(race_id) for race_id in chunk}
+            responses = fetch_all(urls.values(), ttl=SPEED_INDEX_CACHE_TTL)
+
+            for race_id, url in urls.items():
+                response = responses[url]
+                try:
+                    if response is None or response.status != 200:
+                        status = response.status if response else None
+                        logger.error(
+                            f"Failed to retrieve speed index for race_id {race_id}. Status code: {status}"
+                        )
+                        continue
+                    index_list = [
+                        [id_mapping[race_id]] + row
+                        for row in extract_speed_index(parse_html(response.content))
+                    ]
+                    if not index_list:
+                        # スピード指数が未掲載のページは、再試行時に再取得するようキャッシュから削除する
+                        logger.warning(f"No speed index rows for race_id {race_id}")
+                        invalidate(url)
+                        continue
+
+                    yield id_mapping[race_id], pd.DataFrame(
+                        index_list,
+                        columns=[
+                            "race_id",
+                            "uma_ban",
+                            "speed_index",
+                            "rasing_index",
+                            "pace_index",
+                            "leading_index",
+                        ],
+                    )
 
-        return all_race_df
+                except Exception as e:
+                    logger.error(f"Unexpected error occurred for race_id {race_id}: {e}")
+                    invalidate(url)
+                    continue
 
 
 def get_kaisai_date(from_: str, to_: str):
     """
     yyyy-mm-ddの形式でfrom_とto_を指定すると、間の開催日程一覧が返ってくる関数。
+    確定した月の開催日はkaisai_calendarのキャッシュから返す。
     """
-    # 日付範囲を生成
     logger.info(f"Fetching race dates from {from_} to {to_}")
-    date_range = pd.date_range(start=from_, end=to_, freq="D")
-    kaisai_date_list = []
-    seen_year_month = set()
-
-    for date in tqdm(date_range, total=len(date_range)):
-        year_month = (date.year, date.month)
-        if year_month not in seen_year_month:
-            seen_year_month.add(year_month)
-            query = [
-                "year=" + str(date.year),
-                "month=" + str(date.month),
-            ]
-            url = UrlPaths.CALENDAR_URL + "?" + "&".join(query)
-            ctx = ssl.create_default_context(cafile=certifi.where())
-            with urllib.request.urlopen(url, context=ctx) as response:
-                html = response.read()
-            time.sleep(1)
-            soup = BeautifulSoup(html, "html.parser")
-            a_list = soup.find("table", class_="Calendar_Table").find_all("a")
-            for a in a_list:
-                kaisai_date = re.findall(r"(?<=kaisai_date=)\d+", a["href"])[0]
-                kaisai_date_list.append(kaisai_date)
-
-    # 取得した開催日をフィルタリングして指定範囲に含まれる日付のみを返す
-    from_date = from_.replace("-", "")
-    to_date = to_.replace("-", "")
-    kaisai_date_list = [d for d in kaisai_date_list if from_date <= d <= to_date]
+    kaisai_date_list = kaisai_calendar.get_kaisai_date(from_, to_)
     logger.info(f"Found {len(kaisai_date_list)} race dates")
 
     return kaisai_date_list
 
 
-def get_race_id_list(kaisai_date_list):
+def get_race_id_lists(kaisai_date_list):
+    """
+    開催日ごとのレースIDを取得する関数
+    取得に失敗した開催日、またはレースが1件も見つからなかった開催日は結果に含めない
+    """
     logger.info("Executing web scraping for race IDs")
-    # ウェブスクレイピング実行
-    command = [
-        "python",
-        "scraper.py",
-        str(kaisai_date_list),
-        UrlPaths.RACE_LIST_URL,
+    # ウェブスクレイピング実行 (別プロセスを起動せず、同じプロセス内で実行する)
+    race_id_lists = asyncio.run(
+        scraper.scrape_race_id_lists(kaisai_date_list, UrlPaths.RACE_LIST_URL)
+    )
+    race_id_lists = {
+        kaisai_date: race_ids for kaisai_date, race_ids in race_id_lists.items() if race_ids
+    }
+
+    failed_dates = [d for d in kaisai_date_list if d not in race_id_lists]
+    if failed_dates:
+        logger.warning(f"Failed to get race IDs for {len(failed_dates)} dates: {failed_dates}")
+    logger.debug(f"race_id_lists: {race_id_lists}")
+    return race_id_lists
+
+
+def get_race_id_list(kaisai_date_list, state):
+    """
+    開催日のレースIDを開催日の順に返す関数
+    取得できた開催日のレースIDはクロール状態に保存し、再開時は取得できなかった開催日のみ取得し直す
+    """
+    race_id_lists = state.get("race_id_lists", {})
+    missing_dates = [d for d in kaisai_date_list if d not in race_id_lists]
+    if missing_dates:
+        state.update("race_id_lists", get_race_id_lists(missing_dates))
+        state.save()
+        race_id_lists = state.get("race_id_lists", {})
+    else:
+        logger.info("Loaded race_ids of all dates from crawl state")
+
+    race_id_list = [
+        race_id for kaisai_date in kaisai_date_list for race_id in race_id_lists.get(kaisai_date, [])
     ]
-    result = subprocess.run(command, capture_output=True, text=True)
-
-    # スクレイピング結果を出力
-    print("stdout: ", result.stdout)
-    print("stderr: ", result.stderr)
-
-    # スクレイピングで書き出したrace_id_list.json を読み込む
-    filepath = os.path.join(DOWNLOAD_FOLDER, "race_id_list.json")
-    with open(filepath, "r") as f:
-        race_id_list = json.load(f)
-
     logger.info(f"Total number of race_ids: {len(race_id_list)}")
-    logger.debug(f"race_id_list: {race_id_list}")
     return race_id_list
 
 
-def get_race_results(race_id_list, today_str):
+def upload_part_file(path):
+    """
+    封印したパートファイルをCloud Storageへ転送し、転送できたファイルはローカルから削除する
+    DST_BUCKETが未設定の場合(ローカルでのバックフィル等)はローカルに残す
+
+    Returns:
+    ----------
+    uploaded : bool
+        転送できた(またはDST_BUCKETが未設定の)場合はTrue
+    """
+    if not DST_BUCKET:
+        return True
+    if gcs_uploader(os.path.basename(path)):
+        os.remove(path)
+        return True
+    return False
 
-    logger.info("Fetching race results")
 
-    # レース結果を取得
-    race_results = Results.scrape(race_id_list)
+def open_part_writer(table_name, file_prefix, today_str, progress):
+    """
+    スクレイピング結果を DOWNLOAD_FOLDER/{file_prefix}_{today_str}_{hhmmss}_part-NNNNN.(parquet|csv) に
+    レコードバッチごとに書き込むPartFileWriterを作成する関数
+    ファイル名の接頭辞でbq_uploaderがロード先のテーブルを判定する
+    中断後に再開した実行が、転送済みのファイルを上書きしないよう作成時刻をファイル名に含める
+    封印したファイルをCloud Storageへ転送できた場合のみ、progressのファイルに含まれるIDを完了にする
+    """
+    created_at = datetime.datetime.now().strftime("%H%M%S")
+    return PartFileWriter(
+        table_name,
+        os.path.join(DOWNLOAD_FOLDER, f"{file_prefix}_{today_str}_{created_at}"),
+        output_format=OUTPUT_FORMAT,
+        compression=PARQUET_COMPRESSION,
+        rows_per_file=ROWS_PER_PART_FILE,
+        max_seconds=PART_FILE_MAX_SECONDS,
+        on_seal=lambda path: progress.sealed(upload_part_file(path)),
+    )
+
+
+def write_batch(writer, progress, batch, raw_rows):
+    """
+    加工済みのレコードバッチを書き込む関数
+    raw_rowsは加工前の行数 (TaskProgressに記録した行数と対応させる)
+    書き込みでパートファイルを封印した場合に、このバッチまでを封印したファイルの行とするため、書き込み前に加算する
+    """
+    progress.written(raw_rows)
+    try:
+        writer.write(batch)
+    except Exception:
+        # 書き込めなかったバッチのIDを完了にしない
+        progress.discard()
+        raise
+
 
+def format_race_results(race_results):
+    """Results.parseで取得したレース結果のレコードバッチを、raw_race_resultsの列構成に加工する関数"""
     # データ加工
     ## 日付列を結合して新しい列を作成し、不要な列を削除
     race_results["event_date"] = pd.to_datetime(
@@ -554,114 +590,267 @@ def get_race_results(race_id_list, today_str):
         "event_date",
     ]
     # 列を並び替え
-    race_results = race_results[new_order]
+    race_results = race_results[new_order].copy()
 
     ## odds に含まれる文字列処理
     race_results["odds"] = race_results["odds"].replace("---", np.nan).astype(float)
+    return race_results
 
-    # csv出力
-    race_results.to_csv(f"{DOWNLOAD_FOLDER}/race_results_{today_str}.csv", index=None)
-    logger.info(f"Race results saved to {DOWNLOAD_FOLDER}/race_results_{today_str}.csv")
 
-    return race_results
+def format_returns(returns):
+    """Return.parseで取得した払い戻し表のレコードバッチを、raw_race_return_allの列構成に加工する関数"""
+    # 列名を指定された名前に変更
+    returns.columns = [
+        "baken_types",
+        "horse_number",
+        "refund",
+        "popularity",
+        "race_id",
+    ]
+
+    # race_id列を最初の列に移動
+    return returns[["race_id", "baken_types", "horse_number", "refund", "popularity"]]
+
+
+def get_race_results(race_id_list, today_str, state):
+    """
+    レース結果ページを取得し、レース結果と払い戻し表をレコードバッチごとにファイル出力する関数
+    レース結果ページはFETCH_CHUNK_SIZEレースずつ取得し、処理済みのページは保持しない
+    クロール状態で完了済みのレースはスキップする
+
+    Parameters:
+    ----------
+    race_id_list : list
+        レースIDのリスト
+    today_str : str
+        出力ファイル名に付与する日付(yyyymmdd)
+    state : CrawlState
+        クロール状態
+
+    Returns:
+    ----------
+    horse_last_race_dates : dict
+        馬IDをkey、取得済みのレース結果での出走日(yyyy-mm-dd)の最大値をvalueとする辞書
+        (中断前の実行で取得した分を含む)
+    """
+    logger.info("Fetching race results")
 
+    results_progress = state.start("race_results", race_id_list)
+    returns_progress = state.start("race_return_all", race_id_list)
+    results_ids = set(results_progress.ids)
+    returns_ids = set(returns_progress.ids)
+    fetch_ids = [r for r in race_id_list if r in results_ids or r in returns_ids]
+    logger.info(
+        f"Pending races: {len(fetch_ids)} / {len(race_id_list)} "
+        f"(race_results: {len(results_ids)}, race_return_all: {len(returns_ids)})"
+    )
+
+    results_batcher = RecordBatcher(RECORD_BATCH_SIZE)
+    returns_batcher = RecordBatcher(RECORD_BATCH_SIZE)
+
+    def write_race_results(writer, batch):
+        formatted = format_race_results(batch)
+        known_dates = state.get("horse_last_race_dates", {})
+        state.update(
+            "horse_last_race_dates",
+            {
+                horse_id: event_date
+                for horse_id, event_date in (
+                    formatted.groupby("horse_id")["event_date"].max().items()
+                )
+                if event_date > known_dates.get(horse_id, "")
+            },
+        )
+        write_batch(writer, results_progress, formatted, len(batch))
 
-def get_returns(race_id_list, today_str):
     try:
+        with open_part_writer(
+            "raw_race_results", "race_results", today_str, results_progress
+        ) as results_writer, open_part_writer(
+            "raw_race_return_all", "race_return_all", today_str, returns_progress
+        ) as returns_writer:
+            race_pages = RacePage.iter_scrape(fetch_ids, FETCH_CHUNK_SIZE)
+            for race_id, race_results, returns in iter_race_records(race_pages):
+                if race_results is not None and race_id in results_ids:
+                    results_progress.record(race_id, len(race_results))
+                    for batch in results_batcher.add(race_results):
+                        write_race_results(results_writer, batch)
+                if returns is not None and race_id in returns_ids:
+                    returns_progress.record(race_id, len(returns))
+                    for batch in returns_batcher.add(returns):
+                        write_batch(
+                            returns_writer, returns_progress, format_returns(batch), len(batch)
+                        )
+
+            batch = results_batcher.flush()
+            if batch is not None:
+                write_race_results(results_writer, batch)
+            batch = returns_batcher.flush()
+            if batch is not None:
+                write_batch(
+                    returns_writer, returns_progress, format_returns(batch), len(batch)
+                )
+    finally:
+        # 中断した場合も、転送済みのパートファイルに含まれるレースまでを完了にする
+        results_progress.commit()
+        returns_progress.commit()
+    results_progress.finish()
+    returns_progress.finish()
 
-        # 払い戻し表データを取得
-        returns = Return.scrape(race_id_list)
+    logger.info(
+        f"Race results: {results_writer.total_rows} rows, "
+        f"returns: {returns_writer.total_rows} rows"
+    )
+    return dict(state.get("horse_last_race_dates", {}))
 
-        # 列名を指定された名前に変更
-        returns.columns = [
-            "baken_types",
-            "horse_number",
-            "refund",
-            "popularity",
-            "race_id",
-        ]
 
-        # race_id列を最初の列に移動
-        returns = returns[
-            ["race_id", "baken_types", "horse_number", "refund", "popularity"]
+def get_horse_high_water_marks(horse_id_list):
+    """
+    raw_horse_resultsに登録済みの馬ごとの最新レース日を取得する関数
+
+    Parameters:
+    ----------
+    horse_id_list : list
+        馬IDのリスト
+
+    Returns:
+    ----------
+    high_water_marks : dict
+        馬IDをkey、登録済みの最新レース日(yyyy-mm-dd)をvalueとする辞書
+        未登録の馬は含まれない
+    """
+    bq_client = bigquery.Client()
+    query = f"""
+        SELECT horse_id, FORMAT_DATE('%Y-%m-%d', MAX(date)) AS last_date
+        FROM `{PROJECT_ID}.{DATASET_NAME}.raw_horse_results`
+        WHERE horse_id IN UNNEST(@horse_ids)
+        GROUP BY horse_id
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ArrayQueryParameter(
+                "horse_ids", "STRING", [str(h) for h in horse_id_list]
+            )
         ]
+    )
+    rows = bq_client.query(query, job_config=job_config).result()
+    high_water_marks = {row["horse_id"]: row["last_date"] for row in rows}
+    logger.info(f"Loaded high-water marks for {len(high_water_marks)} horses")
+    return high_water_marks
 
-        # csv出力
-        returns.to_csv(
-            f"{DOWNLOAD_FOLDER}/race_return_all_{today_str}.csv",
-            index=None,
-            encoding="utf-8",
-        )
-        logger.info(
-            f"Returns data saved to {DOWNLOAD_FOLDER}/race_return_all_{today_str}.csv"
-        )
 
-        return
-    except Exception as e:
-        logger.error(f"Error occurred while processing returns data: {e}")
-        raise
+def format_horse_results(horse_results, high_water_marks):
+    """
+    RaceScraper.iter_scrapeで取得した過去成績のレコードバッチを、raw_horse_resultsの列構成に加工する関数
+    登録済みの最新レース日(high_water_marks)より新しい行のみ残す
+    """
+    # 不要な列を削除
+    horse_results = horse_results.drop(["映 像", "厩舎 ｺﾒﾝﾄ", "備考"], axis=1)
+
+    # 列名の変更
+    horse_results.columns = [
+        "date",
+        "venue",
+        "weather",
+        "race_number",
+        "race_name",
+        "num_horses",
+        "frame_number",
+        "horse_number",
+        "odds",
+        "popularity",
+        "finish_position",
+        "jockey",
+        "carried_weight",
+        "distance",
+        "track_condition",
+        "track_index",
+        "time",
+        "difference",
+        "time_index",
+        "passing_order",
+        "pace",
+        "last_3f",
+        "horse_weight",
+        "winner_or_2nd",
+        "prize_money",
+        "horse_id",
+    ]
 
+    # 日付の変換(yyyy-mm-dd)に
+    horse_results["date"] = pd.to_datetime(horse_results["date"], format="%Y/%m/%d")
+    # yyyy-mm-dd形式に変換
+    horse_results["date"] = horse_results["date"].dt.strftime("%Y-%m-%d")
 
-def get_horse_results(horse_id_list, today_str):
+    # 登録済みの最新レース日より新しい行のみ残す
+    last_dates = horse_results["horse_id"].map(high_water_marks).fillna("")
+    horse_results = horse_results[horse_results["date"] > last_dates].copy()
+
+    # データ加工
+    horse_results["race_number"] = horse_results["race_number"].astype("Int64")
+    horse_results["frame_number"] = horse_results["frame_number"].astype("Int64")
+    horse_results["popularity"] = horse_results["popularity"].astype("Int64")
+    return horse_results
+
+
+def get_horse_results(horse_last_race_dates, today_str, state):
+    """
+    馬の過去成績を取得してファイル出力する関数
+    差分取得モードでは、登録済みの最新レース日より新しい行のみを出力し、
+    登録済みの最新レース日以降に出走していない馬は取得自体をスキップする
+    クロール状態で完了済みの馬もスキップする
+
+    Parameters:
+    ----------
+    horse_last_race_dates : dict
+        馬IDをkey、今回取得したレース結果での出走日(yyyy-mm-dd)をvalueとする辞書
+    today_str : str
+        出力ファイル名に付与する日付(yyyymmdd)
+    state : CrawlState
+        クロール状態
+    """
     try:
+        high_water_marks = {}
+        if INCREMENTAL_HORSE_RESULTS:
+            try:
+                high_water_marks = get_horse_high_water_marks(
+                    list(horse_last_race_dates)
+                )
+            except Exception as e:
+                logger.warning(
+                    f"Failed to load high-water marks, falling back to full scrape: {e}"
+                )
+        horse_id_list = [
+            horse_id
+            for horse_id, last_race_date in horse_last_race_dates.items()
+            if high_water_marks.get(horse_id, "") < last_race_date
+        ]
+        logger.info(
+            f"Skipped {len(horse_last_race_dates) - len(horse_id_list)} horses with no new races"
+        )
+        progress = state.start("horse_results", horse_id_list)
+        logger.info(f"Pending horses: {len(progress.ids)} / {len(horse_id_list)}")
+        if not progress.ids:
+            return
+
         # ログインしてセッションを取得
         session = RaceScraper.login_and_get_session(EMAIL, PASSWORD)
 
-        # 過去成績データをスクレイピング
-        horse_results = RaceScraper.scrape(horse_id_list, session)
-
-        # 不要な列を削除
-        horse_results = horse_results.drop(["映 像", "厩舎 ｺﾒﾝﾄ", "備考"], axis=1)
-
-        # 列名の変更
-        horse_results.columns = [
-            "date",
-            "venue",
-            "weather",
-            "race_number",
-            "race_name",
-            "num_horses",
-            "frame_number",
-            "horse_number",
-            "odds",
-            "popularity",
-            "finish_position",
-            "jockey",
-            "carried_weight",
-            "distance",
-            "track_condition",
-            "track_index",
-            "time",
-            "difference",
-            "time_index",
-            "passing_order",
-            "pace",
-            "last_3f",
-            "horse_weight",
-            "winner_or_2nd",
-            "prize_money",
-            "horse_id",
-        ]
-
-        # 日付の変換(yyyy-mm-dd)に
-        horse_results["date"] = pd.to_datetime(horse_results["date"], format="%Y/%m/%d")
-        # yyyy-mm-dd形式に変換
-        horse_results["date"] = horse_results["date"].dt.strftime("%Y-%m-%d")
-
-        # データ加工
-        horse_results["race_number"] = horse_results["race_number"].astype("Int64")
-        horse_results["frame_number"] = horse_results["frame_number"].astype("Int64")
-        horse_results["popularity"] = horse_results["popularity"].astype("Int64")
-
-        # csv出力
-        horse_results.to_csv(
-            f"{DOWNLOAD_FOLDER}/horse_results_{today_str}.csv",
-            index=None,
-            encoding="utf-8",
-        )
-        logger.info(
-            f"Horse results saved to {DOWNLOAD_FOLDER}/horse_results_{today_str}.csv"
+        # 過去成績データをスクレイピングし、レコードバッチごとにファイル出力
+        horse_frames = progress.track(
+            RaceScraper.iter_scrape(progress.ids, session, FETCH_CHUNK_SIZE)
         )
+        try:
+            with open_part_writer(
+                "raw_horse_results", "horse_results", today_str, progress
+            ) as writer:
+                for batch in iter_record_batches(horse_frames, RECORD_BATCH_SIZE):
+                    formatted = format_horse_results(batch, high_water_marks)
+                    write_batch(writer, progress, formatted, len(batch))
+        finally:
+            progress.commit()
+        progress.finish()
+        logger.info(f"{writer.total_rows} new horse result rows")
         return
 
     except Exception as e:
@@ -669,19 +858,26 @@ def get_horse_results(horse_id_list, today_str):
         raise
 
 
-def get_speed_results(race_id_list, today_str):
+def get_speed_results(race_id_list, today_str, state):
     try:
-        speed_results = SpeedScraper.get_index(race_id_list)
-
-        # csv出力
-        speed_results.to_csv(
-            f"{DOWNLOAD_FOLDER}/speed_results_{today_str}.csv",
-            index=None,
-            encoding="utf-8",
-        )
-        logger.info(
-            f"Speed results saved to {DOWNLOAD_FOLDER}/speed_results_{today_str}.csv"
+        progress = state.start("speed_results", race_id_list)
+        logger.info(f"Pending speed indexes: {len(progress.ids)} / {len(race_id_list)}")
+        speed_frames = progress.track(
+            SpeedScraper.iter_index(progress.ids, FETCH_CHUNK_SIZE)
         )
+
+        # レコードバッチごとにファイル出力
+        try:
+            with open_part_writer(
+                "raw_speed_results", "speed_results", today_str, progress
+            ) as writer:
+                for batch in iter_record_batches(speed_frames, RECORD_BATCH_SIZE):
+                    write_batch(writer, progress, batch, len(batch))
+        finally:
+            progress.commit()
+        progress.finish()
+        if progress.ids and writer.total_rows == 0:
+            logger.warning("No speed results were successfully scraped.")
         return
 
     except Exception as e:
@@ -695,16 +891,110 @@ def gcs_uploader(src_file):
         gcs_client = gcs.Client()
         bucket = gcs_client.bucket(DST_BUCKET)
         blob = bucket.blob(src_file)
-        blob.upload_from_filename(src_file_path, content_type="text/csv")
+        blob.upload_from_filename(
+            src_file_path, content_type=OUTPUT_FORMATS[OUTPUT_FORMAT]["content_type"]
+        )
         logger.info(f"File '{src_file}' was successfully uploaded to Cloud Storage.")
+        return True
     except Exception as e:
         logger.error(f"Failed to upload '{src_file}' to Cloud Storage: {e}")
         logger.debug(traceback.format_exc())
-    return
+        return False
+
+
+def run_crawl(from_str, to_str, today_str, include_horses=True):
+    """
+    指定期間のレース結果・払い戻し表・スピード指数・馬の過去成績を取得してファイル出力する関数
+    クロール状態はcrawl_id "race_results_{from_str}_{to_str}" で保存し、中断した場合は続きから再開する
+
+    Parameters:
+    ----------
+    from_str : str
+        取得対象期間の開始日(yyyy-mm-dd)
+    to_str : str
+        取得対象期間の終了日(yyyy-mm-dd)
+    today_str : str
+        出力ファイル名に付与する日付(yyyymmdd)
+    include_horses : bool
+        Falseの場合は馬の過去成績を取得しない (バックフィルで馬ごとにまとめて取得する場合)
+
+    Returns:
+    ----------
+    horse_last_race_dates : dict
+        馬IDをkey、取得したレース結果での出走日(yyyy-mm-dd)の最大値をvalueとする辞書
+        (レース結果の取得に失敗した場合はNone)
+    """
+    # クロール状態の読み込み (同じ取得対象期間の実行が中断していた場合は続きから再開する)
+    logger.info(f"Coverage period is from {from_str} to {to_str}.")
+    state = CrawlState.load(f"race_results_{from_str}_{to_str}")
+
+    # スクレイピング: レース開催日 及び レースID取得 (取得済みの開催日はクロール状態から読み込む)
+    kaisai_date_list = get_kaisai_date(from_str, to_str)
+    race_id_list = get_race_id_list(kaisai_date_list, state)
+    print("race_id_list: ", race_id_list)
+
+    # スクレイピング: スピード指数取得
+    # 取得先ホスト(jiro8.sakura.ne.jp)がnetkeibaと異なるため、別スレッドで並行に取得する
+    logger.info("Race data scraping started")
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    speed_future = executor.submit(get_speed_results, race_id_list, today_str, state)
+
+    # スクレイピング: レース結果・払い戻し表取得 (レース結果ページを共有)
+    try:
+        horse_last_race_dates = get_race_results(race_id_list, today_str, state)
+    except Exception as e:
+        print(f"An error occurred in race_results: {e}")
+        print(traceback.format_exc())
+        horse_last_race_dates = None
+
+    if include_horses and horse_last_race_dates is not None:
+        try:
+            get_horse_results(horse_last_race_dates, today_str, state)
+        except Exception as e:
+            print(f"An error occurred in get_horse_results: {e}")
+            print(traceback.format_exc())
+
+    try:
+        speed_future.result()
+    except Exception as e:
+        print(f"An error occurred in get_speed_results: {e}")
+    finally:
+        executor.shutdown()
+
+    logger.info(f"Race data scraping finished. Crawl state: {state.summary()}")
+    return horse_last_race_dates
+
+
+def upload_remaining_files():
+    """
+    パートファイルは封印した時点でCloud Storageへ転送済みのため、
+    転送に失敗してローカルに残ったファイルを再送する
+    """
+    extension = OUTPUT_FORMATS[OUTPUT_FORMAT]["extension"]
+    output_files = [
+        file for file in os.listdir(path=DOWNLOAD_FOLDER) if file.endswith(extension)
+    ]
+    logger.info(f"{OUTPUT_FORMAT} file upload to Cloud Storage started.")
+    for src_file in output_files:
+        gcs_uploader(src_file)
+    logger.info(f"{OUTPUT_FORMAT} file upload to Cloud Storage finished.")
+
+
+def _get_request_param(request, name):
+    """クエリパラメータまたはJSONボディから値を取得する"""
+    value = request.args.get(name) if getattr(request, "args", None) else None
+    if value is None and hasattr(request, "get_json"):
+        value = (request.get_json(silent=True) or {}).get(name)
+    return value
 
 
 @functions_framework.http
 def main(request):
+    """
+    レース結果取得のエントリポイント
+    通常は前日までの1週間分を取得する。from_date, to_date(yyyy-mm-dd)を指定した場合はその期間を取得する
+    (バックフィルの期間を分割して呼び出す場合など)
+    """
 
     logger.info("Function execution started")
 
@@ -715,52 +1005,17 @@ def main(request):
         yesterday = today - datetime.timedelta(days=1)
         one_week_ago = today - datetime.timedelta(days=7)
         today_str = today.strftime("%Y%m%d")
-        yesterday_str = yesterday.strftime("%Y-%m-%d")
-        one_week_ago_str = one_week_ago.strftime("%Y-%m-%d")
-
-        # スクレイピング: レース開催日 及び レースID取得
-        logger.info(f"Coverage period is from {one_week_ago} to {yesterday}.")
-        kaisai_date_list = get_kaisai_date(one_week_ago_str, yesterday_str)
-        race_id_list = get_race_id_list(kaisai_date_list)
-        print("race_id_list: ", race_id_list)
-
-        # スクレイピング: レース結果取得
-        logger.info("Race data scraping started")
-        try:
-            race_results = get_race_results(race_id_list, today_str)
-        except Exception as e:
-            print(f"An error occurred in race_results: {e}")
-            print(traceback.format_exc())
-            race_results = None
-
-        try:
-            get_returns(race_id_list, today_str)
-        except Exception as e:
-            print(f"An error occurred in get_returns: {e}")
-
-        if race_results is not None:
-            try:
-                horse_id_list = race_results["horse_id"].unique()
-                get_horse_results(horse_id_list, today_str)
-            except Exception as e:
-                print(f"An error occurred in get_horse_results: {e}")
-                print(traceback.format_exc())
-
-        try:
-            get_speed_results(race_id_list, today_str)
-        except Exception as e:
-            print(f"An error occurred in get_speed_results: {e}")
+        from_str = _get_request_param(request, "from_date") or one_week_ago.strftime(
+            "%Y-%m-%d"
+        )
+        to_str = _get_request_param(request, "to_date") or yesterday.strftime(
+            "%Y-%m-%d"
+        )
 
-        logger.info("Race data scraping finished")
+        run_crawl(from_str, to_str, today_str)
 
-        # Cloud Storage バケットへCSVファイル転送
-        csv_files = [
-            file for file in os.listdir(path=DOWNLOAD_FOLDER) if file.endswith(".csv")
-        ]
-        logger.info("CSV file upload to Cloud Storage started.")
-        for src_file in csv_files:
-            gcs_uploader(src_file)
-        logger.info("CSV file upload to Cloud Storage finished.")
+        # Cloud Storage バケットへ出力ファイル転送 (転送に失敗したファイルの再送)
+        upload_remaining_files()
         return "OK"
     except Exception as e:
         logger.error(f"An unexpected error occurred: {e}")
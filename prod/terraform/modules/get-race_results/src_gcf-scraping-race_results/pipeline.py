@@ -0,0 +1,63 @@
+import itertools
+
+import pandas as pd
+
+
+def batched(iterable, size):
+    """iterableを最大size件ずつのリストに分割して返すジェネレータ"""
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+class RecordBatcher:
+    """
+    行数の異なるDataFrame(レース・馬ごとの結果)を受け取り、batch_size行ずつのレコードバッチに詰め直すクラス
+    保持するのはbatch_size行未満の端数のみ
+    """
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self._frames = []
+        self._rows = 0
+
+    def add(self, df):
+        """DataFrameを追加し、batch_size行に達したレコードバッチのリストを返す"""
+        if df is None or df.empty:
+            return []
+        self._frames.append(df)
+        self._rows += len(df)
+        if self._rows < self.batch_size:
+            return []
+        buffer = pd.concat(self._frames, ignore_index=True)
+        n_full = len(buffer) // self.batch_size * self.batch_size
+        batches = [
+            buffer.iloc[start : start + self.batch_size]
+            for start in range(0, n_full, self.batch_size)
+        ]
+        rest = buffer.iloc[n_full:]
+        self._frames = [rest] if len(rest) else []
+        self._rows = len(rest)
+        return batches
+
+    def flush(self):
+        """端数の行をレコードバッチとして返す (端数がなければNone)"""
+        if not self._frames:
+            return None
+        batch = pd.concat(self._frames, ignore_index=True)
+        self._frames = []
+        self._rows = 0
+        return batch
+
+
+def iter_record_batches(frames, batch_size):
+    """
+    DataFrameのイテレータを、batch_size行ずつのレコードバッチのイテレータに変換するジェネレータ
+    最後のバッチのみbatch_size行未満になる
+    """
+    batcher = RecordBatcher(batch_size)
+    for df in frames:
+        yield from batcher.add(df)
+    rest = batcher.flush()
+    if rest is not None:
+        yield rest
@@ -0,0 +1,101 @@
+"""
+プロセス間でレコードを受け渡すための長さ付きフレームのストリーム
+
+scraper.pyを別プロセスで実行する場合に、標準出力の文字列をパースする代わりに利用する
+各フレームは 4バイト(ビッグエンディアン)のペイロード長 + ペイロード で、長さ0のフレームで終端する
+ペイロードの形式は以下のいずれか (ストリームの先頭フレームで形式名を送る)
+- json: 1フレームにつき1レコード(dict)のJSON
+- arrow: 1フレームにつき1つのArrow IPCストリーム (レコードのバッチ)
+get-race_results / get-race_plan の両関数に同じファイルを配置している
+"""
+
+import dataclasses
+import json
+import struct
+
+STREAM_FORMATS = ("json", "arrow")
+
+_HEADER = struct.Struct(">I")
+
+
+def _to_dict(record):
+    if dataclasses.is_dataclass(record):
+        return dataclasses.asdict(record)
+    return record
+
+
+def write_frame(stream, payload):
+    stream.write(_HEADER.pack(len(payload)))
+    stream.write(payload)
+
+
+def read_frame(stream):
+    """フレームを1つ読み込む (終端フレーム・ストリームの終わりではNoneを返す)"""
+    header = stream.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return None
+    (length,) = _HEADER.unpack(header)
+    if length == 0:
+        return None
+    payload = stream.read(length)
+    if len(payload) < length:
+        raise EOFError(f"Truncated frame: expected {length} bytes, got {len(payload)}")
+    return payload
+
+
+def write_records(stream, records, stream_format="json", batch_size=1000):
+    """
+    レコードのリストをストリームに書き込む関数
+
+    Parameters:
+    ----------
+    stream : binary file object
+        書き込み先 (sys.stdout.bufferなど)
+    records : list
+        dictまたはdataclassのレコード
+    stream_format : str
+        "json" または "arrow"
+    batch_size : int
+        arrow形式で1フレームにまとめるレコード数
+    """
+    if stream_format not in STREAM_FORMATS:
+        raise ValueError(f"Unsupported stream format: {stream_format}")
+    write_frame(stream, stream_format.encode())
+    records = [_to_dict(record) for record in records]
+    if stream_format == "json":
+        for record in records:
+            write_frame(stream, json.dumps(record, ensure_ascii=False).encode())
+    else:
+        # pyarrowはarrow形式を利用する場合のみ必要なため、ここでimportする
+        import pyarrow as pa
+
+        for i in range(0, len(records), batch_size):
+            table = pa.Table.from_pylist(records[i : i + batch_size])
+            sink = pa.BufferOutputStream()
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+            write_frame(stream, sink.getvalue().to_pybytes())
+    write_frame(stream, b"")
+    stream.flush()
+
+
+def read_records(stream):
+    """
+    write_recordsで書き込んだストリームからレコード(dict)を順に返すジェネレータ
+    """
+    stream_format = read_frame(stream)
+    if stream_format is None:
+        return
+    stream_format = stream_format.decode()
+    if stream_format not in STREAM_FORMATS:
+        raise ValueError(f"Unsupported stream format: {stream_format}")
+    while True:
+        payload = read_frame(stream)
+        if payload is None:
+            return
+        if stream_format == "json":
+            yield json.loads(payload)
+        else:
+            import pyarrow as pa
+
+            yield from pa.ipc.open_stream(payload).read_all().to_pylist()
@@ -1,6 +1,15 @@
+"""
+レース一覧ページ(ブラウザ)からのレースIDの取得
+
+main.pyからはscrape_race_id_listsをimportして同じプロセス内で実行する
+別プロセスで実行する場合は、結果をrecord_streamの形式で標準出力に書き出す
+
+usage:
+    python scraper.py <kaisai_date_list> <RACE_LIST_URL> [json|arrow]
+"""
+
 import ast
 import asyncio
-import json
 import logging
 import os
 import re
@@ -10,24 +19,96 @@ import sys
 from pyppeteer import launch
 from pyppeteer.errors import NetworkError, TimeoutError
 
-# 環境変数取得
-# load_dotenv()
-DOWNLOAD_FOLDER = os.environ.get("DOWNLOAD_FOLDER")
+from record_stream import write_records
 
-
-# ロギングの設定
-logging.basicConfig(
-    level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s"
-)
 logger = logging.getLogger(__name__)
 
 
-async def scraping_race_info(kaisai_date_list, RACE_LIST_URL):
+# 1つのブラウザで同時に開くタブの数
+SCRAPER_MAX_TABS = int(os.environ.get("SCRAPER_MAX_TABS", 4))
+# 1ページ(タブを開いてからレース一覧を抽出するまで)あたりの制限時間(秒)
+SCRAPER_PAGE_TIMEOUT = float(os.environ.get("SCRAPER_PAGE_TIMEOUT", 60))
+# レース一覧の抽出に不要なため読み込まないリソースの種類
+BLOCKED_RESOURCE_TYPES = {"image", "media", "font", "stylesheet"}
+
+
+async def _intercept(request):
+    if request.resourceType in BLOCKED_RESOURCE_TYPES:
+        await request.abort()
+    else:
+        await request.continue_()
+
+
+async def _scrape_race_list(browser, url):
+    logger.info(f"scraping: {url}")
+
+    page = await browser.newPage()
+    try:
+        await page.setRequestInterception(True)
+        page.on("request", lambda request: asyncio.ensure_future(_intercept(request)))
+
+        timeout_ms = int(SCRAPER_PAGE_TIMEOUT * 1000)
+        await page.goto(url, {"timeout": timeout_ms, "waitUntil": "domcontentloaded"})
+        await page.waitForSelector(".RaceList_Box", {"visible": True, "timeout": timeout_ms})
+
+        hrefs = await page.evaluate(
+            """() => {
+            const raceItems = document.querySelectorAll('.RaceList_DataItem a[href*="result.html"]');
+            const hrefs = [];
+            raceItems.forEach(aTag => {
+                hrefs.push(aTag.href);
+            });
+            return hrefs;
+        }"""
+        )
+
+        # hrefsからrace_idを抽出
+        pattern = r"race_id=(\d+)"
+        race_id_list = []
+        for href in hrefs:
+            match = re.search(pattern, href)
+            if match:
+                race_id_list.append(match.group(1))
+        return race_id_list
+    finally:
+        await page.close()
+
+
+async def _scrape_race_list_bounded(browser, semaphore, kaisai_date, RACE_LIST_URL):
+    """
+    同時に開くタブの数と1ページあたりの制限時間の範囲で、1開催日のレースIDを取得する
+    取得に失敗した場合はNoneを返す
+    """
+    query = ["kaisai_date=" + str(kaisai_date)]
+    url = RACE_LIST_URL + "?" + "&".join(query)
+    async with semaphore:
+        try:
+            return await asyncio.wait_for(
+                _scrape_race_list(browser, url), SCRAPER_PAGE_TIMEOUT
+            )
+        except (asyncio.TimeoutError, TimeoutError):
+            logger.error(f"Timeout error while scraping {url}")
+        except NetworkError as e:
+            logger.error(f"Network error while scraping {url}: {e}")
+        except Exception as e:
+            logger.error(f"Unexpected error while scraping {url}: {e}")
+    return None
+
+
+async def scrape_race_id_lists(kaisai_date_list, RACE_LIST_URL) -> dict[str, list[str]]:
+    """
+    開催日ごとのレース一覧ページから、開催日ごとのレースIDを取得する関数
+    取得に失敗した開催日(ブラウザの起動に失敗した場合は全ての開催日)は結果に含めない
+    """
     browser = None
     try:
         # ブラウザ起動
         browser = await launch(
             headless=True,
+            # Cloud Functionsのワーカースレッドからの起動ではシグナルハンドラを登録できない
+            handleSIGINT=False,
+            handleSIGTERM=False,
+            handleSIGHUP=False,
             args=[
                 # '--user-agent=Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/116.0.0.0 Safari/537.36',
                 # "--start-maximized",
@@ -35,61 +116,28 @@ async def scraping_race_info(kaisai_date_list, RACE_LIST_URL):
         )
         logger.info("Launched browser.")
 
-        race_id_list = []
-        for kaisai_date in kaisai_date_list:
-            try:
-                query = ["kaisai_date=" + str(kaisai_date)]
-                url = RACE_LIST_URL + "?" + "&".join(query)
-                print(f"scraping: {url}")
-
-                page = await browser.newPage()
-                await page.goto(url, {"timeout": 180000})
-                await page.waitForSelector(".RaceList_Box", {"visible": True})
-
-                hrefs = await page.evaluate(
-                    """() => {
-                    const raceItems = document.querySelectorAll('.RaceList_DataItem a[href*="result.html"]');
-                    const hrefs = [];
-                    raceItems.forEach(aTag => {
-                        hrefs.push(aTag.href);
-                    });
-                    return hrefs;
-                }"""
-                )
-
-                # hrefsからrace_idを抽出
-                pattern = r"race_id=(\d+)"
-                for href in hrefs:
-                    match = re.search(pattern, href)
-                    if match:
-                        race_id_list.append(match.group(1))
-            except TimeoutError:
-                logger.error(f"Timeout error while scraping {url}")
-            except NetworkError as e:
-                logger.error(f"Network error while scraping {url}: {e}")
-            except Exception as e:
-                logger.error(f"Unexpected error while scraping {url}: {e}")
-            finally:
-                if page:
-                    await page.close()
-
-        await browser.close()
-
-        # /tmp/ に race_id_list.json を保存
-        filepath = os.path.join(DOWNLOAD_FOLDER, "race_id_list.json")
-        with open(filepath, "w") as f:
-            json.dump(race_id_list, f)
-
-        logger.info(f"Saved race_id_list to {filepath}")
-        logger.info(f"Total race IDs scraped: {len(race_id_list)}")
-
-        # race_idリスト出力
-        logger.info(race_id_list)
-        return
+        # 開催日ごとのページを最大SCRAPER_MAX_TABSタブで並行に取得する (結果は開催日の順)
+        semaphore = asyncio.Semaphore(SCRAPER_MAX_TABS)
+        results = await asyncio.gather(
+            *[
+                _scrape_race_list_bounded(browser, semaphore, kaisai_date, RACE_LIST_URL)
+                for kaisai_date in kaisai_date_list
+            ]
+        )
+        race_id_lists = {
+            kaisai_date: result
+            for kaisai_date, result in zip(kaisai_date_list, results)
+            if result is not None
+        }
+        logger.info(
+            f"Total race IDs scraped: {sum(len(r) for r in race_id_lists.values())} "
+            f"({len(race_id_lists)} / {len(kaisai_date_list)} dates)"
+        )
+        return race_id_lists
 
     except Exception as e:
         logger.error(f"An error occurred during scraping: {e}")
-        return []
+        return {}
 
     finally:
         if browser:
@@ -97,14 +145,33 @@ async def scraping_race_info(kaisai_date_list, RACE_LIST_URL):
             logger.info("Closed browser.")
 
 
+async def scrape_race_id_list(kaisai_date_list, RACE_LIST_URL) -> list[str]:
+    """
+    開催日ごとのレース一覧ページから、レースIDを開催日の順に取得する関数
+    取得に失敗した開催日はログを出力して除外する
+    """
+    race_id_lists = await scrape_race_id_lists(kaisai_date_list, RACE_LIST_URL)
+    return [race_id for kaisai_date in kaisai_date_list for race_id in race_id_lists.get(kaisai_date, [])]
+
+
 if __name__ == "__main__":
+    # ロギングの設定 (標準出力はレコードのストリームに使うため、ログは標準エラー出力に出す)
+    logging.basicConfig(
+        level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
     try:
         # コマンドライン引数から変数を取得
         kaisai_date_list = ast.literal_eval(sys.argv[1])
         RACE_LIST_URL = sys.argv[2]
+        stream_format = sys.argv[3] if len(sys.argv) > 3 else "json"
         logger.info(f"RACE_LIST_URL: {RACE_LIST_URL}")
 
-        asyncio.run(scraping_race_info(kaisai_date_list, RACE_LIST_URL))
+        race_id_list = asyncio.run(scrape_race_id_list(kaisai_date_list, RACE_LIST_URL))
+        write_records(
+            sys.stdout.buffer,
+            [{"race_id": race_id} for race_id in race_id_list],
+            stream_format,
+        )
 
     except IndexError:
         logger.error("Not enough command line arguments provided.")
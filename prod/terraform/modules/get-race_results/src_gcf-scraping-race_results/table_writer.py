@@ -0,0 +1,325 @@
+import decimal
+import json
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+# BigQueryテーブルのスキーマ定義
+# Terraformモジュールの bq_schema/*.json と同じ内容のファイルを、関数のソースに含めて配置している
+BQ_SCHEMA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bq_schema")
+
+# 出力形式ごとの拡張子・Content-Type (bq_uploaderはContent-Typeでロード形式を判定する)
+OUTPUT_FORMATS = {
+    "csv": {"extension": ".csv", "content_type": "text/csv"},
+    "parquet": {"extension": ".parquet", "content_type": "application/vnd.apache.parquet"},
+}
+
+
+def load_schema(table_name):
+    """
+    bq_schema/{table_name}.json のスキーマ定義を読み込む関数
+
+    Returns:
+    ----------
+    schema : list
+        name, type, mode を持つ列定義(dict)のリスト
+    """
+    with open(os.path.join(BQ_SCHEMA_DIR, f"{table_name}.json"), "r") as f:
+        return json.load(f)
+
+
+def _is_null(value):
+    # CSVロードと同じく、空文字列もNULLとして扱う
+    return pd.isna(value) or str(value).strip() == ""
+
+
+def _to_decimal(value):
+    # NUMERIC列: 浮動小数点を経由せずに文字列表記のまま10進数に変換する
+    # 数値として解釈できない値("---"など)はNULLとする
+    if _is_null(value):
+        return None
+    try:
+        number = decimal.Decimal(str(value).replace(",", ""))
+    except decimal.InvalidOperation:
+        return None
+    return number if number.is_finite() else None
+
+
+def _to_string(value):
+    if _is_null(value):
+        return None
+    return str(value)
+
+
+def _convert_column(series, field_type):
+    """
+    列をBigQueryの型に対応するpyarrowの配列に変換する
+    型に変換できない値はNULLとする (件数はto_arrow_tableでログに出力する)
+    """
+    if field_type == "STRING":
+        return pa.array(series.map(_to_string), type=pa.string())
+    if field_type == "INTEGER":
+        values = pd.to_numeric(series.map(_to_string), errors="coerce").astype("Int64")
+        return pa.array(values, type=pa.int64(), from_pandas=True)
+    if field_type == "FLOAT":
+        values = pd.to_numeric(series.map(_to_string), errors="coerce").astype(float)
+        return pa.array(values, type=pa.float64(), from_pandas=True)
+    if field_type == "NUMERIC":
+        # BigQueryのNUMERICは精度38桁・小数点以下9桁
+        return pa.array(series.map(_to_decimal), type=pa.decimal128(38, 9))
+    if field_type == "DATE":
+        values = pd.to_datetime(series, errors="coerce").dt.date
+        return pa.array(values, type=pa.date32(), from_pandas=True)
+    raise ValueError(f"Unsupported BigQuery type: {field_type}")
+
+
+def to_arrow_table(df, schema):
+    """
+    DataFrameをスキーマ定義どおりの列名・型のpyarrow.Tableに変換する関数
+    CSVロード(skip_leading_rows=1)と同じく、列の位置でスキーマの列に対応付ける
+    型に変換できない値はNULLとし、REQUIRED列がNULLになった行は除外する (いずれも列ごとの件数をログに出力する)
+
+    Parameters:
+    ----------
+    df : pandas.DataFrame
+        出力するデータ
+    schema : list
+        load_schemaで読み込んだ列定義
+
+    Returns:
+    ----------
+    table : pyarrow.Table
+    """
+    if len(df.columns) != len(schema):
+        raise ValueError(
+            f"Column count mismatch: {len(df.columns)} columns for {len(schema)} schema fields"
+        )
+    arrays = []
+    fields = []
+    keep = np.ones(len(df), dtype=bool)
+    for (column, series), field in zip(df.items(), schema):
+        series = series.reset_index(drop=True)
+        try:
+            array = _convert_column(series, field["type"])
+        except (ValueError, TypeError, decimal.InvalidOperation, pa.ArrowInvalid) as e:
+            raise ValueError(
+                f"Failed to convert column '{column}' to {field['type']}: {e}"
+            ) from e
+        invalid = array.null_count - int(series.map(_is_null).sum())
+        if invalid:
+            logger.warning(
+                f"Column '{column}': {invalid} values could not be converted to {field['type']} "
+                "and were set to null"
+            )
+        required = field.get("mode") == "REQUIRED"
+        if required and array.null_count:
+            logger.warning(
+                f"Column '{column}': dropped {array.null_count} rows with null values in a REQUIRED column"
+            )
+            keep &= ~array.is_null().to_numpy(zero_copy_only=False)
+        arrays.append(array)
+        fields.append(pa.field(field["name"], array.type, nullable=not required))
+    if not keep.all():
+        arrays = [array.filter(pa.array(keep)) for array in arrays]
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+
+def write_table(df, table_name, path, output_format="parquet", compression="zstd"):
+    """
+    スクレイピング結果をファイル出力する関数
+
+    Parameters:
+    ----------
+    df : pandas.DataFrame
+        出力するデータ (列順はBigQueryテーブルのスキーマと同じ)
+    table_name : str
+        ロード先のBigQueryテーブル名 (bq_schemaのファイル名)
+    path : str
+        拡張子を除いた出力先のパス
+    output_format : str
+        "parquet" または "csv"
+    compression : str
+        Parquetの圧縮形式 ("zstd", "snappy", "none" など)
+
+    Returns:
+    ----------
+    path : str
+        出力したファイルのパス
+    """
+    path += OUTPUT_FORMATS[output_format]["extension"]
+    if output_format == "csv":
+        df.to_csv(path, index=None, encoding="utf-8")
+        return path
+
+    table = to_arrow_table(df, load_schema(table_name))
+    pq.write_table(table, path, compression=compression)
+    logger.debug(f"Wrote {table.num_rows} rows to {path} (compression: {compression})")
+    return path
+
+
+class PartFileWriter:
+    """
+    レコードバッチを連番のパートファイル ({path_prefix}_part-00000.parquet, ...) に逐次書き込むクラス
+    ファイルの行数がrows_per_fileに達した時点、またはファイルを開いてからmax_seconds秒が経過した時点で
+    ファイルを閉じ(封印し)、on_sealにファイルパスを渡す
+    with文を抜ける際は例外発生時も含めて書き込み中のファイルを封印するため、途中までの結果が残る
+
+    Parameters:
+    ----------
+    table_name : str
+        ロード先のBigQueryテーブル名 (bq_schemaのファイル名)
+    path_prefix : str
+        パートファイルの出力先パスの接頭辞
+    output_format : str
+        "parquet" または "csv"
+    compression : str
+        Parquetの圧縮形式
+    rows_per_file : int
+        1ファイルあたりの行数の目安
+    max_seconds : float
+        1ファイルを開いておく秒数の目安 (Noneは無制限)
+    on_seal : callable
+        封印したファイルのパスを受け取る関数 (Cloud Storageへのアップロードなど)
+    """
+
+    def __init__(
+        self,
+        table_name,
+        path_prefix,
+        output_format="parquet",
+        compression="zstd",
+        rows_per_file=50000,
+        max_seconds=None,
+        on_seal=None,
+    ):
+        self.table_name = table_name
+        self.path_prefix = path_prefix
+        self.output_format = output_format
+        self.compression = compression
+        self.rows_per_file = rows_per_file
+        self.max_seconds = max_seconds
+        self.on_seal = on_seal
+        self.schema = load_schema(table_name) if output_format == "parquet" else None
+        self.part_number = 0
+        self.total_rows = 0
+        self.sealed_paths = []
+        self._path = None
+        self._rows = 0
+        self._opened_at = None
+        self._parquet_writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _open(self):
+        extension = OUTPUT_FORMATS[self.output_format]["extension"]
+        self._path = f"{self.path_prefix}_part-{self.part_number:05d}{extension}"
+        self._rows = 0
+        self._opened_at = time.monotonic()
+        self.part_number += 1
+
+    def _is_full(self):
+        if self._rows >= self.rows_per_file:
+            return True
+        return (
+            self.max_seconds is not None
+            and time.monotonic() - self._opened_at >= self.max_seconds
+        )
+
+    def write(self, df):
+        """
+        レコードバッチ(DataFrame)を書き込む
+
+        Returns:
+        ----------
+        path : str
+            書き込みによってファイルを封印した場合はそのパス、それ以外はNone
+        """
+        if df.empty:
+            return None
+        if self._path is None:
+            self._open()
+        if self.output_format == "csv":
+            df.to_csv(
+                self._path, mode="a", header=self._rows == 0, index=None, encoding="utf-8"
+            )
+        else:
+            table = to_arrow_table(df, self.schema)
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(
+                    self._path, table.schema, compression=self.compression
+                )
+            self._parquet_writer.write_table(table)
+        self._rows += len(df)
+        self.total_rows += len(df)
+        if self._is_full():
+            return self.seal()
+        return None
+
+    def seal(self):
+        """書き込み中のファイルを閉じてon_sealに渡し、封印したファイルのパスを返す"""
+        if self._path is None:
+            return None
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        path = self._path
+        self._path = None
+        logger.info(f"Sealed {path} ({self._rows} rows)")
+        self.sealed_paths.append(path)
+        if self.on_seal is not None:
+            self.on_seal(path)
+        return path
+
+    def close(self):
+        self.seal()
+
+
+def merge_part_files(paths, path, output_format="parquet", compression="zstd"):
+    """
+    パートファイルを指定順に連結して1つのファイルに出力する関数
+    1ファイルずつ読み込んで追記するため、メモリに保持するのは1パート分のみ
+
+    Parameters:
+    ----------
+    paths : list
+        連結するパートファイルのパス (この順に連結する)
+    path : str
+        出力先のパス
+    output_format : str
+        "parquet" または "csv"
+    compression : str
+        Parquetの圧縮形式
+    """
+    if output_format == "csv":
+        # ヘッダ行は先頭のファイルのみ残す
+        with open(path, "wb") as out:
+            for i, part_path in enumerate(paths):
+                with open(part_path, "rb") as f:
+                    header = f.readline()
+                    if i == 0:
+                        out.write(header)
+                    shutil.copyfileobj(f, out)
+        return
+
+    writer = None
+    try:
+        for part_path in paths:
+            table = pq.read_table(part_path)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema, compression=compression)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
@@ -19,3 +19,6 @@ variable "gcf_source_bucket" {
 variable "notification_channel_id" {
   type = string
 }
+variable "calendar_cache_bucket" {
+  type = string
+}
@@ -0,0 +1,226 @@
+"""
+払い戻しテーブルを用いた馬券購入シミュレーション(回収率の計算)
+
+払い戻しテーブル(raw_race_return_all / pay_results.csv)を1度だけパースし、
+(race_id, 券種, 馬番の組合せ)をkeyとした払い戻しに変換しておくことで、
+予測全体の的中・払い戻しをレースごとのループではなくjoinで計算する
+"""
+
+import numpy as np
+import pandas as pd
+
+# 券種ごとの (組み合わせる頭数, 着順通りかどうか)
+# 枠連は馬番ではなく枠番の組合せのため対象外
+BET_TYPES = {
+    '単勝': (1, False),
+    '複勝': (1, False),
+    '馬連': (2, False),
+    'ワイド': (2, False),
+    '馬単': (2, True),
+    '三連複': (3, False),
+    '三連単': (3, True),
+}
+
+# 05_馬券の購入シミュレーション の recovery_rate の bet 引数との対応
+BET_NAMES = {
+    'tansho': '単勝',
+    'fukusho': '複勝',
+    'umaren': '馬連',
+    'wide': 'ワイド',
+    'umatan': '馬単',
+    'sanrenpuku': '三連複',
+    'sanrentan': '三連単',
+}
+
+# 1点あたりの購入金額
+BET_UNIT = 100
+
+
+def combination_key(horses, ordered):
+    """
+    馬番の組合せをint64の1つの値に変換する関数 (馬番は2桁以内)
+    着順を問わない券種は馬番を昇順に並べてから変換する
+
+    Parameters:
+    ----------
+    horses : numpy.ndarray
+        (行数, 頭数) の馬番の配列
+    ordered : bool
+        着順通りの組合せかどうか
+
+    Returns:
+    ----------
+    key : numpy.ndarray
+    """
+    horses = np.asarray(horses, dtype=np.int64)
+    if not ordered:
+        horses = np.sort(horses, axis=1)
+    key = np.zeros(len(horses), dtype=np.int64)
+    for i in range(horses.shape[1]):
+        key = key * 100 + horses[:, i]
+    return key
+
+
+class PayoutTable:
+    """
+    払い戻しを (race_id, bet_type, key) で引けるようにしたテーブル
+
+    Parameters:
+    ----------
+    payouts : pandas.DataFrame
+        race_id, bet_type, key, refund の列を持つデータ
+        parse_return_tablesで作成する
+    """
+
+    def __init__(self, payouts):
+        self.payouts = payouts
+        self.race_ids = pd.Index(payouts['race_id'].unique())
+
+    @classmethod
+    def from_return_tables(cls, return_tables):
+        return cls(parse_return_tables(return_tables))
+
+    def settle(self, bets):
+        """
+        購入した馬券に払い戻し金額(refund)を付与する。外れた馬券のrefundは0
+        払い戻しデータのないレース(中止・データ未取得)の馬券は対象外とする
+        """
+        bets = bets[bets['race_id'].isin(self.race_ids)]
+        settled = bets.merge(self.payouts, on=['race_id', 'bet_type', 'key'], how='left')
+        settled['refund'] = settled['refund'].fillna(0).astype(np.int64)
+        return settled
+
+
+def parse_return_tables(return_tables):
+    """
+    払い戻しテーブルを1行1払い戻しの形式に変換する関数
+    1つの券種に複数の払い戻しがある場合(複勝・ワイド・同着)は "br" で区切られている
+
+    Parameters:
+    ----------
+    return_tables : pandas.DataFrame
+        race_id, baken_types, horse_number, refund の列を持つ払い戻しテーブル
+        例: 複勝 "1br3br4" / "110br110br470", ワイド "1 - 3br1 - 4br3 - 4" / "120br840br1,100"
+
+    Returns:
+    ----------
+    payouts : pandas.DataFrame
+        race_id, bet_type, key, refund の列を持つデータ
+    """
+    df = return_tables[return_tables['baken_types'].isin(BET_TYPES)]
+    df = pd.DataFrame({
+        'race_id': df['race_id'].astype(np.int64).to_numpy(),
+        'bet_type': df['baken_types'].to_numpy(),
+        'horses': df['horse_number'].astype(str).str.split('br').to_numpy(),
+        'refund': df['refund'].astype(str).str.split('br').to_numpy(),
+    })
+    # 馬番と払い戻しの個数が一致しない行は除外
+    df = df[df['horses'].str.len() == df['refund'].str.len()]
+    df = df.explode(['horses', 'refund'], ignore_index=True)
+    df['refund'] = pd.to_numeric(df['refund'].str.replace(',', ''), errors='coerce')
+
+    frames = []
+    for bet_type, (size, ordered) in BET_TYPES.items():
+        bet_df = df[df['bet_type'] == bet_type]
+        horses = bet_df['horses'].str.split(r'\s*(?:-|→)\s*', expand=True, regex=True)
+        if horses.shape[1] < size:
+            continue
+        horses = horses.apply(pd.to_numeric, errors='coerce')
+        # 頭数が券種と一致しない組合せは除外
+        valid = bet_df['refund'].notna() & horses.iloc[:, size:].isna().all(axis=1)
+        horses = horses.iloc[:, :size]
+        valid &= horses.notna().all(axis=1)
+        if not valid.any():
+            continue
+        frames.append(pd.DataFrame({
+            'race_id': bet_df.loc[valid, 'race_id'].to_numpy(),
+            'bet_type': bet_type,
+            'key': combination_key(horses[valid].to_numpy(), ordered),
+            'refund': bet_df.loc[valid, 'refund'].astype(np.int64).to_numpy(),
+        }))
+    if not frames:
+        return pd.DataFrame({'race_id': [], 'bet_type': [], 'key': [], 'refund': []})
+    return pd.concat(frames, ignore_index=True)
+
+
+def make_bets(picks, bet_type, race_id='race_id', horse_number='horse_number'):
+    """
+    レースごとの購入対象馬から、券種の組合せをすべて購入した場合の馬券を作成する関数
+
+    Parameters:
+    ----------
+    picks : pandas.DataFrame
+        購入対象馬の行のみを含むデータ
+    bet_type : str
+        券種 (BET_TYPESのkey)
+
+    Returns:
+    ----------
+    bets : pandas.DataFrame
+        race_id, bet_type, key, horses の列を持つデータ (1行1点)
+    """
+    size, ordered = BET_TYPES[bet_type]
+    picks = picks[[race_id, horse_number]].rename(columns={race_id: 'race_id', horse_number: 'h0'})
+    picks = picks.astype(np.int64)
+    bets = picks
+    for i in range(1, size):
+        # 同じレースの購入対象馬同士を組み合わせる (着順を問わない券種は馬番の昇順の組のみ)
+        bets = bets.merge(picks.rename(columns={'h0': f'h{i}'}), on='race_id')
+        if ordered:
+            bets = bets[np.all([bets[f'h{i}'] != bets[f'h{j}'] for j in range(i)], axis=0)]
+        else:
+            bets = bets[bets[f'h{i}'] > bets[f'h{i - 1}']]
+    horse_columns = [f'h{i}' for i in range(size)]
+    horses = bets[horse_columns].to_numpy()
+    return pd.DataFrame({
+        'race_id': bets['race_id'].to_numpy(),
+        'bet_type': bet_type,
+        'key': combination_key(horses, ordered),
+        'horses': [list(h) for h in horses],
+    })
+
+
+def summarize(settled):
+    """購入した馬券の的中数・的中率・回収金額・回収率を集計する"""
+    bets = len(settled)
+    hits = int((settled['refund'] > 0).sum())
+    refund = int(settled['refund'].sum())
+    return {
+        'races': settled['race_id'].nunique(),
+        'bets': bets,
+        'hits': hits,
+        'hit_rate': hits / bets if bets else np.nan,
+        'refund': refund,
+        'recovery_rate': refund / (bets * BET_UNIT) if bets else np.nan,
+    }
+
+
+def backtest(picks, payout_table, bet_types=('複勝', 'ワイド')):
+    """
+    購入対象馬に対して券種ごとの回収率を計算する関数
+
+    Parameters:
+    ----------
+    picks : pandas.DataFrame
+        購入対象馬の行のみを含むデータ (race_id, horse_number の列を持つ)
+    payout_table : PayoutTable
+        払い戻しテーブル
+    bet_types : list
+        計算する券種
+
+    Returns:
+    ----------
+    summary : pandas.DataFrame
+        券種ごとの races, bets, hits, hit_rate, refund, recovery_rate
+    settled : pandas.DataFrame
+        払い戻し金額を付与した購入馬券
+    """
+    settled = pd.concat(
+        [payout_table.settle(make_bets(picks, bet_type)) for bet_type in bet_types],
+        ignore_index=True,
+    )
+    summary = pd.DataFrame(
+        [dict(bet_type=bet_type, **summarize(settled[settled['bet_type'] == bet_type])) for bet_type in bet_types]
+    ).set_index('bet_type')
+    return summary, settled
+
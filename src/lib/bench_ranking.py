@@ -0,0 +1,86 @@
+"""
+レースごとの上位3頭フラグ(pred_class)の計算速度の比較
+03_モデルの学習 の従来のループ処理・pandasのgroupby rank・ranking.pyの処理を比較する
+
+simulation_dataのCSVのレースIDを付け替えて複製し、複数年分のデータ量に拡大して計測する
+(1年分は約3,400レース・約47,000行)
+
+usage:
+    python bench_ranking.py <simulation_csv> [scale ...]
+"""
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from ranking import add_race_rankings, top_k_flags
+
+
+def legacy_pred_class(train):
+    # 03_モデルの学習 の処理
+    submit = pd.DataFrame()
+    pred_list = []
+
+    for race in train['race_id'].unique():
+        data = train[train['race_id'] == race]
+        data = data.sort_values(by='pred', ascending=False).reset_index()
+        for index, data_ in data.iterrows():
+            if index < 3:
+                pred_list.append(1)
+            else:
+                pred_list.append(0)
+        submit = pd.concat([submit, data])
+
+    submit['pred_class'] = pred_list
+    submit = submit.sort_values(by='index', ascending=True)
+    return submit['pred_class'].to_numpy()
+
+
+def groupby_pred_class(df):
+    rank = df.groupby('race_id')['pred'].rank(method='first', ascending=False)
+    return (rank <= 3).astype(int).to_numpy()
+
+
+def lexsort_pred_class(df):
+    return top_k_flags(df['race_id'].to_numpy(), df['pred'].to_numpy())
+
+
+def scale_up(df, scale):
+    # レースIDに複製番号を付与して別レースとして複製する
+    frames = []
+    for i in range(scale):
+        copied = df.copy()
+        copied['race_id'] = copied['race_id'] * 1000 + i
+        frames.append(copied)
+    return pd.concat(frames, ignore_index=True)
+
+
+def _bench(name, func, df):
+    start = time.perf_counter()
+    result = func(df)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    print(f'  {name:<20} {elapsed_ms:10.1f} ms')
+    return result
+
+
+def main(path, scales=(1, 10, 100)):
+    base = pd.read_csv(path)
+    for scale in scales:
+        df = scale_up(base, scale)
+        print(f'scale: x{scale} (races: {df["race_id"].nunique()}, rows: {len(df)})')
+        # 従来処理はレース数の2乗に比例するため、小さいデータのみで計測する
+        legacy = _bench('legacy loop', legacy_pred_class, df) if scale <= 10 else None
+        grouped = _bench('groupby rank', groupby_pred_class, df)
+        flags = _bench('ranking.top_k_flags', lexsort_pred_class, df)
+        _bench('add_race_rankings', lambda d: add_race_rankings(d), df)
+
+        # 計算結果が一致することを確認
+        assert np.array_equal(grouped, flags)
+        if legacy is not None:
+            assert np.array_equal(legacy, flags)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], [int(s) for s in sys.argv[2:]] or (1, 10, 100))
@@ -0,0 +1,156 @@
+"""
+馬・騎手・調教師ごとの直近の成績(フォーム)のインデックス
+
+キーごとの成績を開催日順に1つの配列に並べ、累積和を保持することで、
+任意の開催日より前の直近window件の平均を、BigQueryへの問い合わせやDataFrameの走査なしに配列の参照のみで返す
+特徴量ストア(feature_store.py)が開催日ごとの増分で更新・保存し、lookupで参照する
+予測サービスには同じ内容のファイルを src_gcf-race_prediction/form_index.py として配置している
+"""
+
+import io
+
+import numpy as np
+import pandas as pd
+
+# 開催日は1900-01-01からの日数として保持し、キーの番号と合わせて1つの整数(key_code << DAY_BITS | day)で並べる
+EPOCH = np.datetime64('1900-01-01', 'D')
+DAY_BITS = 20
+
+
+def _to_days(dates):
+    try:
+        # datetime64・yyyy-mm-ddの文字列・datetime.dateはpandasを経由せずに変換する (予測時の参照を速くするため)
+        days = np.asarray(dates, dtype='datetime64[D]')
+    except (TypeError, ValueError):
+        days = np.asarray(pd.to_datetime(pd.Series(dates)).to_numpy(), dtype='datetime64[D]')
+    return (days - EPOCH).astype(np.int64)
+
+
+class FormIndex:
+    """
+    キーごとの成績を開催日順に並べた配列から、直近window件の集計を返すインデックス
+
+    Parameters:
+    ----------
+    keys : numpy.ndarray
+        キー(文字列)の昇順の一覧
+    key_codes : numpy.ndarray
+        成績ごとのキーの番号 (keysの位置)。key_codes・daysの順に並んでいること
+    days : numpy.ndarray
+        成績ごとの開催日 (1900-01-01からの日数)
+    values : numpy.ndarray
+        成績ごと・集計項目ごとの値 (成績の行数 × 集計項目数。値がない場合はNaN)
+    stats : list
+        集計項目名
+    window : int
+        集計する直近の成績の件数
+    """
+
+    def __init__(self, keys, key_codes, days, values, stats, window):
+        self.keys = np.asarray(keys, dtype=str)
+        self.key_codes = np.asarray(key_codes, dtype=np.int64)
+        self.days = np.asarray(days, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.float32).reshape(len(self.key_codes), len(stats))
+        self.stats = list(stats)
+        self.window = int(window)
+
+        # 参照用の配列: キー・開催日の並び順、キーごとの開始位置、集計項目ごとの累積和・値がある件数の累積
+        self._positions = (self.key_codes << DAY_BITS) | self.days
+        self._starts = np.searchsorted(self._positions, np.arange(len(self.keys) + 1, dtype=np.int64) << DAY_BITS)
+        present = ~np.isnan(self.values)
+        self._sums = np.vstack([np.zeros((1, len(stats))), np.cumsum(np.where(present, self.values, 0), axis=0, dtype=np.float64)])
+        self._counts = np.vstack([np.zeros((1, len(stats)), np.int64), np.cumsum(present, axis=0)])
+
+    @classmethod
+    def empty(cls, stats, window):
+        return cls(np.array([], dtype=str), [], [], np.empty((0, len(stats))), stats, window)
+
+    @classmethod
+    def from_events(cls, events, stats, window):
+        """
+        成績(key・date・集計項目の列を持つDataFrame)からインデックスを作成する
+        同じキー・開催日の成績はeventsの行順に並べる
+        """
+        events = events[events['key'].notna()]
+        keys, key_codes = np.unique(events['key'].astype(str).to_numpy(), return_inverse=True)
+        days = _to_days(events['date'])
+        order = np.lexsort((days, key_codes))
+        values = events[stats].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+        return cls(keys, key_codes[order], days[order], values[order], stats, window)
+
+    def to_events(self):
+        """保持している成績をfrom_eventsと同じ形式のDataFrameで返す"""
+        events = pd.DataFrame(self.values, columns=self.stats)
+        events.insert(0, 'key', self.keys[self.key_codes])
+        events.insert(1, 'date', EPOCH + self.days.astype('timedelta64[D]'))
+        return events
+
+    def update(self, events):
+        """
+        成績を追加したインデックスを返す
+        保持している成績より前の開催日の成績も追加できる (from_eventsでキー・開催日順に並べ直す)
+        同じキー・開催日の成績は保持している成績の後ろに並べる
+        """
+        events = pd.concat([self.to_events(), events[['key', 'date'] + self.stats]], ignore_index=True)
+        return FormIndex.from_events(events, self.stats, self.window)
+
+    def __len__(self):
+        return len(self.key_codes)
+
+    def _codes(self, keys):
+        """キーの番号と、キーがインデックスにあるか"""
+        codes = np.searchsorted(self.keys, keys)
+        found = codes < len(self.keys)
+        found[found] = self.keys[codes[found]] == keys[found]
+        return np.where(found, codes, 0), found
+
+    def contains(self, keys, dates):
+        """キー・開催日ごとに、その開催日の成績を保持しているか"""
+        codes, found = self._codes(np.asarray(keys, dtype=str))
+        positions = (codes << DAY_BITS) | _to_days(dates)
+        at = np.searchsorted(self._positions, positions)
+        hit = at < len(self._positions)
+        hit[hit] = self._positions[at[hit]] == positions[hit]
+        return found & hit
+
+    def lookup(self, keys, as_of):
+        """
+        キーごとに、as_ofより前(当日を含まない)の直近window件の成績を集計する関数 (point-in-time)
+
+        Parameters:
+        ----------
+        keys : array-like
+            キー(文字列)
+        as_of : array-like
+            キーごとの基準日
+
+        Returns:
+        ----------
+        count : numpy.ndarray
+            集計した成績の件数
+        means : numpy.ndarray
+            集計項目ごとの平均 (キーの数 × 集計項目数。値のある成績がない場合はNaN)
+        """
+        codes, found = self._codes(np.asarray(keys, dtype=str))
+        start = np.where(found, self._starts[codes], 0)
+        end = np.where(found, np.searchsorted(self._positions, (codes << DAY_BITS) | _to_days(as_of)), 0)
+        window_start = np.maximum(start, end - self.window)
+
+        counts = self._counts[end] - self._counts[window_start]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = (self._sums[end] - self._sums[window_start]) / counts
+        means[counts == 0] = np.nan
+        return end - window_start, means
+
+    def to_bytes(self):
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer, keys=self.keys, key_codes=self.key_codes.astype(np.int32), days=self.days.astype(np.int32),
+            values=self.values, stats=np.asarray(self.stats, dtype=str), window=np.asarray(self.window),
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, content):
+        arrays = np.load(io.BytesIO(content))
+        return cls(arrays['keys'], arrays['key_codes'], arrays['days'], arrays['values'], list(arrays['stats']), arrays['window'])
@@ -0,0 +1,187 @@
+"""
+馬券の購入方針(閾値・上位k頭・券種・レース内の購入対象頭数)のグリッドサーチ
+
+購入対象になり得る馬(候補)と、その組合せの馬券の払い戻しを最初に1度だけ計算しておき、
+各購入方針は候補に対するマスク処理だけで評価する
+購入方針の数が多い場合は複数プロセスで並列に評価する
+"""
+
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from backtest import BET_UNIT, make_bets
+from ranking import rank_within_race
+
+# 購入方針のパラメータ
+# threshold: predがこの値より大きい馬のみ購入対象 (Noneは閾値なし)
+# top_k: レース内でpredの上位k頭のみ購入対象 (Noneは全頭)
+# bet_type: 券種
+# min_horses, max_horses: 購入対象馬がこの頭数の範囲に収まるレースのみ購入 (Noneは制限なし)
+STRATEGY_PARAMS = ['threshold', 'top_k', 'bet_type', 'min_horses', 'max_horses']
+
+
+def make_grid(**params):
+    """
+    購入方針のパラメータの全組合せを作成する関数
+
+    例: make_grid(threshold=[None, 0.7, 0.8], top_k=[3], bet_type=['複勝', 'ワイド'], min_horses=[1], max_horses=[None])
+
+    Returns:
+    ----------
+    grid : list
+        購入方針(dict)のリスト
+    """
+    params = {name: params.get(name, [None]) for name in STRATEGY_PARAMS}
+    return [dict(zip(params, values)) for values in itertools.product(*params.values())]
+
+
+def _limit(value, default):
+    return default if value is None else value
+
+
+class CandidateSet:
+    """
+    購入対象になり得る馬と、その組合せの馬券を払い戻し付きで保持するクラス
+
+    Parameters:
+    ----------
+    predictions : pandas.DataFrame
+        race_id, horse_number, pred の列を持つ予測結果
+    payout_table : backtest.PayoutTable
+        払い戻しテーブル
+    bet_types : list
+        評価する券種
+    max_top_k : int
+        候補とする上位頭数の上限 (グリッドのtop_kの最大値。Noneは全頭)
+    min_threshold : float
+        候補とするpredの下限 (グリッドのthresholdの最小値。Noneは下限なし)
+    """
+
+    def __init__(self, predictions, payout_table, bet_types, max_top_k=None, min_threshold=None):
+        # 払い戻しデータのあるレースのみ対象とする
+        predictions = predictions[predictions['race_id'].isin(payout_table.race_ids)]
+        rank = rank_within_race(predictions['race_id'].to_numpy(), predictions['pred'].to_numpy())
+        candidates = predictions.assign(pred_rank=rank)
+        candidates = candidates[
+            (candidates['pred_rank'] <= _limit(max_top_k, np.inf))
+            & (candidates['pred'] > _limit(min_threshold, -np.inf))
+        ].reset_index(drop=True)
+
+        self.race_index = pd.Index(candidates['race_id'].unique())
+        self.race_code = self.race_index.get_indexer(candidates['race_id'])
+        self.rank = candidates['pred_rank'].to_numpy()
+        self.pred = candidates['pred'].to_numpy(dtype=float)
+
+        # (race_id, 馬番) から候補の順位・予測値を引くための対応表
+        lookup = candidates.set_index(['race_id', 'horse_number'])[['pred_rank', 'pred']]
+
+        self.bets = {}
+        for bet_type in bet_types:
+            settled = payout_table.settle(make_bets(candidates, bet_type))
+            if settled.empty:
+                # 候補の頭数が券種の組合せに満たない場合など、馬券が1点もない
+                self.bets[bet_type] = {
+                    'race_code': np.array([], dtype=np.int64),
+                    'max_rank': np.array([]),
+                    'min_pred': np.array([]),
+                    'refund': np.array([], dtype=np.int64),
+                }
+                continue
+            horses = np.array(settled['horses'].tolist(), dtype=np.int64).reshape(len(settled), -1)
+            race_ids = np.repeat(settled['race_id'].to_numpy(), horses.shape[1])
+            values = lookup.loc[list(zip(race_ids, horses.ravel()))].to_numpy().reshape(len(settled), -1, 2)
+            # 組合せの馬券は、含まれる馬がすべて購入対象のときのみ購入される
+            self.bets[bet_type] = {
+                'race_code': self.race_index.get_indexer(settled['race_id']),
+                'max_rank': values[:, :, 0].max(axis=1),
+                'min_pred': values[:, :, 1].min(axis=1),
+                'refund': settled['refund'].to_numpy(),
+            }
+
+    def evaluate(self, threshold=None, top_k=None, bet_type='複勝', min_horses=None, max_horses=None):
+        """購入方針1つ分の購入レース数・購入点数・的中数・回収金額・回収率を計算する"""
+        threshold = _limit(threshold, -np.inf)
+        top_k = _limit(top_k, np.inf)
+
+        # レースごとの購入対象馬の頭数
+        is_pick = (self.rank <= top_k) & (self.pred > threshold)
+        pick_count = np.bincount(self.race_code[is_pick], minlength=len(self.race_index))
+        race_ok = (pick_count >= _limit(min_horses, 1)) & (pick_count <= _limit(max_horses, np.inf))
+
+        bets = self.bets[bet_type]
+        mask = (bets['max_rank'] <= top_k) & (bets['min_pred'] > threshold) & race_ok[bets['race_code']]
+        refund = bets['refund'][mask]
+        n_bets = len(refund)
+        hits = int((refund > 0).sum())
+        total_refund = int(refund.sum())
+        cost = n_bets * BET_UNIT
+        return {
+            'races': len(np.unique(bets['race_code'][mask])),
+            'bets': n_bets,
+            'hits': hits,
+            'hit_rate': hits / n_bets if n_bets else np.nan,
+            'refund': total_refund,
+            'recovery_rate': total_refund / cost if n_bets else np.nan,
+            'roi': (total_refund - cost) / cost if n_bets else np.nan,
+        }
+
+
+# ワーカープロセスで共有する候補データ (initializerで1度だけ受け取る)
+_candidate_set = None
+
+
+def _init_worker(candidate_set):
+    global _candidate_set
+    _candidate_set = candidate_set
+
+
+def _evaluate_chunk(strategies):
+    return [dict(strategy, **_candidate_set.evaluate(**strategy)) for strategy in strategies]
+
+
+def run_grid(predictions, payout_table, grid, max_workers=None, chunk_size=200):
+    """
+    購入方針のグリッドを評価する関数
+
+    Parameters:
+    ----------
+    predictions : pandas.DataFrame
+        race_id, horse_number, pred の列を持つ予測結果
+    payout_table : backtest.PayoutTable
+        払い戻しテーブル
+    grid : list
+        購入方針(dict)のリスト (make_gridで作成)
+    max_workers : int
+        並列実行するプロセス数。1の場合は並列化せずに実行する
+    chunk_size : int
+        1プロセスにまとめて渡す購入方針の数
+
+    Returns:
+    ----------
+    result : pandas.DataFrame
+        購入方針ごとに races, bets, hits, hit_rate, refund, recovery_rate, roi を持つデータ
+    """
+    grid = [{name: strategy.get(name) for name in STRATEGY_PARAMS} for strategy in grid]
+    top_k_list = [s['top_k'] for s in grid]
+    threshold_list = [s['threshold'] for s in grid]
+    candidate_set = CandidateSet(
+        predictions,
+        payout_table,
+        sorted({s['bet_type'] for s in grid}),
+        max_top_k=None if None in top_k_list else max(top_k_list),
+        min_threshold=None if None in threshold_list else min(threshold_list),
+    )
+
+    chunks = [grid[i:i + chunk_size] for i in range(0, len(grid), chunk_size)]
+    max_workers = max_workers or os.cpu_count()
+    if max_workers == 1 or len(chunks) == 1:
+        _init_worker(candidate_set)
+        results = [_evaluate_chunk(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers, initializer=_init_worker, initargs=(candidate_set,)) as executor:
+            results = list(executor.map(_evaluate_chunk, chunks))
+    return pd.DataFrame(list(itertools.chain.from_iterable(results)))